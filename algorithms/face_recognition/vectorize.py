@@ -4,6 +4,8 @@ import numpy as np
 
 from face_recognition import face_encodings, face_locations, load_image_file
 
+from vectorize_server import serve
+
 FaceVector = List[float]
 Image = np.array
 
@@ -34,6 +36,13 @@ def get_face_vectors(img_path: str, prealigned: bool) -> List[FaceVector]:
     return face_vectors
 
 
+def get_face_vectors_batch(image_paths: List[str],
+                           prealigned: bool) -> List[List[FaceVector]]:
+    # naive implementation for demo purposes, could also batch process images
+    return [get_face_vectors(image_path, prealigned)
+            for image_path in image_paths]
+
+
 def _cli():
     from argparse import ArgumentParser
     from argparse import FileType
@@ -41,19 +50,24 @@ def _cli():
     import json
 
     parser = ArgumentParser(description=__doc__)
-    parser.add_argument('images', type=FileType('r'), nargs='+')
+    parser.add_argument('images', type=FileType('r'), nargs='*')
+    parser.add_argument('--serve', type=int, metavar='PORT',
+                        help='keep the model loaded and vectorize the images '
+                             'posted to this port')
 
     args = parser.parse_args()
+    prealigned = getenv('PREALIGNED') == 'true'
+
+    if args.serve:
+        serve(args.serve, get_face_vectors_batch, prealigned)
+        return
+
     image_paths = []
     for image in args.images:
         image.close()
         image_paths.append(image.name)
 
-    prealigned = getenv('PREALIGNED') == 'true'
-
-    # naive implementation for demo purposes, could also batch process images
-    vectors = [get_face_vectors(image_path, prealigned)
-               for image_path in image_paths]
+    vectors = get_face_vectors_batch(image_paths, prealigned)
 
     print(json.dumps({'faceVectors': vectors}))
 
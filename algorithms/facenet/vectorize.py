@@ -1,4 +1,5 @@
 import os
+from functools import lru_cache
 from typing import List
 
 import numpy as np
@@ -6,6 +7,8 @@ import tensorflow as tf
 
 from facenet_sandberg import Identifier, get_image_from_path_rgb
 
+from vectorize_server import serve
+
 os.environ['TF_CPP_MIN_LOG_LEVEL'] = '3'
 tf.logging.set_verbosity(tf.logging.ERROR)
 
@@ -13,9 +16,14 @@ FaceVector = List[float]
 Image = np.array
 
 
+@lru_cache(maxsize=1)
+def _get_identifier() -> Identifier:
+    return Identifier(model_path='facenet_model.pb')
+
+
 def get_face_vectors_batch(
         img_paths: List[str], prealigned: bool) -> List[List[FaceVector]]:
-    identifier = Identifier(model_path='facenet_model.pb')
+    identifier = _get_identifier()
 
     images = map(get_image_from_path_rgb, img_paths)
     all_vectors = identifier.vectorize_all(images, prealigned=prealigned)
@@ -32,16 +40,23 @@ def _cli():
     import json
 
     parser = ArgumentParser(description=__doc__)
-    parser.add_argument('images', type=FileType('r'), nargs='+')
+    parser.add_argument('images', type=FileType('r'), nargs='*')
+    parser.add_argument('--serve', type=int, metavar='PORT',
+                        help='keep the model loaded and vectorize the images '
+                             'posted to this port')
 
     args = parser.parse_args()
+    prealigned = getenv('PREALIGNED') == 'true'
+
+    if args.serve:
+        serve(args.serve, get_face_vectors_batch, prealigned)
+        return
+
     image_paths = []
     for image in args.images:
         image.close()
         image_paths.append(image.name)
 
-    prealigned = getenv('PREALIGNED') == 'true'
-
     vectors = get_face_vectors_batch(image_paths, prealigned)
 
     print(json.dumps({'faceVectors': vectors}))
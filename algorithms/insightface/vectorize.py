@@ -1,4 +1,5 @@
 import os
+from functools import lru_cache
 from typing import List
 
 import numpy as np
@@ -6,6 +7,8 @@ import tensorflow as tf
 
 from facenet_sandberg import Identifier, get_image_from_path_bgr
 
+from vectorize_server import serve
+
 os.environ['TF_CPP_MIN_LOG_LEVEL'] = '3'
 tf.logging.set_verbosity(tf.logging.ERROR)
 
@@ -13,15 +16,19 @@ FaceVector = List[float]
 Image = np.array
 
 
-def get_face_vectors_batch(
-        img_paths: List[str], prealigned: bool) -> List[List[FaceVector]]:
-    identifier = Identifier(
+@lru_cache(maxsize=1)
+def _get_identifier() -> Identifier:
+    return Identifier(
         model_path='insightface/insightface_ckpt',
         is_insightface=True)
 
+
+def get_face_vectors_batch(
+        img_paths: List[str], prealigned: bool) -> List[List[FaceVector]]:
+    identifier = _get_identifier()
+
     images = map(get_image_from_path_bgr, img_paths)
     all_vectors = identifier.vectorize_all(images, prealigned=prealigned)
-    identifier.tear_down()
     np_to_list = []
     for vectors in all_vectors:
         np_to_list.append([vector.tolist() for vector in vectors])
@@ -35,17 +42,25 @@ def _cli():
     import json
 
     parser = ArgumentParser(description=__doc__)
-    parser.add_argument('images', type=FileType('r'), nargs='+')
+    parser.add_argument('images', type=FileType('r'), nargs='*')
+    parser.add_argument('--serve', type=int, metavar='PORT',
+                        help='keep the model loaded and vectorize the images '
+                             'posted to this port')
 
     args = parser.parse_args()
+    prealigned = getenv('PREALIGNED') == 'true'
+
+    if args.serve:
+        serve(args.serve, get_face_vectors_batch, prealigned)
+        return
+
     image_paths = []
     for image in args.images:
         image.close()
         image_paths.append(image.name)
 
-    prealigned = getenv('PREALIGNED') == 'true'
-
     vectors = get_face_vectors_batch(image_paths, prealigned)
+    _get_identifier().tear_down()
 
     print(json.dumps({'faceVectors': vectors}))
 
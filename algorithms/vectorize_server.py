@@ -0,0 +1,44 @@
+"""Server mode shared by the algorithm containers, see README.md."""
+from base64 import b64decode
+from http.server import BaseHTTPRequestHandler
+from http.server import HTTPServer
+from tempfile import TemporaryDirectory
+from typing import Callable, List
+import json
+import os
+
+FaceVector = List[float]
+Vectorize = Callable[[List[str], bool], List[List[FaceVector]]]
+
+
+def serve(port: int, vectorize: Vectorize, prealigned: bool):
+    """Vectorize the images posted to the port until the process is killed.
+
+    Requests may override the PREALIGNED setting of the container with a
+    "prealigned" boolean next to the images.
+    """
+
+    class VectorizeHandler(BaseHTTPRequestHandler):
+        def do_POST(self):  # pylint: disable=invalid-name
+            length = int(self.headers['Content-Length'])
+            request = json.loads(self.rfile.read(length).decode('utf-8'))
+
+            with TemporaryDirectory() as image_dir:
+                image_paths = []
+                for i, image in enumerate(request['images']):
+                    image_path = os.path.join(image_dir, str(i))
+                    with open(image_path, 'wb') as fobj:
+                        fobj.write(b64decode(image))
+                    image_paths.append(image_path)
+
+                vectors = vectorize(image_paths,
+                                    request.get('prealigned', prealigned))
+
+            body = json.dumps({'faceVectors': vectors}).encode('utf-8')
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+    HTTPServer(('', port), VectorizeHandler).serve_forever()
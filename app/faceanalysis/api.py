@@ -1,11 +1,27 @@
 from http import HTTPStatus
+from io import BytesIO
+from itertools import chain
 from mimetypes import guess_type
+from typing import Any  # noqa: F401
+from typing import Dict  # noqa: F401
+from typing import IO
+from typing import Iterable
+from typing import Iterator
+from typing import List
+from typing import Optional
 from typing import Tuple
 from typing import Union
 from uuid import uuid4
+from zipfile import BadZipFile
+from zipfile import ZipFile
+from zipfile import is_zipfile
+import json
+import tarfile
 
 from flask import Flask
+from flask import Response
 from flask_restful import Resource
+from flask_restful import inputs
 from flask_restful.reqparse import RequestParser
 from flask_restful_swagger_2 import Api
 from flask_restful_swagger_2 import Schema
@@ -14,15 +30,28 @@ from werkzeug.datastructures import FileStorage
 from werkzeug.utils import secure_filename
 
 from faceanalysis import domain
+from faceanalysis.api_metrics import CacheMetrics
+from faceanalysis.api_metrics import DeletionMetrics
+from faceanalysis.api_metrics import QueueMetrics
+from faceanalysis.api_metrics import StageMetrics
+from faceanalysis.cache import get_cache
 from faceanalysis.domain.errors import ImageAlreadyProcessed
 from faceanalysis.domain.errors import ImageDoesNotExist
+from faceanalysis.domain.errors import SearchTimedOut
+from faceanalysis.domain.types import MatchCursor
 from faceanalysis.models import ImageStatusEnum
 from faceanalysis.models import delete_models
 from faceanalysis.models import init_models
 from faceanalysis.settings import ALLOWED_MIMETYPES
+from faceanalysis.settings import BULK_REQUEST_MAX_IMG_IDS
+from faceanalysis.settings import IMAGE_EXPORT_BATCH_SIZE
 from faceanalysis.settings import RESET_DATABASE_ENABLED
+from faceanalysis.tasks import BULK_PRIORITY
+from faceanalysis.tasks import INTERACTIVE_PRIORITY
+from faceanalysis.tasks import PRIORITIES
 
 JsonResponse = Union[dict, Tuple[dict, int]]
+Upload = Tuple[IO[bytes], str, Optional[str]]
 
 app = Flask(__name__)
 app.url_map.strict_slashes = False
@@ -37,6 +66,59 @@ ERROR_IMAGE_DOES_NOT_EXIST = 'Image not yet uploaded'
 ERROR_BAD_IMAGE_FORMAT = ('Image upload failed: please use one of the '
                           'following MIME types --> {}'
                           .format(ALLOWED_MIMETYPES))
+ERROR_BAD_ARCHIVE = 'Archive upload failed: please use a zip or tar file'
+ERROR_NO_IMAGES = 'images or archive missing in post body'
+ERROR_BAD_CURSOR = 'Invalid cursor: use the next value of a previous response'
+ERROR_BAD_LIMIT = 'Invalid limit: must be a positive integer'
+ERROR_TOO_MANY_IMG_IDS = ('Too many img_ids: send at most {} per request'
+                          .format(BULK_REQUEST_MAX_IMG_IDS))
+ERROR_SEARCH_TIMED_OUT = 'Search did not finish in time, please retry'
+ERROR_BAD_PRIORITY = ('Invalid priority: use one of the following '
+                      'priorities --> {}'.format(', '.join(PRIORITIES)))
+
+
+# the paginated lists take the cursor of the page before them
+_CURSOR_PARAMETER = {
+    'name': 'cursor',
+    'description': 'The next cursor of the previous page',
+    'in': 'query',
+    'type': 'string'
+}
+
+
+def _parse_priority(default: str, location) -> str:
+    parser = RequestParser()
+    parser.add_argument('priority',
+                        choices=PRIORITIES,
+                        default=default,
+                        location=location,
+                        help=ERROR_BAD_PRIORITY)
+    return parser.parse_args()['priority']
+
+
+def _priority_parameter(default: str) -> dict:
+    return {
+        'name': 'priority',
+        'description': 'Queue to process the images from, workers prefer '
+                       'interactive images over bulk images '
+                       '(default {})'.format(default),
+        'in': 'query',
+        'type': 'string',
+        'enum': list(PRIORITIES),
+    }
+
+
+def _format_match_cursor(cursor: MatchCursor) -> str:
+    distance, img_id = cursor
+    return '{!r},{}'.format(distance, img_id)
+
+
+def _parse_match_cursor(cursor: Optional[str]) -> Optional[MatchCursor]:
+    if not cursor:
+        return None
+
+    distance, img_id = cursor.split(',', 1)
+    return float(distance), img_id
 
 
 # pylint: disable=no-self-use
@@ -50,7 +132,8 @@ class ProcessImg(Resource):
                 'description': 'UUID of an uploaded image',
                 'in': 'body',
                 'schema': {'type': 'string', }
-            }
+            },
+            _priority_parameter(INTERACTIVE_PRIORITY),
         ],
         'responses': {
             '200': {
@@ -61,7 +144,8 @@ class ProcessImg(Resource):
                 }
             },
             '400': {
-                'description': 'Image not uploaded or already in queue',
+                'description': 'Image not uploaded or already in queue or '
+                               'invalid priority',
                 'schema': {'type': 'string', }
             },
             '500': {
@@ -77,9 +161,10 @@ class ProcessImg(Resource):
                             help="img_id missing in the post body")
         args = parser.parse_args()
         img_id = args['img_id']
+        priority = _parse_priority(INTERACTIVE_PRIORITY, ('json', 'values'))
 
         try:
-            domain.process_image(img_id)
+            domain.process_image(img_id, priority)
         except ImageAlreadyProcessed:
             return {'error_msg': ERROR_IMAGE_ALREADY_PROCESSED},\
                     HTTPStatus.BAD_REQUEST.value
@@ -136,6 +221,228 @@ class ProcessImg(Resource):
         return {'status': status, 'error_msg': error}
 
 
+def _parse_img_ids(location: str) -> Tuple[List[str], bool]:
+    parser = RequestParser()
+    parser.add_argument('img_ids',
+                        action='append',
+                        required=True,
+                        location=location,
+                        help='img_ids missing in the request')
+    parser.add_argument('with_matches',
+                        type=inputs.boolean,
+                        default=False,
+                        location=location)
+    args = parser.parse_args()
+
+    # keep the first occurrence of each id and the order of the request
+    img_ids = list(dict.fromkeys(args['img_ids']))
+    return img_ids, args['with_matches']
+
+
+class ProcessImgBatch(Resource):
+    class ProcessImgBatchModel(Schema):
+        type = 'object'
+        properties = {
+            'img_ids': {
+                'type': 'array',
+                'description': 'UUID of the images placed in the queue',
+                'items': {
+                    'type': 'string'
+                }
+            },
+            'rejected': {
+                'type': 'array',
+                'description': 'UUID of the images not yet uploaded or '
+                               'previously placed in the queue',
+                'items': {
+                    'type': 'string'
+                }
+            },
+        }
+
+    @swagger.doc({
+        'tags': ['process', ],
+        'description': 'Process many uploaded images at once',
+        'parameters': [
+            {
+                'name': 'img_ids',
+                'description': 'UUIDs of uploaded images',
+                'in': 'body',
+                'schema': {'type': 'array', 'items': {'type': 'string'}}
+            },
+            _priority_parameter(BULK_PRIORITY),
+        ],
+        'responses': {
+            '200': {
+                'description': 'Images placed in the queue',
+                'schema': ProcessImgBatchModel,
+            },
+            '400': {
+                'description': 'img_ids missing, too many img_ids or '
+                               'invalid priority',
+                'schema': {'type': 'string', }
+            },
+            '500': {
+                'description': "Images can't be placed in queue",
+                'schema': {'type': 'string', }
+            }
+        }
+    })
+    def post(self) -> JsonResponse:
+        img_ids, _ = _parse_img_ids('json')
+        priority = _parse_priority(BULK_PRIORITY, ('json', 'args'))
+
+        if len(img_ids) > BULK_REQUEST_MAX_IMG_IDS:
+            return {'error_msg': ERROR_TOO_MANY_IMG_IDS},\
+                   HTTPStatus.BAD_REQUEST.value
+
+        queued, rejected = domain.process_images(img_ids, priority)
+
+        return {'img_ids': queued, 'rejected': rejected}
+
+
+class ImgStatusList(Resource):
+    class ImgStatusListModel(Schema):
+        type = 'object'
+        properties = {
+            'statuses': {
+                'type': 'array',
+                'description': 'Status of each known image in request order',
+                'items': {
+                    'type': 'object',
+                    'properties': {
+                        'img_id': {
+                            'type': 'string',
+                            'description': 'Image UUID'
+                        },
+                        'status': {
+                            'type': 'string',
+                            'description': 'Image status',
+                            'oneOf': [status.name
+                                      for status in ImageStatusEnum],
+                        },
+                        'error_msg': {
+                            'type': 'string',
+                            'description': 'Error message (can be null)'
+                        },
+                        'num_matches': {
+                            'type': 'integer',
+                            'description': 'Number of matching images '
+                                           '(only if with_matches is set)'
+                        },
+                        'closest_distance': {
+                            'type': 'number',
+                            'description': 'Distance to the closest '
+                                           'matching image (can be null, '
+                                           'only if with_matches is set)'
+                        },
+                    }
+                }
+            },
+            'missing': {
+                'type': 'array',
+                'description': 'UUID of the images not yet uploaded',
+                'items': {
+                    'type': 'string'
+                }
+            },
+        }
+
+    _parameters = [
+        {
+            'name': 'img_ids',
+            'description': 'UUIDs of images (can be repeated)',
+            'in': 'query',
+            'type': 'string'
+        },
+        {
+            'name': 'with_matches',
+            'description': 'Also return the number of matches and the '
+                           'closest match distance of each image',
+            'in': 'query',
+            'type': 'boolean'
+        },
+    ]
+
+    _responses = {
+        '200': {
+            'description': 'Statuses of the images identified by their UUIDs',
+            'schema': ImgStatusListModel,
+        },
+        '400': {
+            'description': 'img_ids missing or too many img_ids',
+            'schema': {'type': 'string', }
+        },
+    }
+
+    @swagger.doc({
+        'tags': ['status', ],
+        'description': 'Get the statuses of many images from their UUIDs',
+        'parameters': _parameters,
+        'responses': _responses,
+    })
+    def get(self) -> JsonResponse:
+        return self._get_statuses(*_parse_img_ids('args'))
+
+    @swagger.doc({
+        'tags': ['status', ],
+        'description': 'Get the statuses of many images from their UUIDs '
+                       'sent in the body to avoid long URLs',
+        'parameters': [
+            {
+                'name': 'body',
+                'description': 'img_ids and with_matches as in the query',
+                'in': 'body',
+                'schema': {
+                    'type': 'object',
+                    'properties': {
+                        'img_ids': {
+                            'type': 'array',
+                            'items': {'type': 'string'}
+                        },
+                        'with_matches': {'type': 'boolean'},
+                    }
+                }
+            }
+        ],
+        'responses': _responses,
+    })
+    def post(self) -> JsonResponse:
+        return self._get_statuses(*_parse_img_ids('json'))
+
+    @classmethod
+    def _get_statuses(cls, img_ids: List[str],
+                      with_matches: bool) -> JsonResponse:
+
+        if len(img_ids) > BULK_REQUEST_MAX_IMG_IDS:
+            return {'error_msg': ERROR_TOO_MANY_IMG_IDS},\
+                   HTTPStatus.BAD_REQUEST.value
+
+        statuses = domain.get_processing_statuses(img_ids)
+        summaries = {}  # type: Dict[str, Tuple[int, Optional[float]]]
+        if with_matches:
+            summaries = domain.summarize_matches(list(statuses))
+
+        results = []
+        missing = []
+        for img_id in img_ids:
+            try:
+                status, error = statuses[img_id]
+            except KeyError:
+                missing.append(img_id)
+                continue
+
+            result = {'img_id': img_id, 'status': status,
+                      'error_msg': error}  # type: Dict[str, Any]
+            if with_matches:
+                num_matches, closest = summaries.get(img_id, (0, None))
+                result['num_matches'] = num_matches
+                result['closest_distance'] = closest
+            results.append(result)
+
+        return {'statuses': results, 'missing': missing}
+
+
 class ImgUpload(Resource):
     @swagger.doc({
         'tags': ['upload', ],
@@ -187,11 +494,174 @@ class ImgUpload(Resource):
         img_id = str(uuid4())
         image_type = mimetype.split('/')[1]
         image_filename = '{}.{}'.format(img_id, image_type)
-        domain.upload_image(image.stream, img_id, image_filename)
+        img_id = domain.upload_image(image.stream, img_id, image_filename)
 
         return {'img_id': img_id}
 
 
+class ImgBulkUpload(Resource):
+    class ImgBulkUploadModel(Schema):
+        type = 'object'
+        properties = {
+            'img_ids': {
+                'type': 'array',
+                'description': 'UUID of the uploaded images',
+                'items': {
+                    'type': 'string'
+                }
+            },
+            'filenames': {
+                'type': 'array',
+                'description': 'Filenames corresponding to img_ids array',
+                'items': {
+                    'type': 'string'
+                }
+            },
+            'rejected': {
+                'type': 'array',
+                'description': 'Filenames not uploaded since their MIME '
+                               'type is not allowed',
+                'items': {
+                    'type': 'string'
+                }
+            },
+        }
+
+    @swagger.doc({
+        'tags': ['upload', ],
+        'description': 'Upload many images at once',
+        'parameters': [
+            {
+                'name': 'images',
+                'description': 'Uploaded images (can be repeated)',
+                'in': 'formData',
+                'type': 'file'
+            },
+            {
+                'name': 'archive',
+                'description': 'Zip or (compressed) tar archive of images',
+                'in': 'formData',
+                'type': 'file'
+            },
+            {
+                'name': 'process',
+                'description': 'Also queue all the images for processing',
+                'in': 'query',
+                'type': 'boolean'
+            },
+            _priority_parameter(BULK_PRIORITY),
+        ],
+        'responses': {
+            '200': {
+                'description': 'Uploaded image UUIDs',
+                'schema': ImgBulkUploadModel,
+            },
+            '400': {
+                'description': 'No images, invalid archive or invalid '
+                               'priority',
+                'schema': {'type': 'string', }
+            },
+            '500': {
+                'description': 'Something wrong happened when saving the '
+                               'image files or updating the statuses',
+                'schema': {'type': 'string', }
+            }
+        }
+    })
+    def post(self) -> JsonResponse:
+        parser = RequestParser()
+        parser.add_argument('images',
+                            type=FileStorage,
+                            action='append',
+                            default=[],
+                            location='files')
+        parser.add_argument('archive',
+                            type=FileStorage,
+                            location='files')
+        parser.add_argument('process',
+                            type=inputs.boolean,
+                            default=False,
+                            location='args')
+        parser.add_argument('priority',
+                            choices=PRIORITIES,
+                            default=BULK_PRIORITY,
+                            location='args',
+                            help=ERROR_BAD_PRIORITY)
+        args = parser.parse_args()
+
+        uploads = [(image.stream, image.filename, image.mimetype)
+                   for image in args['images']]
+        archive_uploads = []  # type: Iterable[Upload]
+        if args['archive'] is not None:
+            try:
+                archive_uploads = _open_archive(args['archive'].stream)
+            except (BadZipFile, tarfile.TarError):
+                return {'error_msg': ERROR_BAD_ARCHIVE},\
+                       HTTPStatus.BAD_REQUEST.value
+        elif not uploads:
+            return {'error_msg': ERROR_NO_IMAGES},\
+                   HTTPStatus.BAD_REQUEST.value
+
+        filenames = []  # type: List[str]
+        rejected = []  # type: List[str]
+        try:
+            # archive members are only read while the images are stored
+            img_ids = domain.upload_images(
+                _accept_uploads(chain(uploads, archive_uploads),
+                                filenames, rejected),
+                args['process'], args['priority'])
+        except (BadZipFile, tarfile.TarError):
+            return {'error_msg': ERROR_BAD_ARCHIVE},\
+                   HTTPStatus.BAD_REQUEST.value
+
+        return {'img_ids': img_ids,
+                'filenames': filenames,
+                'rejected': rejected}
+
+
+def _open_archive(stream: IO[bytes]) -> Iterator[Upload]:
+    if is_zipfile(stream):
+        stream.seek(0)
+        return _iter_zip(ZipFile(stream))
+
+    stream.seek(0)
+    return _iter_tar(tarfile.open(fileobj=stream, mode='r|*'))
+
+
+def _iter_zip(archive: ZipFile) -> Iterator[Upload]:
+    with archive:
+        for member in archive.infolist():
+            # the names of directory entries end with a slash
+            if not member.filename.endswith('/'):
+                yield BytesIO(archive.read(member)), member.filename, None
+
+
+def _iter_tar(archive: tarfile.TarFile) -> Iterator[Upload]:
+    # the archive is streamed so every member must be read before the next
+    with archive:
+        for member in archive:
+            fobj = archive.extractfile(member) if member.isfile() else None
+            if fobj is not None:
+                yield BytesIO(fobj.read()), member.name, None
+
+
+def _accept_uploads(uploads: Iterable[Upload],
+                    filenames: List[str],
+                    rejected: List[str]) \
+        -> Iterator[Tuple[IO[bytes], str, str]]:
+
+    for stream, filename, mimetype in uploads:
+        mimetype = mimetype or guess_type(secure_filename(filename))[0]
+        if mimetype not in ALLOWED_MIMETYPES:
+            rejected.append(filename)
+            continue
+
+        img_id = str(uuid4())
+        image_type = mimetype.split('/')[1]
+        filenames.append(filename)
+        yield stream, img_id, '{}.{}'.format(img_id, image_type)
+
+
 class ImgMatchList(Resource):
     class ImgMatchListModel(Schema):
         type = 'object'
@@ -212,11 +682,17 @@ class ImgMatchList(Resource):
                     'format': 'float',
                 }
             },
+            'next': {
+                'type': 'string',
+                'description': 'Cursor to fetch the next page of matches '
+                               '(null on the last page)',
+            },
         }
 
     @swagger.doc({
         'tags': ['match', ],
-        'description': 'Get all UUID of matches from an image UUID',
+        'description': 'Get the UUID of matches from an image UUID, '
+                       'closest matches first',
         'parameters': [
             {
                 'name': 'img_id',
@@ -224,61 +700,237 @@ class ImgMatchList(Resource):
                 'description': 'Image UUID',
                 'in': 'path',
                 'type': 'string'
-            }
+            },
+            {
+                'name': 'limit',
+                'description': 'Maximum number of matches to return',
+                'in': 'query',
+                'type': 'integer'
+            },
+            {
+                'name': 'max_distance',
+                'description': 'Only return matches closer than this',
+                'in': 'query',
+                'type': 'number'
+            },
+            _CURSOR_PARAMETER,
         ],
         'responses': {
             '200': {
                 'description': 'Uploaded image UUID',
                 'schema': ImgMatchListModel,
             },
+            '400': {
+                'description': 'Invalid limit or cursor',
+                'schema': {'type': 'string', }
+            },
         }
     })
     def get(self, img_id: str) -> JsonResponse:
-        images, distances = domain.lookup_matching_images(img_id)
+        parser = RequestParser()
+        parser.add_argument('limit', type=int, location='args')
+        parser.add_argument('max_distance', type=float, location='args')
+        parser.add_argument('cursor', type=str, location='args')
+        args = parser.parse_args()
+        limit = args['limit']
+
+        try:
+            cursor = _parse_match_cursor(args['cursor'])
+        except ValueError:
+            return {'error_msg': ERROR_BAD_CURSOR},\
+                   HTTPStatus.BAD_REQUEST.value
+
+        if limit is not None and limit <= 0:
+            return {'error_msg': ERROR_BAD_LIMIT},\
+                   HTTPStatus.BAD_REQUEST.value
+
+        images, distances = domain.lookup_matching_images(
+            img_id, limit, args['max_distance'], cursor)
+
+        next_cursor = None
+        if limit is not None and len(images) == limit:
+            next_cursor = _format_match_cursor((distances[-1], images[-1]))
+
+        return {'imgs': images, 'distances': distances, 'next': next_cursor}
+
+
+class ImgSearch(Resource):
+    @swagger.doc({
+        'tags': ['search', ],
+        'description': 'Find the images matching the faces in an image '
+                       'without storing it, closest matches first',
+        'parameters': [
+            {
+                'name': 'image',
+                'description': 'Image to search for',
+                'in': 'body',
+                'schema': {'type': 'binary', }
+            },
+            {
+                'name': 'limit',
+                'description': 'Maximum number of matches to return',
+                'in': 'query',
+                'type': 'integer'
+            },
+        ],
+        'responses': {
+            '200': {
+                'description': 'Matching image UUIDs',
+                'schema': ImgMatchList.ImgMatchListModel,
+            },
+            '400': {
+                'description': 'Mime type not allowed or invalid limit',
+                'schema': {'type': 'string', }
+            },
+            '504': {
+                'description': 'Search took longer than the time budget',
+                'schema': {'type': 'string', }
+            },
+        }
+    })
+    def post(self) -> JsonResponse:
+        parser = RequestParser()
+        parser.add_argument('image',
+                            type=FileStorage,
+                            required=True,
+                            help="image missing in post body",
+                            location='files')
+        parser.add_argument('limit', type=int, location='args')
+        args = parser.parse_args()
+        image = args['image']
+        limit = args['limit']
+        filename = secure_filename(image.filename)
+        mimetype = image.mimetype or guess_type(filename)[0]
+
+        if mimetype not in ALLOWED_MIMETYPES:
+            return {'error_msg': ERROR_BAD_IMAGE_FORMAT},\
+                   HTTPStatus.BAD_REQUEST.value
+
+        if limit is not None and limit <= 0:
+            return {'error_msg': ERROR_BAD_LIMIT},\
+                   HTTPStatus.BAD_REQUEST.value
+
+        try:
+            images, distances = domain.search_image(image.stream, filename,
+                                                    limit)
+        except SearchTimedOut:
+            return {'error_msg': ERROR_SEARCH_TIMED_OUT},\
+                   HTTPStatus.GATEWAY_TIMEOUT.value
+
         return {'imgs': images, 'distances': distances}
 
 
 class ImgList(Resource):
+    class ImgListModel(Schema):
+        type = 'object'
+        properties = {
+            'imgs': {
+                'type': 'array',
+                'description': 'List of image UUID',
+                'items': {
+                    'type': 'string'
+                }
+            },
+            'next': {
+                'type': 'string',
+                'description': 'Cursor to fetch the next page of images '
+                               '(null on the last page)',
+            },
+        }
+
     @swagger.doc({
         'tags': ['list', ],
-        'description': 'Get all UUID of matches from an image UUID',
+        'description': 'Get the UUID of all processed images',
         'parameters': [
             {
-                'name': 'img_id',
-                'required': True,
-                'description': 'Image UUID',
-                'in': 'path',
+                'name': 'limit',
+                'description': 'Maximum number of images to return',
+                'in': 'query',
+                'type': 'integer'
+            },
+            _CURSOR_PARAMETER,
+            {
+                'name': 'format',
+                'description': 'Set to ndjson to stream all the images as '
+                               'one JSON object per line',
+                'in': 'query',
                 'type': 'string'
-            }
+            },
         ],
         'responses': {
             '200': {
-                'description': 'Uploaded image UUID',
-                'schema': {
-                    'type': 'array',
-                    'items': 'string',
-                },
+                'description': 'Image UUIDs',
+                'schema': ImgListModel,
+            },
+            '400': {
+                'description': 'Invalid limit or cursor',
+                'schema': {'type': 'string', }
             },
         }
     })
-    def get(self) -> JsonResponse:
-        images = domain.list_images()
-        return {'imgs': images}
+    def get(self) -> Union[JsonResponse, Response]:
+        parser = RequestParser()
+        parser.add_argument('limit', type=int, location='args')
+        parser.add_argument('cursor', type=str, location='args')
+        parser.add_argument('format', type=str, location='args')
+        args = parser.parse_args()
+        limit = args['limit']
+
+        try:
+            cursor = int(args['cursor']) if args['cursor'] else None
+        except ValueError:
+            return {'error_msg': ERROR_BAD_CURSOR},\
+                   HTTPStatus.BAD_REQUEST.value
+
+        if limit is not None and limit <= 0:
+            return {'error_msg': ERROR_BAD_LIMIT},\
+                   HTTPStatus.BAD_REQUEST.value
+
+        if args['format'] == 'ndjson':
+            return Response(_stream_images(cursor),
+                            mimetype='application/x-ndjson')
+
+        images, next_cursor = domain.list_images(limit, cursor)
+        next_page = None
+        if next_cursor is not None:
+            next_page = str(next_cursor)
+
+        return {'imgs': images, 'next': next_page}
+
+
+def _stream_images(cursor: Optional[int]) -> Iterable[str]:
+    while True:
+        images, cursor = domain.list_images(IMAGE_EXPORT_BATCH_SIZE, cursor)
+        for img_id in images:
+            yield json.dumps({'img_id': img_id}) + '\n'
+        if cursor is None:
+            return
 
 
 class ResetDatabase(Resource):
     def get(self) -> JsonResponse:
         delete_models()
         init_models()
+        cache = get_cache()
+        if cache is not None:
+            cache.clear()
         return {'status': 'DELETED'}
 # pylint: enable=no-self-use
 
 
 api.add_resource(ImgUpload, '/api/v1/upload_image')
+api.add_resource(ImgBulkUpload, '/api/v1/upload_images')
 api.add_resource(ProcessImg, '/api/v1/process_image/',
                  '/api/v1/process_image/<string:img_id>')
+api.add_resource(ProcessImgBatch, '/api/v1/process_images')
+api.add_resource(ImgStatusList, '/api/v1/image_statuses')
 api.add_resource(ImgMatchList, '/api/v1/image_matches/<string:img_id>')
 api.add_resource(ImgList, '/api/v1/images')
+api.add_resource(ImgSearch, '/api/v1/search')
+api.add_resource(CacheMetrics, '/api/v1/metrics/cache')
+api.add_resource(DeletionMetrics, '/api/v1/metrics/deletions')
+api.add_resource(StageMetrics, '/api/v1/metrics/stages')
+api.add_resource(QueueMetrics, '/api/v1/metrics/queues')
 
 if RESET_DATABASE_ENABLED:
     api.add_resource(ResetDatabase, '/api/v1/reset')
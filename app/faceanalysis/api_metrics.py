@@ -0,0 +1,199 @@
+from datetime import datetime
+from typing import Optional
+
+from flask_restful import Resource
+from flask_restful import inputs
+from flask_restful.reqparse import RequestParser
+from flask_restful_swagger_2 import Schema
+from flask_restful_swagger_2 import swagger
+
+from faceanalysis.cache import get_cache_stats
+from faceanalysis.deleter import get_deletion_backlog
+from faceanalysis.tasks import get_queue_metrics
+from faceanalysis.timings import get_stage_timings
+
+
+def _since_parameter(description: str) -> dict:
+    return {
+        'name': 'since',
+        'description': description,
+        'in': 'query',
+        'type': 'string'
+    }
+
+
+def _parse_since() -> Optional[datetime]:
+    parser = RequestParser()
+    parser.add_argument('since', type=inputs.datetime_from_iso8601,
+                        location='args')
+    args = parser.parse_args()
+    return args['since']
+
+
+# pylint: disable=no-self-use
+class CacheMetrics(Resource):
+    class CacheMetricsModel(Schema):
+        type = 'object'
+        properties = {
+            'hits': {
+                'type': 'integer',
+                'description': 'Lookups answered from the cache'
+            },
+            'misses': {
+                'type': 'integer',
+                'description': 'Lookups answered from the database'
+            },
+            'hit_rate': {
+                'type': 'number',
+                'description': 'Fraction of lookups answered from the cache '
+                               '(can be null)'
+            },
+            'hit_latency_ms': {
+                'type': 'number',
+                'description': 'Mean latency of cache hits (can be null)'
+            },
+            'miss_latency_ms': {
+                'type': 'number',
+                'description': 'Mean latency of cache misses (can be null)'
+            },
+        }
+
+    @swagger.doc({
+        'tags': ['metrics', ],
+        'description': 'Get the cache counters of this api process for the '
+                       'status and the matches lookups',
+        'responses': {
+            '200': {
+                'description': 'Cache counters by lookup',
+                'schema': {
+                    'type': 'object',
+                    'additionalProperties': CacheMetricsModel,
+                },
+            },
+        }
+    })
+    def get(self) -> dict:
+        return get_cache_stats()
+
+
+class DeletionMetrics(Resource):
+    class DeletionMetricsModel(Schema):
+        type = 'object'
+        properties = {
+            'pending': {
+                'type': 'integer',
+                'description': 'Processed images not yet deleted from storage'
+            },
+            'oldest': {
+                'type': 'string',
+                'description': 'Time at which the oldest pending image was '
+                               'processed (can be null)'
+            },
+        }
+
+    @swagger.doc({
+        'tags': ['metrics', ],
+        'description': 'Get the backlog of processed images waiting to be '
+                       'deleted from storage',
+        'responses': {
+            '200': {
+                'description': 'Deletion backlog',
+                'schema': DeletionMetricsModel,
+            },
+        }
+    })
+    def get(self) -> dict:
+        return get_deletion_backlog()
+
+
+class StageMetrics(Resource):
+    class StageMetricsModel(Schema):
+        type = 'object'
+        properties = {
+            'images': {
+                'type': 'integer',
+                'description': 'Images that went through the stage'
+            },
+            'seconds_per_image': {
+                'type': 'number',
+                'description': 'Mean time the stage took per image '
+                               '(can be null)'
+            },
+        }
+
+    @swagger.doc({
+        'tags': ['metrics', ],
+        'description': 'Get the time the workers spent in the normalize and '
+                       'the vectorize stages of processing images and the '
+                       'time the images waited in the queue of each '
+                       'priority',
+        'parameters': [
+            _since_parameter('Only count the images processed since this '
+                             'ISO 8601 time'),
+        ],
+        'responses': {
+            '200': {
+                'description': 'Stage timings by stage',
+                'schema': {
+                    'type': 'object',
+                    'additionalProperties': StageMetricsModel,
+                },
+            },
+            '400': {
+                'description': 'Invalid time',
+                'schema': {'type': 'string', }
+            },
+        }
+    })
+    def get(self) -> dict:
+        return get_stage_timings(_parse_since())
+
+
+class QueueMetrics(Resource):
+    class QueueMetricsModel(Schema):
+        type = 'object'
+        properties = {
+            'queue': {
+                'type': 'string',
+                'description': 'Name of the queue'
+            },
+            'depth': {
+                'type': 'integer',
+                'description': 'Images waiting to be processed'
+            },
+            'images': {
+                'type': 'integer',
+                'description': 'Images taken from the queue by the workers'
+            },
+            'wait_seconds_per_image': {
+                'type': 'number',
+                'description': 'Mean time the images waited in the queue '
+                               '(can be null)'
+            },
+        }
+
+    @swagger.doc({
+        'tags': ['metrics', ],
+        'description': 'Get the depth of the queue of each priority and '
+                       'how long its images waited to be processed',
+        'parameters': [
+            _since_parameter('Only count the waits of the images taken '
+                             'from the queues since this ISO 8601 time'),
+        ],
+        'responses': {
+            '200': {
+                'description': 'Queue metrics by priority',
+                'schema': {
+                    'type': 'object',
+                    'additionalProperties': QueueMetricsModel,
+                },
+            },
+            '400': {
+                'description': 'Invalid time',
+                'schema': {'type': 'string', }
+            },
+        }
+    })
+    def get(self) -> dict:
+        return get_queue_metrics(_parse_since())
+# pylint: enable=no-self-use
@@ -0,0 +1,73 @@
+from threading import Thread
+from time import monotonic
+from typing import List  # noqa: F401
+
+from faceanalysis.log import get_logger
+from faceanalysis.settings import IMAGE_BATCH_MAX_LATENCY
+from faceanalysis.settings import IMAGE_BATCH_SIZE
+from faceanalysis.tasks import PRIORITIES
+from faceanalysis.tasks import celery
+from faceanalysis.tasks import get_batch_queue
+from faceanalysis.tasks import get_process_queue
+from faceanalysis.tasks import process_image_batch
+
+logger = get_logger(__name__)
+
+
+def _drain(queue, batch_size: int, max_latency: float) -> list:
+    messages = [queue.get(block=True)]
+    deadline = monotonic() + max_latency
+
+    while len(messages) < batch_size:
+        timeout = deadline - monotonic()
+        if timeout <= 0:
+            break
+        try:
+            messages.append(queue.get(block=True, timeout=timeout))
+        except queue.Empty:
+            break
+
+    return messages
+
+
+def _run_priority_batcher(priority: str,
+                          batch_size: int,
+                          max_latency: float):
+
+    with celery.connection_for_read() as connection:
+        with connection.SimpleQueue(get_batch_queue(priority)) as queue:
+            while True:
+                messages = _drain(queue, batch_size, max_latency)
+                img_ids = [message.payload['img_id']
+                           for message in messages]  # type: List[str]
+                queued_at = [message.payload['queued_at']
+                             for message in messages
+                             if 'queued_at' in message.payload]
+
+                process_image_batch.apply_async(
+                    (img_ids, priority, queued_at),
+                    queue=get_process_queue(priority))
+                logger.debug('Dispatched %s batch of %d images',
+                             priority, len(img_ids))
+
+                for message in messages:
+                    message.ack()
+
+
+def run_batcher(batch_size: int = IMAGE_BATCH_SIZE,
+                max_latency: float = IMAGE_BATCH_MAX_LATENCY):
+    """Group queued images into batches processed by process_image_batch.
+
+    A batch is dispatched as soon as it holds batch_size images or once
+    max_latency seconds have passed since its first image was queued. The
+    images of every priority are batched separately.
+    """
+    threads = [Thread(target=_run_priority_batcher,
+                      args=(priority, batch_size, max_latency),
+                      daemon=True)
+               for priority in PRIORITIES]
+
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
@@ -0,0 +1,237 @@
+from collections import OrderedDict
+from functools import lru_cache
+from functools import wraps
+from threading import Lock
+from time import monotonic
+from typing import Any
+from typing import Callable
+from typing import Dict
+from typing import Iterable
+from typing import Optional
+from typing import Tuple
+import json
+
+from faceanalysis.log import get_logger
+from faceanalysis.settings import CACHE_MAX_SIZE
+from faceanalysis.settings import CACHE_TTL
+from faceanalysis.settings import CACHE_URL
+
+logger = get_logger(__name__)
+
+STATUS_NAMESPACE = 'status'
+MATCHES_NAMESPACE = 'matches'
+_NAMESPACES = (STATUS_NAMESPACE, MATCHES_NAMESPACE)
+
+_MISSING = object()
+
+# when a key expires and its values by field
+_Entry = Tuple[float, Dict[str, Any]]
+
+
+class Cache:
+    """Values stored under a field of a key, all the fields of a key are
+    dropped together so that every result derived from one image can be
+    invalidated at once."""
+
+    def get(self, key: str, field: str) -> Any:
+        raise NotImplementedError
+
+    def set(self, key: str, field: str, value: Any):
+        raise NotImplementedError
+
+    def delete(self, keys: Iterable[str]):
+        raise NotImplementedError
+
+    def clear(self):
+        raise NotImplementedError
+
+
+class LocalCache(Cache):
+    """In-process LRU cache whose keys expire ttl seconds after creation.
+
+    The invalidations done by the workers never reach it, so the cached
+    results are only as fresh as the ttl.
+    """
+
+    def __init__(self, max_size: int = CACHE_MAX_SIZE,
+                 ttl: float = CACHE_TTL) -> None:
+        self.max_size = max_size
+        self.ttl = ttl
+        self._entries = OrderedDict()  # type: OrderedDict[str, _Entry]
+        self._lock = Lock()
+
+    def get(self, key: str, field: str) -> Any:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return _MISSING
+
+            expires, fields = entry
+            if expires <= monotonic():
+                del self._entries[key]
+                return _MISSING
+
+            self._entries.move_to_end(key)
+            return fields.get(field, _MISSING)
+
+    def set(self, key: str, field: str, value: Any):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry[0] <= monotonic():
+                entry = (monotonic() + self.ttl, {})
+                self._entries[key] = entry
+            self._entries.move_to_end(key)
+            _, fields = entry
+            fields[field] = value
+
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def delete(self, keys: Iterable[str]):
+        with self._lock:
+            for key in keys:
+                self._entries.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+class RedisCache(Cache):
+    """Cache shared by all processes so that the invalidations done by the
+    workers are seen by every api process."""
+
+    prefix = 'faceanalysis:'
+
+    def __init__(self, url: str, ttl: float = CACHE_TTL) -> None:
+        from redis import StrictRedis
+        self.redis = StrictRedis.from_url(url)
+        self.ttl = ttl
+
+    def get(self, key: str, field: str) -> Any:
+        value = self.redis.hget(self.prefix + key, field)
+        if value is None:
+            return _MISSING
+        return json.loads(value.decode('utf-8'))
+
+    def set(self, key: str, field: str, value: Any):
+        with self.redis.pipeline() as pipeline:
+            pipeline.hset(self.prefix + key, field, json.dumps(value))
+            pipeline.expire(self.prefix + key, max(1, int(self.ttl)))
+            pipeline.execute()
+
+    def delete(self, keys: Iterable[str]):
+        keys = [self.prefix + key for key in keys]
+        if keys:
+            self.redis.delete(*keys)
+
+    def clear(self):
+        keys = list(self.redis.scan_iter(self.prefix + '*'))
+        if keys:
+            self.redis.delete(*keys)
+
+
+@lru_cache(maxsize=1)
+def get_cache() -> Optional[Cache]:
+    if CACHE_URL.startswith('redis://'):
+        return RedisCache(CACHE_URL)
+    if CACHE_URL == 'local://':
+        return LocalCache()
+    return None
+
+
+class CacheStats:
+    def __init__(self):
+        self.hits = 0
+        self.misses = 0
+        self.hit_seconds = 0.0
+        self.miss_seconds = 0.0
+
+    def record(self, is_hit: bool, seconds: float):
+        if is_hit:
+            self.hits += 1
+            self.hit_seconds += seconds
+        else:
+            self.misses += 1
+            self.miss_seconds += seconds
+
+    def to_dict(self) -> Dict[str, Optional[float]]:
+        lookups = self.hits + self.misses
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': self.hits / lookups if lookups else None,
+            'hit_latency_ms': (1000 * self.hit_seconds / self.hits
+                               if self.hits else None),
+            'miss_latency_ms': (1000 * self.miss_seconds / self.misses
+                                if self.misses else None),
+        }
+
+
+_stats = {}  # type: Dict[str, CacheStats]
+
+
+def get_cache_stats() -> Dict[str, Dict[str, Optional[float]]]:
+    return {namespace: stats.to_dict() for namespace, stats in _stats.items()}
+
+
+def _cache_key(namespace: str, img_id: str) -> str:
+    return '{}:{}'.format(namespace, img_id)
+
+
+def cached(namespace: str) -> Callable:
+    """Read-through caching of a function returning a tuple for an image.
+
+    The result is cached per image under the repr of the other arguments
+    and is dropped by invalidate_images when the workers update the image.
+    Without a cache every call goes straight to the function.
+    """
+    stats = _stats.setdefault(namespace, CacheStats())
+
+    def decorator(func: Callable[..., Tuple]) -> Callable[..., Tuple]:
+        @wraps(func)
+        def wrapper(img_id: str, *args, **kwargs) -> Tuple:
+            cache = get_cache()
+            if cache is None:
+                return func(img_id, *args, **kwargs)
+
+            start = monotonic()
+            key = _cache_key(namespace, img_id)
+            field = repr((args, sorted(kwargs.items())))
+
+            try:
+                value = cache.get(key, field)
+            except Exception:  # pylint: disable=broad-except
+                logger.exception("Can't read %s from the cache", key)
+                value = _MISSING
+
+            is_hit = value is not _MISSING
+            if is_hit:
+                result = tuple(value)
+            else:
+                result = func(img_id, *args, **kwargs)
+                try:
+                    cache.set(key, field, list(result))
+                except Exception:  # pylint: disable=broad-except
+                    logger.exception("Can't write %s to the cache", key)
+
+            stats.record(is_hit, monotonic() - start)
+            return result
+
+        return wrapper
+
+    return decorator
+
+
+def invalidate_images(img_ids: Iterable[str]):
+    keys = [_cache_key(namespace, img_id)
+            for img_id in set(img_ids)
+            for namespace in _NAMESPACES]
+    cache = get_cache()
+    if cache is None or not keys:
+        return
+
+    try:
+        cache.delete(keys)
+    except Exception:  # pylint: disable=broad-except
+        logger.exception("Can't invalidate %d cached images", len(keys))
@@ -0,0 +1,79 @@
+from time import sleep
+from typing import Dict
+from typing import List  # noqa: F401
+from typing import Optional
+from typing import Union
+
+from sqlalchemy.sql import func
+
+from faceanalysis.log import get_logger
+from faceanalysis.models import PendingDeletion
+from faceanalysis.models import get_db_session
+from faceanalysis.settings import DELETER_BATCH_SIZE
+from faceanalysis.settings import DELETER_INTERVAL
+from faceanalysis.storage import delete_images
+from faceanalysis.tasks import delete_expired_results
+
+logger = get_logger(__name__)
+
+
+def delete_pending_images(batch_size: int = DELETER_BATCH_SIZE) -> int:
+    """Remove the images recorded as pending deletion from storage.
+
+    The pending deletions are walked in batches of batch_size. Deletions
+    that fail stay pending and are retried by the next pass.
+    """
+    last_id = 0
+    deleted = 0
+
+    while True:
+        rows = []  # type: List[tuple]
+        with get_db_session() as session:
+            rows = session.query(PendingDeletion.id,
+                                 PendingDeletion.img_id,
+                                 PendingDeletion.object_name) \
+                .filter(PendingDeletion.id > last_id) \
+                .order_by(PendingDeletion.id) \
+                .limit(batch_size) \
+                .all()
+
+        if not rows:
+            return deleted
+
+        last_id = rows[-1][0]
+        deleted_img_ids = set(delete_images(
+            [(img_id, object_name) for _, img_id, object_name in rows]))
+        done_ids = [row_id for row_id, img_id, _ in rows
+                    if img_id in deleted_img_ids]
+
+        if done_ids:
+            with get_db_session(commit=True) as session:
+                session.query(PendingDeletion) \
+                    .filter(PendingDeletion.id.in_(done_ids)) \
+                    .delete(synchronize_session=False)
+
+        deleted += len(done_ids)
+        logger.debug('Deleted %d of %d pending images up to id %d',
+                     len(done_ids), len(rows), last_id)
+
+
+def get_deletion_backlog() -> Dict[str, Union[int, Optional[str]]]:
+    pending = 0
+    oldest = None
+    with get_db_session() as session:
+        pending, oldest = session.query(
+            func.count(PendingDeletion.id),
+            func.min(PendingDeletion.time_created)).one()
+
+    return {'pending': pending,
+            'oldest': oldest.isoformat() if oldest is not None else None}
+
+
+def run_deleter(interval: float = DELETER_INTERVAL):
+    while True:
+        deleted = delete_pending_images()
+        backlog = get_deletion_backlog()
+        logger.info('Deleted %d images, %d still pending since %s',
+                    deleted, backlog['pending'], backlog['oldest'])
+        delete_expired_results()
+        sleep(interval)
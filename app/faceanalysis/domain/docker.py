@@ -1,22 +1,61 @@
+from concurrent.futures import FIRST_COMPLETED
+from concurrent.futures import Future  # noqa: F401
+from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import wait
+from heapq import merge
+from itertools import islice
+from shutil import copyfileobj
+from tempfile import NamedTemporaryFile
+from time import monotonic
+from typing import Dict
 from typing import IO
+from typing import Iterable
 from typing import List
+from typing import Optional
+from typing import Set  # noqa: F401
 from typing import Tuple
+import os
+
+from celery.exceptions import TimeoutError as CeleryTimeoutError
+from sqlalchemy import and_
+from sqlalchemy import or_
+from sqlalchemy.orm import Session
+from sqlalchemy.sql import func
 
 from faceanalysis import tasks
+from faceanalysis.cache import MATCHES_NAMESPACE
+from faceanalysis.cache import STATUS_NAMESPACE
+from faceanalysis.cache import cached
 from faceanalysis.domain.errors import ImageAlreadyProcessed
 from faceanalysis.domain.errors import ImageDoesNotExist
+from faceanalysis.domain.errors import SearchTimedOut
+from faceanalysis.domain.pagination import list_img_ids
+from faceanalysis.domain.types import MatchCursor
+from faceanalysis.face_vectorizer import VectorizerError
+from faceanalysis.face_vectorizer import get_face_vectors
 from faceanalysis.log import get_logger
 from faceanalysis.models import Image
 from faceanalysis.models import ImageStatus
 from faceanalysis.models import ImageStatusEnum
 from faceanalysis.models import Match
 from faceanalysis.models import get_db_session
+from faceanalysis.normalizer import normalized_images
+from faceanalysis.settings import FACE_VECTORIZE_ALGORITHM
+from faceanalysis.settings import MATCH_STORAGE_MODE
+from faceanalysis.settings import MOUNTED_DATA_DIR
+from faceanalysis.settings import SEARCH_TIMEOUT
+from faceanalysis.settings import UPLOAD_CONCURRENCY
+from faceanalysis.settings import UPLOAD_DEDUPLICATION
+from faceanalysis.storage import delete_image
+from faceanalysis.storage import delete_images
 from faceanalysis.storage import store_image
+from faceanalysis.tasks import BULK_PRIORITY
+from faceanalysis.tasks import INTERACTIVE_PRIORITY
 
 logger = get_logger(__name__)
 
 
-def process_image(img_id: str):
+def process_image(img_id: str, priority: str = INTERACTIVE_PRIORITY):
     with get_db_session() as session:
         img_status = session.query(ImageStatus) \
             .filter(ImageStatus.img_id == img_id) \
@@ -28,10 +67,31 @@ def process_image(img_id: str):
     if img_status.status != ImageStatusEnum.uploaded.name:
         raise ImageAlreadyProcessed()
 
-    tasks.process_image.delay(img_id)
-    logger.debug('Image %s queued for processing', img_id)
+    tasks.queue_image(img_id, priority)
+    logger.debug('Image %s queued for %s processing', img_id, priority)
+
+
+def process_images(img_ids: List[str],
+                   priority: str = BULK_PRIORITY) \
+        -> Tuple[List[str], List[str]]:
+
+    statuses = {}  # type: Dict[str, str]
+    with get_db_session() as session:
+        statuses = dict(session.query(ImageStatus.img_id, ImageStatus.status)
+                        .filter(ImageStatus.img_id.in_(img_ids)))
 
+    queued = [img_id for img_id in img_ids
+              if statuses.get(img_id) == ImageStatusEnum.uploaded.name]
+    rejected = [img_id for img_id in img_ids
+                if statuses.get(img_id) != ImageStatusEnum.uploaded.name]
 
+    if queued:
+        tasks.queue_images(queued, priority)
+    logger.debug('Queued %d images for %s processing', len(queued), priority)
+    return queued, rejected
+
+
+@cached(STATUS_NAMESPACE)
 def get_processing_status(img_id: str) -> Tuple[str, str]:
     with get_db_session() as session:
         img_status = session.query(ImageStatus) \
@@ -45,38 +105,284 @@ def get_processing_status(img_id: str) -> Tuple[str, str]:
     return img_status.status, img_status.error_msg
 
 
-def upload_image(stream: IO[bytes], img_id: str, filename: str):
-    store_image(stream, filename)
-    img_status = ImageStatus(img_id=img_id,
-                             status=ImageStatusEnum.uploaded.name,
-                             error_msg=None)
+def get_processing_statuses(img_ids: List[str]) \
+        -> Dict[str, Tuple[str, str]]:
+
+    statuses = {}  # type: Dict[str, Tuple[str, str]]
+    with get_db_session() as session:
+        statuses = {img_id: (status, error_msg)
+                    for img_id, status, error_msg in session
+                    .query(ImageStatus.img_id,
+                           ImageStatus.status,
+                           ImageStatus.error_msg)
+                    .filter(ImageStatus.img_id.in_(img_ids))}
+
+    logger.debug('Got statuses of %d images', len(statuses))
+    return statuses
+
+
+def summarize_matches(img_ids: List[str]) \
+        -> Dict[str, Tuple[int, Optional[float]]]:
+
+    rows = []  # type: List[tuple]
+    with get_db_session() as session:
+        rows = _summarize_matches(session, Match.this_img_id, img_ids)
+        if MATCH_STORAGE_MODE == 'canonical':
+            # each pair is stored once so also look at the reverse direction
+            rows += _summarize_matches(session, Match.that_img_id, img_ids)
+
+    summaries = {}  # type: Dict[str, Tuple[int, Optional[float]]]
+    for img_id, count, closest in rows:
+        previous_count, previous_closest = summaries.get(img_id, (0, None))
+        if previous_closest is not None:
+            closest = min(closest, previous_closest)
+        summaries[img_id] = (previous_count + count, closest)
+
+    return summaries
+
 
+def _summarize_matches(session: Session, this_column,
+                       img_ids: List[str]) -> List[tuple]:
+
+    return session.query(this_column,
+                         func.count(Match.id),
+                         func.min(Match.distance_score)) \
+        .filter(this_column.in_(img_ids)) \
+        .group_by(this_column) \
+        .all()
+
+
+def _find_uploaded_hashes(session: Session,
+                          content_hashes: Iterable[str]) -> Dict[str, str]:
+
+    rows = session.query(ImageStatus.content_hash, ImageStatus.img_id) \
+        .filter(ImageStatus.content_hash.in_(set(content_hashes))) \
+        .order_by(ImageStatus.id.desc())
+
+    # the earliest upload of each content wins
+    return dict(rows)
+
+
+def upload_image(stream: IO[bytes], img_id: str, filename: str) -> str:
+    content_hash = store_image(stream, filename)
+
+    existing_img_id = None  # type: Optional[str]
     with get_db_session(commit=True) as session:
-        session.add(img_status)
+        if UPLOAD_DEDUPLICATION == 'return':
+            existing_img_id = _find_uploaded_hashes(
+                session, [content_hash]).get(content_hash)
+
+        if existing_img_id is None:
+            session.add(ImageStatus(img_id=img_id,
+                                    status=ImageStatusEnum.uploaded.name,
+                                    error_msg=None,
+                                    object_name=filename,
+                                    content_hash=content_hash))
+
+    if existing_img_id is not None:
+        delete_image(img_id, filename)
+        logger.debug('Image %s is a duplicate of %s', img_id, existing_img_id)
+        return existing_img_id
 
     logger.debug('Image %s uploaded', img_id)
+    return img_id
 
 
-def list_images() -> List[str]:
-    with get_db_session() as session:
-        image_ids = [image.img_id for image in session.query(Image).all()]
+def _store_images(images: Iterable[Tuple[IO[bytes], str, str]]) \
+        -> List[Tuple[str, str, str]]:
+    """Store the images concurrently, returning their img_id, filename and
+    content hash.
+
+    When the images can't all be read or stored, the ones stored so far are
+    deleted again before the error is raised since they have no status.
+    """
+    stored = []  # type: List[Tuple[str, str, Future]]
+    try:
+        with ThreadPoolExecutor(max_workers=UPLOAD_CONCURRENCY) as executor:
+            pending = set()  # type: Set[Future]
+            for stream, img_id, filename in images:
+                # bound the number of images held in memory at once
+                if len(pending) >= 2 * UPLOAD_CONCURRENCY:
+                    done, pending = wait(pending,
+                                         return_when=FIRST_COMPLETED)
+                    for future in done:
+                        future.result()
+
+                future = executor.submit(store_image, stream, filename)
+                pending.add(future)
+                stored.append((img_id, filename, future))
+
+            for future in pending:
+                future.result()
+    except Exception:
+        stored_images = [
+            (img_id, filename) for img_id, filename, future in stored
+            if future.exception() is None
+        ]  # type: List[Tuple[str, Optional[str]]]
+        delete_images(stored_images)
+        logger.warning('Deleted %d images of a failed upload',
+                       len(stored_images))
+        raise
+
+    return [(img_id, filename, future.result())
+            for img_id, filename, future in stored]
+
+
+def upload_images(images: Iterable[Tuple[IO[bytes], str, str]],
+                  process: bool = False,
+                  priority: str = BULK_PRIORITY) -> List[str]:
 
-    logger.debug('Got %d images overall', len(image_ids))
-    return image_ids
+    uploads = _store_images(images)
+    if not uploads:
+        return []
 
+    existing_img_ids = {}  # type: Dict[str, str]
+    rows = []  # type: List[dict]
+    with get_db_session(commit=True) as session:
+        if UPLOAD_DEDUPLICATION == 'return':
+            existing_img_ids = _find_uploaded_hashes(
+                session, [content_hash for _, _, content_hash in uploads])
+
+        for img_id, filename, content_hash in uploads:
+            if content_hash in existing_img_ids:
+                continue
+            if UPLOAD_DEDUPLICATION == 'return':
+                existing_img_ids[content_hash] = img_id
+            rows.append({'img_id': img_id,
+                         'status': ImageStatusEnum.uploaded.name,
+                         'error_msg': None,
+                         'object_name': filename,
+                         'content_hash': content_hash})
+
+        if rows:
+            session.execute(ImageStatus.__table__.insert(), rows)
+
+    new_img_ids = [row['img_id'] for row in rows]
+    img_ids = [existing_img_ids.get(content_hash, img_id)
+               for img_id, _, content_hash in uploads]
+
+    for img_id, filename, content_hash in uploads:
+        if existing_img_ids.get(content_hash, img_id) != img_id:
+            delete_image(img_id, filename)
+
+    logger.debug('Uploaded %d images, %d of them new',
+                 len(img_ids), len(new_img_ids))
+
+    if process and new_img_ids:
+        tasks.queue_images(new_img_ids, priority)
+        logger.debug('Queued %d images for %s processing',
+                     len(new_img_ids), priority)
+
+    return img_ids
+
+
+def list_images(limit: Optional[int] = None,
+                cursor: Optional[int] = None) \
+        -> Tuple[List[str], Optional[int]]:
+    return list_img_ids(Image, limit, cursor)
+
+
+def _query_matches(query, that_column, limit: Optional[int],
+                   max_distance: Optional[float],
+                   cursor: Optional[MatchCursor]) -> List[tuple]:
+
+    if max_distance is not None:
+        query = query.filter(Match.distance_score < max_distance)
+
+    if cursor is not None:
+        cursor_distance, cursor_img_id = cursor
+        query = query.filter(or_(
+            Match.distance_score > cursor_distance,
+            and_(Match.distance_score == cursor_distance,
+                 that_column > cursor_img_id)))
+
+    query = query.order_by(Match.distance_score, that_column)
+
+    if limit is not None:
+        query = query.limit(limit)
+
+    return query.all()
 
-def lookup_matching_images(img_id: str) -> Tuple[List[str], List[float]]:
+
+@cached(MATCHES_NAMESPACE)
+def lookup_matching_images(img_id: str,
+                           limit: Optional[int] = None,
+                           max_distance: Optional[float] = None,
+                           cursor: Optional[MatchCursor] = None) \
+        -> Tuple[List[str], List[float]]:
+
+    matches = []  # type: List[tuple]
     with get_db_session() as session:
-        matches = session.query(Match) \
-            .filter(Match.this_img_id == img_id) \
-            .order_by(Match.distance_score.desc()) \
-            .all()
+        query = session.query(Match.that_img_id, Match.distance_score) \
+            .filter(Match.this_img_id == img_id)
+        matches = _query_matches(query, Match.that_img_id,
+                                 limit, max_distance, cursor)
+
+        if MATCH_STORAGE_MODE == 'canonical':
+            # each pair is stored once so also look at the reverse direction
+            query = session.query(Match.this_img_id, Match.distance_score) \
+                .filter(Match.that_img_id == img_id)
+            reverse_matches = _query_matches(query, Match.this_img_id,
+                                             limit, max_distance, cursor)
+            matches = list(islice(
+                merge(matches, reverse_matches, key=_distance_then_img_id),
+                limit))
 
     images = []
     distances = []
-    for match in matches:
-        images.append(match.that_img_id)
-        distances.append(match.distance_score)
+    for that_img_id, distance_score in matches:
+        images.append(that_img_id)
+        distances.append(distance_score)
 
     logger.debug('Image %s has %d matches', img_id, len(distances))
     return images, distances
+
+
+def _distance_then_img_id(match: tuple) -> MatchCursor:
+    that_img_id, distance_score = match
+    return distance_score, that_img_id
+
+
+def _remaining(deadline: float) -> float:
+    timeout = deadline - monotonic()
+    if timeout <= 0:
+        raise SearchTimedOut()
+    return timeout
+
+
+def search_image(stream: IO[bytes], filename: str,
+                 limit: Optional[int] = None) \
+        -> Tuple[List[str], List[float]]:
+
+    deadline = monotonic() + SEARCH_TIMEOUT
+
+    # keep the probe in the data directory like every other image
+    with NamedTemporaryFile(suffix=os.path.splitext(filename)[1],
+                            dir=MOUNTED_DATA_DIR) as fobj:
+        copyfileobj(stream, fobj)
+        fobj.flush()
+        # the probe must be vectorized like the stored images it's matched to
+        try:
+            with normalized_images([fobj.name]) as (img_path,):
+                face_vectors = get_face_vectors(img_path,
+                                                FACE_VECTORIZE_ALGORITHM,
+                                                _remaining(deadline))
+        except VectorizerError:
+            logger.exception("Can't vectorize probe %s in time", filename)
+            raise SearchTimedOut()
+
+    if not face_vectors:
+        return [], []
+
+    timeout = _remaining(deadline)
+
+    try:
+        matches = tasks.search(face_vectors, limit, timeout)
+    except CeleryTimeoutError:
+        raise SearchTimedOut()
+
+    images = [that_img_id for that_img_id, _ in matches]
+    distances = [distance for _, distance in matches]
+
+    logger.debug('Probe %s has %d matches', filename, len(distances))
+    return images, distances
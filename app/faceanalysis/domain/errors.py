@@ -8,3 +8,7 @@ class ImageDoesNotExist(FaceAnalysisError):
 
 class ImageAlreadyProcessed(FaceAnalysisError):
     pass
+
+
+class SearchTimedOut(FaceAnalysisError):
+    pass
@@ -2,6 +2,7 @@ from typing import Dict
 from typing import IO
 from typing import Iterable
 from typing import List
+from typing import Optional
 from typing import Tuple
 
 import cognitive_face
@@ -9,6 +10,8 @@ from cognitive_face import CognitiveFaceException
 
 from faceanalysis import storage
 from faceanalysis.domain.errors import ImageDoesNotExist
+from faceanalysis.domain.pagination import list_img_ids
+from faceanalysis.domain.types import MatchCursor
 from faceanalysis.log import get_logger
 from faceanalysis.models import FaceApiMapping
 from faceanalysis.models import ImageStatusEnum
@@ -17,6 +20,8 @@ from faceanalysis.settings import FACE_API_ACCESS_KEY
 from faceanalysis.settings import FACE_API_ENDPOINT
 from faceanalysis.settings import FACE_API_MODEL_ID
 from faceanalysis.storage import StorageError
+from faceanalysis.tasks import BULK_PRIORITY
+from faceanalysis.tasks import INTERACTIVE_PRIORITY
 
 if not FACE_API_MODEL_ID or not FACE_API_ACCESS_KEY or not FACE_API_ENDPOINT:
     raise ValueError('FaceAPI settings missing')
@@ -28,7 +33,7 @@ logger = get_logger(__name__)
 
 
 # pylint: disable=unused-argument
-def process_image(img_id: str):
+def process_image(img_id: str, priority: str = INTERACTIVE_PRIORITY):
     model_id, is_new = _get_model_id()
 
     if is_new:
@@ -46,6 +51,64 @@ def process_image(img_id: str):
 # pylint: enable=unused-argument
 
 
+# pylint: disable=unused-argument
+def process_images(img_ids: List[str],
+                   priority: str = BULK_PRIORITY) \
+        -> Tuple[List[str], List[str]]:
+
+    queued = []  # type: List[str]
+    rejected = []  # type: List[str]
+    for img_id in img_ids:
+        try:
+            storage.get_image_path(img_id)
+        except StorageError:
+            rejected.append(img_id)
+        else:
+            queued.append(img_id)
+
+    # a single retraining of the model picks up all the images
+    if queued:
+        try:
+            process_image(queued[0])
+        except ImageDoesNotExist:
+            return [], rejected + queued
+
+    return queued, rejected
+# pylint: enable=unused-argument
+
+
+def get_processing_statuses(img_ids: List[str]) \
+        -> Dict[str, Tuple[str, str]]:
+
+    known_img_ids = []  # type: List[str]
+    with get_db_session() as session:
+        known_img_ids = [img_id for img_id, in session
+                         .query(FaceApiMapping.img_id)
+                         .filter(FaceApiMapping.img_id.in_(img_ids))]
+
+    if not known_img_ids:
+        return {}
+
+    # all the images share the training status of the model
+    try:
+        status = get_processing_status(known_img_ids[0])
+    except ImageDoesNotExist:
+        return {}
+
+    return {img_id: status for img_id in known_img_ids}
+
+
+def summarize_matches(img_ids: List[str]) \
+        -> Dict[str, Tuple[int, Optional[float]]]:
+
+    summaries = {}  # type: Dict[str, Tuple[int, Optional[float]]]
+    for img_id in img_ids:
+        _, distances = lookup_matching_images(img_id)
+        summaries[img_id] = (len(distances),
+                             min(distances) if distances else None)
+    return summaries
+
+
 # pylint: disable=unused-argument
 def get_processing_status(img_id: str) -> Tuple[str, str]:
     model_id, is_new = _get_model_id()
@@ -98,7 +161,7 @@ def upload_image(stream: IO[bytes], filename: str) -> str:
     img_id = filename[:filename.find('.')]
 
     storage.store_image(stream, filename)
-    image_path = storage.get_image_path(img_id)
+    image_path = storage.get_image_path(img_id, filename)
 
     faces = cognitive_face.face.detect(image_path)
     if len(faces) != 1:
@@ -117,13 +180,21 @@ def upload_image(stream: IO[bytes], filename: str) -> str:
     return img_id
 
 
-def list_images() -> List[str]:
-    with get_db_session() as session:
-        image_ids = [mapping.img_id
-                     for mapping in session.query(FaceApiMapping).all()]
+# pylint: disable=unused-argument
+def upload_images(images: Iterable[Tuple[IO[bytes], str, str]],
+                  process: bool = False,
+                  priority: str = BULK_PRIORITY) -> List[str]:
+
+    # face-api indexes every face as it's added so there's nothing to batch
+    return [upload_image(stream, filename)
+            for stream, _, filename in images]
+# pylint: enable=unused-argument
+
 
-    logger.debug('Got %d images', len(image_ids))
-    return image_ids
+def list_images(limit: Optional[int] = None,
+                cursor: Optional[int] = None) \
+        -> Tuple[List[str], Optional[int]]:
+    return list_img_ids(FaceApiMapping, limit, cursor)
 
 
 def _fetch_faces_for_person(img_id: str) -> Tuple[List[str], str]:
@@ -177,7 +248,11 @@ def _fetch_mappings_for_faces(face_ids: Iterable[str]) -> List[FaceApiMapping]:
     return mappings
 
 
-def lookup_matching_images(img_id: str) -> Tuple[List[str], List[float]]:
+def lookup_matching_images(img_id: str, limit: Optional[int] = None,
+                           max_distance: Optional[float] = None,
+                           cursor: Optional[MatchCursor] = None) \
+        -> Tuple[List[str], List[float]]:
+
     face_ids, own_id = _fetch_faces_for_person(img_id)
     if not face_ids:
         return [], []
@@ -191,13 +266,46 @@ def lookup_matching_images(img_id: str) -> Tuple[List[str], List[float]]:
     if not mappings:
         return [], []
 
-    images = []
-    distances = []
-    for mapping in mappings:
-        confidence = face_id_to_confidence[mapping.face_id]
-        distance = 1 - confidence
-        images.append(mapping.img_id)
+    matches = sorted((1 - face_id_to_confidence[mapping.face_id],
+                      mapping.img_id)
+                     for mapping in mappings)
+
+    images = []  # type: List[str]
+    distances = []  # type: List[float]
+    for distance, that_img_id in matches:
+        if max_distance is not None and distance >= max_distance:
+            break
+        if cursor is not None and (distance, that_img_id) <= cursor:
+            continue
+        if limit is not None and len(images) == limit:
+            break
+        images.append(that_img_id)
         distances.append(distance)
 
     logger.debug('Image %s has %d matches', img_id, len(distances))
     return images, distances
+
+
+def search_image(stream: IO[bytes], filename: str,
+                 limit: Optional[int] = None) \
+        -> Tuple[List[str], List[float]]:
+
+    faces = cognitive_face.face.detect(stream)
+    face_ids = [face['faceId'] for face in faces]
+    if not face_ids:
+        return [], []
+
+    face_id_to_confidence = _fetch_matching_faces(face_ids)
+    if not face_id_to_confidence:
+        return [], []
+
+    mappings = _fetch_mappings_for_faces(face_id_to_confidence.keys())
+    matches = sorted((1 - face_id_to_confidence[mapping.face_id],
+                      mapping.img_id)
+                     for mapping in mappings)[:limit]
+
+    images = [that_img_id for _, that_img_id in matches]
+    distances = [distance for distance, _ in matches]
+
+    logger.debug('Probe %s has %d matches', filename, len(distances))
+    return images, distances
@@ -0,0 +1,34 @@
+from typing import List
+from typing import Optional
+from typing import Tuple
+
+from faceanalysis.log import get_logger
+from faceanalysis.models import get_db_session
+
+logger = get_logger(__name__)
+
+
+def list_img_ids(model, limit: Optional[int] = None,
+                 cursor: Optional[int] = None) \
+        -> Tuple[List[str], Optional[int]]:
+    """Page through the img_ids of a model by its primary key.
+
+    The returned cursor is the id of the last row on a full page and is
+    passed back to get the page after it; it's None on the last page.
+    """
+    rows = []  # type: List[tuple]
+    with get_db_session() as session:
+        query = session.query(model.id, model.img_id)
+        if cursor is not None:
+            query = query.filter(model.id > cursor)
+        query = query.order_by(model.id)
+        if limit is not None:
+            query = query.limit(limit)
+        rows = query.all()
+
+    image_ids = [img_id for _, img_id in rows]
+    next_cursor = rows[-1][0] if limit is not None and len(rows) == limit \
+        else None
+
+    logger.debug('Got %d images', len(image_ids))
+    return image_ids, next_cursor
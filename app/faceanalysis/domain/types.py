@@ -0,0 +1,4 @@
+from typing import Tuple
+
+# position after which to continue listing matches: (distance, img_id)
+MatchCursor = Tuple[float, str]
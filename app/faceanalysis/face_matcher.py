@@ -1,4 +1,9 @@
+from contextlib import ExitStack
+from contextlib import contextmanager
 from datetime import datetime
+from typing import Dict
+from typing import Iterable
+from typing import Iterator
 from typing import List
 from typing import Optional
 from typing import Tuple
@@ -6,21 +11,40 @@ from typing import Tuple
 import numpy as np
 from sqlalchemy.orm import Session
 
-from faceanalysis.face_vectorizer import face_vector_from_text, FaceVector
-from faceanalysis.face_vectorizer import face_vector_to_text
-from faceanalysis.face_vectorizer import get_face_vectors
+from faceanalysis.cache import invalidate_images
+from faceanalysis.face_vectorizer import FaceVector
+from faceanalysis.face_vectorizer import face_vector_from_bytes
+from faceanalysis.face_vectorizer import face_vector_to_bytes
+from faceanalysis.face_vectorizer import get_face_vectors_batch
+from faceanalysis.gallery import Gallery
+from faceanalysis.gallery import get_gallery
+from faceanalysis.image_cache import get_image_cache
 from faceanalysis.log import get_logger
 from faceanalysis.models import FeatureMapping
 from faceanalysis.models import Image
 from faceanalysis.models import ImageStatus
 from faceanalysis.models import ImageStatusEnum
 from faceanalysis.models import Match
+from faceanalysis.models import PendingDeletion
 from faceanalysis.models import get_db_session
+from faceanalysis.normalizer import normalized_images
+from faceanalysis.perceptual_hash import compute_perceptual_hash
+from faceanalysis.perceptual_hash import find_similar_image
+from faceanalysis.perceptual_hash import format_perceptual_hash
+from faceanalysis.perceptual_hash import index_images
 from faceanalysis.settings import DISTANCE_SCORE_THRESHOLD
 from faceanalysis.settings import FACE_VECTORIZE_ALGORITHM
+from faceanalysis.settings import MATCH_STORAGE_MODE
+from faceanalysis.settings import NEAR_DUPLICATE_DETECTION
+from faceanalysis.settings import NEAR_DUPLICATE_RADIUS
+from faceanalysis.settings import UPLOAD_DEDUPLICATION
 from faceanalysis.storage import StorageError
-from faceanalysis.storage import delete_image
 from faceanalysis.storage import get_image_path
+from faceanalysis.timings import NORMALIZE_STAGE
+from faceanalysis.timings import VECTORIZE_STAGE
+from faceanalysis.timings import QueueWait
+from faceanalysis.timings import record_queue_wait
+from faceanalysis.timings import timed_stage
 
 logger = get_logger(__name__)
 
@@ -34,131 +58,778 @@ def _add_entry_to_session(cls, session: Session, **kwargs):
 
 def _store_face_vector(features: FaceVector, img_id: str, session: Session):
     logger.debug('processing feature mapping')
-    _add_entry_to_session(FeatureMapping, session,
-                          img_id=img_id,
-                          features=face_vector_to_text(features))
-    return features
+    return _add_entry_to_session(FeatureMapping, session,
+                                 img_id=img_id,
+                                 features=face_vector_to_bytes(features))
 
 
-def _store_matches(this_img_id: str,
-                   that_img_id: str,
-                   distance_score: float,
+def _store_matches(matches: Iterable[Tuple[str, str, float]],
                    session: Session):
 
     logger.debug('processing matches')
-    _add_entry_to_session(Match, session,
-                          this_img_id=this_img_id,
-                          that_img_id=that_img_id,
-                          distance_score=distance_score)
-    _add_entry_to_session(Match, session,
-                          this_img_id=that_img_id,
-                          that_img_id=this_img_id,
-                          distance_score=distance_score)
 
+    rows = []  # type: List[Dict[str, object]]
+    for this_img_id, that_img_id, distance_score in matches:
+        pair = tuple(sorted((this_img_id, that_img_id)))
+        pairs = [pair]  # type: List[Tuple[str, ...]]
+        if MATCH_STORAGE_MODE != 'canonical':
+            pairs.append(pair[::-1])
 
-def _load_image_ids_and_face_vectors() -> Tuple[List[str], np.array]:
-    logger.debug('getting all img ids and respective features')
+        rows.extend({'this_img_id': pair[0],
+                     'that_img_id': pair[1],
+                     'distance_score': distance_score}
+                    for pair in pairs)
 
-    with get_db_session() as session:
-        rows = session.query(FeatureMapping)\
+    if not rows:
+        return
+
+    # the matched images must exist before the matches can reference them
+    session.flush()
+
+    # pairs found concurrently by another worker are already stored
+    insert = Match.__table__.insert().prefix_with('IGNORE', dialect='mysql')
+    session.execute(insert, rows)
+
+
+def _invalidate_processed_images(img_ids: List[str],
+                                 matches: List[Tuple[str, str, float]]):
+    # the matches of the images they matched changed as well
+    invalidate_images(img_ids + [that_img_id for _, that_img_id, _ in matches])
+
+
+def _with_img_id(img_id: str, matches: List[Tuple[str, float]]) \
+        -> List[Tuple[str, str, float]]:
+
+    return [(img_id, that_img_id, distance_score)
+            for that_img_id, distance_score in matches]
+
+
+# statuses from which an image may move into each status
+_PREVIOUS_STATUSES = {
+    ImageStatusEnum.processing: (
+        ImageStatusEnum.uploaded,
+    ),
+    ImageStatusEnum.face_vector_computed: (
+        ImageStatusEnum.processing,
+    ),
+    ImageStatusEnum.finished_processing: (
+        ImageStatusEnum.processing,
+        ImageStatusEnum.face_vector_computed,
+    ),
+    ImageStatusEnum.failed: (
+        ImageStatusEnum.processing,
+    ),
+}  # type: Dict[ImageStatusEnum, Tuple[ImageStatusEnum, ...]]
+
+
+def _transition_img_statuses(session: Session,
+                             img_ids: List[str],
+                             status: ImageStatusEnum,
+                             error_msg: Optional[str] = None) -> int:
+
+    if not img_ids:
+        return 0
+
+    previous_statuses = [previous_status.name for previous_status
+                         in _PREVIOUS_STATUSES[status]]
+
+    updated = session.query(ImageStatus) \
+        .filter(ImageStatus.img_id.in_(img_ids)) \
+        .filter(ImageStatus.status.in_(previous_statuses)) \
+        .update({'status': status.name, 'error_msg': error_msg},
+                synchronize_session=False)
+
+    if updated != len(img_ids):
+        logger.warning("%d of images %s can't move to status %s",
+                       len(img_ids) - updated, img_ids, status.name)
+    return updated
+
+
+def _transition_img_status(session: Session,
+                           img_id: str,
+                           status: ImageStatusEnum,
+                           error_msg: Optional[str] = None) -> bool:
+
+    return _transition_img_statuses(
+        session, [img_id], status, error_msg) == 1
+
+
+@contextmanager
+def _failing_images(img_ids: List[str]) -> Iterator[None]:
+    """Move claimed images to the failed status if processing them raises,
+    instead of leaving them in processing where nobody picks them up."""
+
+    # pylint: disable=broad-except
+    try:
+        yield
+    except Exception as error:
+        error_msg = 'Processing failed: {}'.format(type(error).__name__)
+        with get_db_session(commit=True) as session:
+            _transition_img_statuses(session, img_ids, ImageStatusEnum.failed,
+                                     error_msg=error_msg[:50])
+        invalidate_images(img_ids)
+        raise
+    # pylint: enable=broad-except
+
+
+def _find_batch_matches(img_ids: List[str],
+                        face_vectors: List[List[FaceVector]],
+                        gallery: Gallery) -> List[List[Tuple[str, float]]]:
+    """Match the faces of many images against the gallery in one pass.
+
+    Returns, for every image, the matching gallery images together with the
+    closest distance between any of their faces.
+    """
+    matches = [[] for _ in img_ids]  # type: List[List[Tuple[str, float]]]
+
+    with_faces = [i for i, vectors in enumerate(face_vectors) if vectors]
+    if not with_faces or not gallery:
+        return matches
+
+    faces = np.asarray([face_vector for i in with_faces
+                        for face_vector in face_vectors[i]],
+                       dtype=np.float32)
+    group_starts = np.cumsum([0] + [len(face_vectors[i])
+                                    for i in with_faces[:-1]])
+
+    groups, rows, distances = gallery.search(
+        faces, DISTANCE_SCORE_THRESHOLD, group_starts)
+
+    this_img_ids = np.asarray([img_ids[i] for i in with_faces],
+                              dtype=object)[groups]
+    for group, that_img_id, distance in _closest_matches(
+            groups, this_img_ids, gallery.img_ids[rows], distances):
+        matches[with_faces[group]].append((that_img_id, distance))
+
+    return matches
+
+
+def _closest_matches(groups: np.ndarray,
+                     this_img_ids: np.ndarray,
+                     that_img_ids: np.ndarray,
+                     distances: np.ndarray) \
+        -> List[Tuple[int, str, float]]:
+    """Closest distance of every pair of different images among the matching
+    faces, together with the group of the face that was searched for."""
+
+    is_other_img = this_img_ids != that_img_ids
+    if not is_other_img.any():
+        return []
+
+    groups = groups[is_other_img]
+    distances = distances[is_other_img]
+    that_img_ids, that_img_codes = np.unique(that_img_ids[is_other_img],
+                                             return_inverse=True)
+
+    pairs, pair_codes = np.unique(groups * len(that_img_ids) + that_img_codes,
+                                  return_inverse=True)
+    pair_distances = np.full(len(pairs), np.inf, dtype=np.float32)
+    np.minimum.at(  # pylint: disable=no-member
+        pair_distances, pair_codes, distances)
+
+    closest = []  # type: List[Tuple[int, str, float]]
+    for pair, distance in zip(pairs.tolist(), pair_distances.tolist()):
+        group, that_img_code = divmod(pair, len(that_img_ids))
+        closest.append((group, that_img_ids[that_img_code], distance))
+    return closest
+
+
+def _find_matches(img_id: str,
+                  face_vectors: List[FaceVector],
+                  gallery: Gallery) -> List[Tuple[str, float]]:
+
+    return _find_batch_matches([img_id], [face_vectors], gallery)[0]
+
+
+def _find_matches_within_batch(img_ids: List[str],
+                               face_vectors: List[List[FaceVector]]) \
+        -> List[List[Tuple[str, float]]]:
+    """Match the images of a batch against the images before them."""
+
+    batch_gallery = Gallery()
+    for img_id, vectors in zip(img_ids, face_vectors):
+        batch_gallery.add(range(len(vectors)), [img_id] * len(vectors),
+                          vectors)
+
+    positions = {img_id: i for i, img_id in enumerate(img_ids)}
+    matches = _find_batch_matches(img_ids, face_vectors, batch_gallery)
+
+    return [[(that_img_id, distance) for that_img_id, distance in matches[i]
+             if positions[that_img_id] < i]
+            for i in range(len(img_ids))]
+
+
+def _get_object_names(session: Session,
+                      img_ids: List[str]) -> Dict[str, Optional[str]]:
+
+    return dict(session.query(ImageStatus.img_id, ImageStatus.object_name)
+                .filter(ImageStatus.img_id.in_(img_ids)))
+
+
+def _get_local_image_path(img_id: str, object_name: Optional[str]) -> str:
+    image_cache = get_image_cache()
+    if image_cache is None:
+        return get_image_path(img_id, object_name)
+    return image_cache.get_path(img_id, object_name)
+
+
+def _record_finished_images(session: Session,
+                            img_ids: List[str]) -> Dict[str, Optional[str]]:
+    """Index the processed images for near duplicate detection and record
+    them for the deleter to remove from storage."""
+
+    if NEAR_DUPLICATE_DETECTION:
+        index_images(session, img_ids)
+
+    object_names = _get_object_names(session, img_ids)
+    session.execute(PendingDeletion.__table__.insert(),
+                    [{'img_id': img_id,
+                      'object_name': object_names.get(img_id)}
+                     for img_id in img_ids])
+    return object_names
+
+
+def _discard_local_copies(object_names: Dict[str, Optional[str]]):
+    image_cache = get_image_cache()
+    if image_cache is None:
+        return
+
+    for img_id, object_name in object_names.items():
+        image_cache.discard(img_id, object_name)
+
+
+def _find_originals(session: Session, img_ids: List[str]) -> Dict[str, str]:
+    """Processed images with the same content as some of the images."""
+
+    if UPLOAD_DEDUPLICATION != 'reuse':
+        return {}
+
+    content_hashes = dict(session
+                          .query(ImageStatus.img_id, ImageStatus.content_hash)
+                          .filter(ImageStatus.img_id.in_(img_ids))
+                          .filter(ImageStatus.content_hash.isnot(None)))
+    if not content_hashes:
+        return {}
+
+    # the earliest processed image of each content wins
+    originals = dict(session
+                     .query(ImageStatus.content_hash, ImageStatus.img_id)
+                     .filter(ImageStatus.content_hash
+                             .in_(set(content_hashes.values())))
+                     .filter(ImageStatus.status ==
+                             ImageStatusEnum.finished_processing.name)
+                     .order_by(ImageStatus.id.desc()))
+
+    return {img_id: originals[content_hash]
+            for img_id, content_hash in content_hashes.items()
+            if content_hash in originals}
+
+
+def _load_face_vectors(session: Session,
+                       img_ids: List[str]) -> Dict[str, List[FaceVector]]:
+
+    face_vectors = {}  # type: Dict[str, List[FaceVector]]
+
+    rows = session.query(FeatureMapping.img_id, FeatureMapping.features) \
+        .filter(FeatureMapping.img_id.in_(img_ids)) \
+        .order_by(FeatureMapping.id)
+
+    for img_id, features in rows:
+        face_vectors.setdefault(img_id, []).append(
+            face_vector_from_bytes(features).tolist())
+    return {img_id: face_vectors.get(img_id, []) for img_id in img_ids}
+
+
+def _copy_matches(session: Session,
+                  img_id: str,
+                  original_img_id: str,
+                  has_faces: bool) -> List[Tuple[str, str, float]]:
+
+    matches = session.query(Match.that_img_id, Match.distance_score) \
+        .filter(Match.this_img_id == original_img_id) \
+        .all()
+    if MATCH_STORAGE_MODE == 'canonical':
+        matches += session.query(Match.this_img_id, Match.distance_score) \
+            .filter(Match.that_img_id == original_img_id) \
             .all()
 
-    known_features = []
-    img_ids = []
-    for row in rows:
-        img_ids.append(row.img_id)
-        current_features = np.array(face_vector_from_text(row.features))
-        known_features.append(current_features)
-    return img_ids, np.array(known_features)
-
-
-def _prepare_matches(matches: List[dict],
-                     that_img_id: str,
-                     distance_score: float):
-
-    match_exists = False
-    for match in matches:
-        if match["that_img_id"] == that_img_id:
-            match_exists = True
-            match["distance_score"] = min(match["distance_score"],
-                                          distance_score)
-
-    if not match_exists:
-        matches.append({
-            "that_img_id": that_img_id,
-            "distance_score": distance_score
-        })
-
-
-def _update_img_status(img_id: str,
-                       status: Optional[ImageStatusEnum] = None,
-                       error_msg: Optional[str] = None):
-    update_fields = {}
-    if status:
-        update_fields['status'] = status.name
-    if error_msg:
-        update_fields['error_msg'] = error_msg
+    # the faces of the duplicate are the very faces of the original
+    if has_faces:
+        matches.append((original_img_id, 0.0))
 
-    with get_db_session(commit=True) as session:
-        session.query(ImageStatus)\
-            .filter(ImageStatus.img_id == img_id)\
-            .update(update_fields)
+    return _with_img_id(img_id, [(that_img_id, distance_score)
+                                 for that_img_id, distance_score in matches
+                                 if that_img_id != img_id])
+
+
+def _find_near_duplicate(session: Session,
+                         img_id: str,
+                         img_path: str) -> Optional[str]:
+    """Processed image that looks like the image, resized or recompressed."""
 
+    if not NEAR_DUPLICATE_DETECTION:
+        return None
 
-# pylint: disable=len-as-condition
-def _compute_distances(face_encodings: np.array,
-                       face_to_compare: FaceVector) -> np.array:
+    perceptual_hash = compute_perceptual_hash(img_path)
+    if perceptual_hash is None:
+        return None
 
-    if len(face_encodings) == 0:
-        return np.empty(0)
+    session.query(ImageStatus) \
+        .filter(ImageStatus.img_id == img_id) \
+        .update({'perceptual_hash': format_perceptual_hash(perceptual_hash)},
+                synchronize_session=False)
 
-    face_to_compare = np.array(face_to_compare)
-    return np.linalg.norm(face_encodings - face_to_compare, axis=1)
-# pylint: enable=len-as-condition
+    return find_similar_image(session, perceptual_hash, NEAR_DUPLICATE_RADIUS)
+
+
+def _vectorize(session: Session,
+               img_paths: List[str]) -> List[List[FaceVector]]:
+
+    with ExitStack() as stack:
+        with timed_stage(session, NORMALIZE_STAGE, len(img_paths)):
+            img_paths = stack.enter_context(normalized_images(img_paths))
+
+        with timed_stage(session, VECTORIZE_STAGE, len(img_paths)):
+            return get_face_vectors_batch(img_paths, FACE_VECTORIZE_ALGORITHM)
+
+
+def _compute_face_vectors(session: Session,
+                          img_id: str,
+                          img_path: str,
+                          original_img_id: Optional[str] = None) \
+        -> List[FaceVector]:
+
+    if original_img_id is not None:
+        face_vectors = _load_face_vectors(
+            session, [original_img_id])[original_img_id]
+        logger.info('Reusing %d faces of image %s for its duplicate %s',
+                    len(face_vectors), original_img_id, img_id)
+        return face_vectors
+
+    similar_img_id = _find_near_duplicate(session, img_id, img_path)
+    if similar_img_id is not None:
+        face_vectors = _load_face_vectors(
+            session, [similar_img_id])[similar_img_id]
+        logger.info('Reusing %d faces of image %s for its near duplicate %s',
+                    len(face_vectors), similar_img_id, img_id)
+        return face_vectors
+
+    face_vectors = _vectorize(session, [img_path])[0]
+    logger.info('Found %d faces in image %s', len(face_vectors), img_id)
 
+    return face_vectors
 
-def process_image(img_id: str):
+
+def _finish_processing(session: Session, img_id: str, has_faces: bool) -> bool:
+    is_finished = _transition_img_status(
+        session, img_id, ImageStatusEnum.finished_processing,
+        error_msg='No faces found in image' if not has_faces else None)
+
+    if not is_finished:
+        session.rollback()
+    return is_finished
+
+
+def process_image(img_id: str, wait: Optional[QueueWait] = None):
     logger.info('Processing image %s', img_id)
-    try:
-        img_path = get_image_path(img_id)
-    except StorageError:
-        logger.error("Can't process image %s since it doesn't exist", img_id)
-        _update_img_status(img_id, error_msg='Image processed before uploaded')
+    start = datetime.utcnow()
+
+    gallery = get_gallery()
+    face_vectors = []  # type: List[FaceVector]
+    feature_mapping_ids = []  # type: List[int]
+    matches = []  # type: List[Tuple[str, str, float]]
+    object_names = {}  # type: Dict[str, Optional[str]]
+    is_finished = False
+
+    with get_db_session(commit=True) as session:
+        img_path = _claim_images([img_id], session, wait).get(img_id)
+    if img_path is None:
         return
 
+    with _failing_images([img_id]), \
+            get_db_session(commit=True, reraise=True) as session:
+        original_img_id = _find_originals(session, [img_id]).get(img_id)
+        face_vectors = _compute_face_vectors(session, img_id, img_path,
+                                             original_img_id)
+
+        gallery.refresh()
+
+        _add_entry_to_session(Image, session, img_id=img_id)
+        feature_mappings = [_store_face_vector(face_vector, img_id, session)
+                            for face_vector in face_vectors]
+
+        if original_img_id is None:
+            matches = _with_img_id(
+                img_id, _find_matches(img_id, face_vectors, gallery))
+        else:
+            matches = _copy_matches(session, img_id, original_img_id,
+                                    bool(face_vectors))
+        logger.info('Found %d face matches for image %s', len(matches), img_id)
+        _store_matches(matches, session)
+
+        session.flush()
+        feature_mapping_ids = [mapping.id for mapping in feature_mappings]
+
+        is_finished = _finish_processing(session, img_id, bool(face_vectors))
+        if is_finished:
+            object_names = _record_finished_images(session, [img_id])
+
+    if not is_finished:
+        return
+
+    _invalidate_processed_images([img_id], matches)
+
+    if feature_mapping_ids:
+        gallery.add(feature_mapping_ids, [img_id] * len(face_vectors),
+                    face_vectors)
+
+    _discard_local_copies(object_names)
+
+    processing_time = (datetime.utcnow() - start).total_seconds()
+    logger.info('Processed image %s in %d seconds', img_id, processing_time)
+
+
+def _claim_images(img_ids: List[str], session: Session,
+                  wait: Optional[QueueWait]) -> Dict[str, str]:
+    # the wait is kept whether or not the images can still be claimed
+    if wait is not None:
+        record_queue_wait(session, wait)
+
+    object_names = _get_object_names(session, img_ids)
+
+    img_paths = {}  # type: Dict[str, str]
+    for img_id in img_ids:
+        try:
+            img_paths[img_id] = _get_local_image_path(
+                img_id, object_names.get(img_id))
+        except StorageError:
+            logger.error("Can't process image %s since it doesn't exist",
+                         img_id)
+            session.query(ImageStatus) \
+                .filter(ImageStatus.img_id == img_id) \
+                .update({'error_msg': 'Image processed before uploaded'},
+                        synchronize_session=False)
+
+    if not img_paths:
+        session.commit()
+        return {}
+
+    # lock the rows so that we know which of the images we moved on
+    claimable_img_ids = [img_id for img_id, in session
+                         .query(ImageStatus.img_id)
+                         .filter(ImageStatus.img_id.in_(list(img_paths)))
+                         .filter(ImageStatus.status ==
+                                 ImageStatusEnum.uploaded.name)
+                         .with_for_update()]
+
+    _transition_img_statuses(session, claimable_img_ids,
+                             ImageStatusEnum.processing)
+    session.commit()
+    invalidate_images(claimable_img_ids)
+
+    return {img_id: img_paths[img_id] for img_id in claimable_img_ids}
+
+
+def _compute_batch_face_vectors(session: Session,
+                                img_ids: List[str],
+                                img_paths: Dict[str, str],
+                                originals: Dict[str, str]) \
+        -> List[List[FaceVector]]:
+
+    reused = dict(originals)
+    for img_id in img_ids:
+        if img_id in originals:
+            continue
+        similar_img_id = _find_near_duplicate(session, img_id,
+                                              img_paths[img_id])
+        if similar_img_id is not None:
+            reused[img_id] = similar_img_id
+
+    new_img_ids = [img_id for img_id in img_ids if img_id not in reused]
+    face_vectors = _load_face_vectors(session, list(set(reused.values())))
+    if new_img_ids:
+        face_vectors.update(zip(new_img_ids, _vectorize(
+            session, [img_paths[img_id] for img_id in new_img_ids])))
+
+    logger.debug('Reusing the faces of %d duplicates and %d near duplicates '
+                 'in batch', len(originals), len(reused) - len(originals))
+    return [face_vectors[reused.get(img_id, img_id)] for img_id in img_ids]
+
+
+def _finish_processing_batch(session: Session,
+                             img_ids: List[str],
+                             has_faces: List[bool]) -> bool:
+
+    with_faces = [img_id for img_id, has_face in zip(img_ids, has_faces)
+                  if has_face]
+    without_faces = [img_id for img_id, has_face in zip(img_ids, has_faces)
+                     if not has_face]
+
+    finished = _transition_img_statuses(
+        session, with_faces, ImageStatusEnum.finished_processing)
+    finished += _transition_img_statuses(
+        session, without_faces, ImageStatusEnum.finished_processing,
+        error_msg='No faces found in image')
+
+    is_finished = finished == len(img_ids)
+    if not is_finished:
+        session.rollback()
+    return is_finished
+
+
+def _match_batch(session: Session,
+                 img_ids: List[str],
+                 face_vectors: List[List[FaceVector]],
+                 originals: Dict[str, str],
+                 gallery: Gallery) -> List[Tuple[str, str, float]]:
+
+    # duplicates copy the gallery matches of their original instead
+    gallery.refresh()
+    gallery_matches = _find_batch_matches(
+        img_ids,
+        [[] if img_id in originals else vectors
+         for img_id, vectors in zip(img_ids, face_vectors)],
+        gallery)
+    batch_matches = _find_matches_within_batch(img_ids, face_vectors)
+
+    matches = []  # type: List[Tuple[str, str, float]]
+    for i, img_id in enumerate(img_ids):
+        matches.extend(_with_img_id(img_id, gallery_matches[i]))
+        if img_id in originals:
+            matches.extend(_copy_matches(session, img_id, originals[img_id],
+                                         bool(face_vectors[i])))
+        matches.extend(_with_img_id(img_id, batch_matches[i]))
+    return matches
+
+
+def _store_batch_face_vectors(session: Session,
+                              img_ids: List[str],
+                              face_vectors: List[List[FaceVector]]) \
+        -> List[Tuple[int, str, FaceVector]]:
+
+    mappings = []  # type: List[Tuple[FeatureMapping, str, FaceVector]]
+    for img_id, vectors in zip(img_ids, face_vectors):
+        _add_entry_to_session(Image, session, img_id=img_id)
+        mappings.extend((_store_face_vector(face_vector, img_id, session),
+                         img_id, face_vector)
+                        for face_vector in vectors)
+
+    session.flush()
+    return [(mapping.id, img_id, face_vector)
+            for mapping, img_id, face_vector in mappings]
+
+
+def process_images(img_ids: List[str],
+                   wait: Optional[QueueWait] = None):
+    """Process a batch of images with a single vectorizer invocation.
+
+    The faces of all the images are matched against the gallery in one
+    pass, the images of the batch are matched against each other and all
+    the results are written in a single transaction.
+    """
+    logger.info('Processing batch of %d images', len(img_ids))
     start = datetime.utcnow()
-    _update_img_status(img_id, status=ImageStatusEnum.processing)
 
-    prev_img_ids, prev_face_vectors = _load_image_ids_and_face_vectors()
-    face_vectors = get_face_vectors(img_path, FACE_VECTORIZE_ALGORITHM)
-    logger.info('Found %d faces in image %s', len(face_vectors), img_id)
-    _update_img_status(img_id, status=ImageStatusEnum.face_vector_computed)
+    gallery = get_gallery()
+    feature_mappings = []  # type: List[Tuple[int, str, FaceVector]]
+    matches = []  # type: List[Tuple[str, str, float]]
+    object_names = {}  # type: Dict[str, Optional[str]]
+    is_finished = False
+
+    with get_db_session(commit=True) as session:
+        img_paths = _claim_images(img_ids, session, wait)
+    if not img_paths:
+        return
+
+    img_ids = list(img_paths)
+    with _failing_images(img_ids), \
+            get_db_session(commit=True, reraise=True) as session:
+        originals = _find_originals(session, img_ids)
+        face_vectors = _compute_batch_face_vectors(
+            session, img_ids, img_paths, originals)
+
+        matches = _match_batch(session, img_ids, face_vectors, originals,
+                               gallery)
+        logger.info('Found %d face matches for %d images',
+                    len(matches), len(img_ids))
+
+        feature_mappings = _store_batch_face_vectors(session, img_ids,
+                                                     face_vectors)
+        _store_matches(matches, session)
+
+        is_finished = _finish_processing_batch(
+            session, img_ids, [bool(vectors) for vectors in face_vectors])
+        if is_finished:
+            object_names = _record_finished_images(session, img_ids)
+
+    if not is_finished:
+        return
+
+    _invalidate_processed_images(img_ids, matches)
+
+    if feature_mappings:
+        row_ids, row_img_ids, row_vectors = zip(*feature_mappings)
+        gallery.add(row_ids, list(row_img_ids), row_vectors)
 
+    _discard_local_copies(object_names)
+
+    logger.info('Processed batch of %d images in %d seconds', len(img_ids),
+                (datetime.utcnow() - start).total_seconds())
+
+
+def store_face_vectors(img_id: str, wait: Optional[QueueWait] = None) \
+        -> Optional[List[FaceVector]]:
+    """First step of sharded processing: vectorize and store the faces.
+
+    The stored face vectors are picked up by the galleries of the match
+    shards which are then searched by find_shard_matches.
+    """
+    logger.info('Vectorizing image %s', img_id)
+
+    face_vectors = []  # type: List[FaceVector]
+    object_names = {}  # type: Dict[str, Optional[str]]
     with get_db_session(commit=True) as session:
+        img_path = _claim_images([img_id], session, wait).get(img_id)
+    if img_path is None:
+        return None
+
+    with _failing_images([img_id]), \
+            get_db_session(commit=True, reraise=True) as session:
+        original_img_id = _find_originals(session, [img_id]).get(img_id)
+        face_vectors = _compute_face_vectors(session, img_id, img_path,
+                                             original_img_id)
+
         _add_entry_to_session(Image, session, img_id=img_id)
-        matches = []  # type: List[dict]
         for face_vector in face_vectors:
             _store_face_vector(face_vector, img_id, session)
 
-            distances = _compute_distances(prev_face_vectors, face_vector)
-            for that_img_id, distance in zip(prev_img_ids, distances):
-                if img_id == that_img_id:
-                    continue
-                distance = float(distance)
-                if distance >= DISTANCE_SCORE_THRESHOLD:
-                    continue
-                _prepare_matches(matches, that_img_id, distance)
+        if not _transition_img_status(session, img_id,
+                                      ImageStatusEnum.face_vector_computed):
+            session.rollback()
+            return None
+        object_names = _get_object_names(session, [img_id])
 
-        logger.info('Found %d face matches for image %s', len(matches), img_id)
-        for match in matches:
-            _store_matches(img_id, match["that_img_id"],
-                           match["distance_score"], session)
+    invalidate_images([img_id])
+    # the matches are merged on the matchworkers, which don't need the image
+    _discard_local_copies(object_names)
+    return face_vectors
 
-    _update_img_status(img_id,
-                       status=ImageStatusEnum.finished_processing,
-                       error_msg=('No faces found in image'
-                                  if not face_vectors else None))
-    delete_image(img_id)
 
-    processing_time = (datetime.utcnow() - start).total_seconds()
-    logger.info('Processed image %s in %d seconds', img_id, processing_time)
+def store_batch_face_vectors(img_ids: List[str],
+                             wait: Optional[QueueWait] = None) \
+        -> Tuple[List[str], List[List[FaceVector]]]:
+    """Vectorize and store the faces of a batch of images at once.
+
+    Same as store_face_vectors for a batch with a single vectorizer
+    invocation. Returns the images that were claimed together with their
+    face vectors.
+    """
+    logger.info('Vectorizing batch of %d images', len(img_ids))
+
+    face_vectors = []  # type: List[List[FaceVector]]
+    object_names = {}  # type: Dict[str, Optional[str]]
+    with get_db_session(commit=True) as session:
+        img_paths = _claim_images(img_ids, session, wait)
+    if not img_paths:
+        return [], []
+
+    img_ids = list(img_paths)
+    with _failing_images(img_ids), \
+            get_db_session(commit=True, reraise=True) as session:
+        originals = _find_originals(session, img_ids)
+        face_vectors = _compute_batch_face_vectors(
+            session, img_ids, img_paths, originals)
+        _store_batch_face_vectors(session, img_ids, face_vectors)
+
+        updated = _transition_img_statuses(
+            session, img_ids, ImageStatusEnum.face_vector_computed)
+        if updated != len(img_ids):
+            session.rollback()
+            return [], []
+        object_names = _get_object_names(session, img_ids)
+
+    invalidate_images(img_ids)
+    _discard_local_copies(object_names)
+    return img_ids, face_vectors
+
+
+def find_shard_matches(shard: int,
+                       img_id: str,
+                       face_vectors: List[FaceVector]) \
+        -> List[Tuple[str, float]]:
+
+    return find_shard_batch_matches(shard, [img_id], [face_vectors])[0]
+
+
+def find_shard_batch_matches(shard: int,
+                             img_ids: List[str],
+                             face_vectors: List[List[FaceVector]]) \
+        -> List[List[Tuple[str, float]]]:
+
+    gallery = get_gallery(shard)
+    gallery.refresh()
+
+    matches = _find_batch_matches(img_ids, face_vectors, gallery)
+    logger.debug('Found %d face matches for %d images in shard %d',
+                 sum(len(image_matches) for image_matches in matches),
+                 len(img_ids), shard)
+    return matches
+
+
+def store_matches(img_id: str,
+                  has_faces: bool,
+                  matches: List[Tuple[str, float]]):
+
+    logger.info('Found %d face matches for image %s', len(matches), img_id)
+
+    is_finished = False
+    with get_db_session(commit=True) as session:
+        _store_matches(_with_img_id(img_id, matches), session)
+        is_finished = _finish_processing(session, img_id, has_faces)
+        if is_finished:
+            _record_finished_images(session, [img_id])
+
+    if is_finished:
+        _invalidate_processed_images([img_id], _with_img_id(img_id, matches))
+
+
+def store_batch_matches(img_ids: List[str],
+                        has_faces: List[bool],
+                        matches: List[List[Tuple[str, float]]]):
+
+    batch_matches = [match
+                     for img_id, image_matches in zip(img_ids, matches)
+                     for match in _with_img_id(img_id, image_matches)]
+    logger.info('Found %d face matches for %d images',
+                len(batch_matches), len(img_ids))
+
+    is_finished = False
+    with get_db_session(commit=True) as session:
+        _store_matches(batch_matches, session)
+        is_finished = _finish_processing_batch(session, img_ids, has_faces)
+        if is_finished:
+            _record_finished_images(session, img_ids)
+
+    if is_finished:
+        _invalidate_processed_images(img_ids, batch_matches)
+
+
+def search_faces(face_vectors: List[FaceVector],
+                 limit: Optional[int] = None) -> List[Tuple[str, float]]:
+    """Closest gallery images to a probe that is not stored anywhere."""
+
+    gallery = get_gallery()
+    gallery.refresh()
+
+    # the probe isn't in the gallery so there's no own image to exclude
+    matches = _find_matches('', face_vectors, gallery)
+    matches.sort(key=lambda match: (match[1], match[0]))
+    return matches[:limit]
+
+
+def prefetch_images(img_ids: List[str]):
+    """Start downloading the images of reserved tasks in the background."""
+
+    image_cache = get_image_cache()
+    if image_cache is not None:
+        image_cache.prefetch(img_ids)
@@ -1,17 +1,44 @@
+from base64 import b64encode
+from typing import Dict  # noqa: F401
 from typing import List
+from typing import Optional
+from typing import Union
+from urllib.error import URLError
+from urllib.request import Request
+from urllib.request import urlopen
 import json
 import os
+import struct
 
 from docker import DockerClient
+from docker.errors import DockerException
+import numpy as np
 
 from faceanalysis.log import get_logger
 from faceanalysis.settings import DOCKER_DAEMON
+from faceanalysis.settings import FACE_VECTORIZE_PREALIGNED
+from faceanalysis.settings import FACE_VECTORIZE_SERVICE_TIMEOUT
+from faceanalysis.settings import FACE_VECTORIZE_SERVICE_URL
 from faceanalysis.settings import HOST_DATA_DIR
 from faceanalysis.settings import MOUNTED_DATA_DIR
+from faceanalysis.vector_cache import get_vector_cache
+from faceanalysis.vector_cache import hash_file
 
 FaceVector = List[float]
 logger = get_logger(__name__)
 
+# binary face vectors are stored as a fixed size header (magic, format
+# version, dtype code, number of dimensions) followed by the raw vector
+_FACE_VECTOR_HEADER = struct.Struct('<2sBBI')
+_FACE_VECTOR_MAGIC = b'FV'
+_FACE_VECTOR_VERSION = 1
+_FACE_VECTOR_DTYPE_CODE = 1
+_FACE_VECTOR_DTYPES = {_FACE_VECTOR_DTYPE_CODE: np.dtype('<f4')}
+
+
+class VectorizerError(Exception):
+    pass
+
 
 def _format_mount_path(img_path: str) -> str:
     return '/{}'.format(os.path.basename(img_path))
@@ -30,23 +57,194 @@ def _format_host_path(img_path: str) -> str:
     return img_path
 
 
-def get_face_vectors(img_path: str, algorithm: str) -> List[FaceVector]:
-    img_mount = _format_mount_path(img_path)
-    img_host = _format_host_path(img_path)
-    volumes = {img_host: {'bind': img_mount, 'mode': 'ro'}}
+def _run_container(img_paths: List[str],
+                   algorithm: str) -> Optional[List[List[FaceVector]]]:
+    img_mounts = [_format_mount_path(img_path) for img_path in img_paths]
+    volumes = {_format_host_path(img_path): {'bind': img_mount, 'mode': 'ro'}
+               for img_path, img_mount in zip(img_paths, img_mounts)}
 
-    logger.debug('Running container %s with image %s', algorithm, img_host)
+    logger.debug('Running container %s with %d images',
+                 algorithm, len(img_paths))
     client = DockerClient(base_url=DOCKER_DAEMON)
-    stdout = client.containers.run(algorithm, img_mount,
-                                   volumes=volumes, auto_remove=True)
+    environment = ['PREALIGNED=true'] if FACE_VECTORIZE_PREALIGNED else []
+    stdout = client.containers.run(algorithm, img_mounts,
+                                   volumes=volumes, environment=environment,
+                                   auto_remove=True)
+
+    return json.loads(stdout.decode('ascii')).get('faceVectors')
+
+
+def _request_face_vectors(url: str,
+                          img_paths: List[str],
+                          timeout: float) \
+        -> Optional[List[List[FaceVector]]]:
+
+    images = []
+    for img_path in img_paths:
+        with open(img_path, 'rb') as fobj:
+            images.append(b64encode(fobj.read()).decode('ascii'))
+
+    body = {'images': images, 'prealigned': FACE_VECTORIZE_PREALIGNED}
+    request = Request(url,
+                      data=json.dumps(body).encode('utf-8'),
+                      headers={'Content-Type': 'application/json'})
+
+    logger.debug('Requesting face vectors for %d images from %s',
+                 len(img_paths), url)
+    with urlopen(request, timeout=timeout) as response:
+        face_vectors = json.loads(response.read().decode('utf-8'))
+
+    return face_vectors.get('faceVectors')
+
+
+def _compute_face_vectors_batch(img_paths: List[str],
+                                algorithm: str,
+                                timeout: Optional[float] = None) \
+        -> Optional[List[List[FaceVector]]]:
+
+    if timeout is not None:
+        # there's no time to start a container when the caller is waiting
+        if not FACE_VECTORIZE_SERVICE_URL:
+            raise VectorizerError('No vectorizer service configured')
+        try:
+            return _request_face_vectors(FACE_VECTORIZE_SERVICE_URL,
+                                         img_paths, timeout)
+        except (URLError, OSError, ValueError) as ex:
+            raise VectorizerError('Vectorizer service unavailable') from ex
+
+    if FACE_VECTORIZE_SERVICE_URL:
+        try:
+            return _request_face_vectors(FACE_VECTORIZE_SERVICE_URL,
+                                         img_paths,
+                                         FACE_VECTORIZE_SERVICE_TIMEOUT)
+        except (URLError, OSError, ValueError):
+            logger.exception('Vectorizer service unavailable, falling back '
+                             'to running container %s', algorithm)
+
+    return _run_container(img_paths, algorithm)
+
+
+def _get_algorithm_image_id(algorithm: str) -> Optional[str]:
+    # the tag of an algorithm moves to every new build of its image
+    try:
+        return DockerClient(base_url=DOCKER_DAEMON).images.get(algorithm).id
+    except (DockerException, OSError):
+        logger.warning("Can't resolve the image of algorithm %s, its face "
+                       "vectors are not cached", algorithm)
+        return None
+
+
+def get_face_vectors_batch(img_paths: List[str],
+                           algorithm: str,
+                           timeout: Optional[float] = None) \
+        -> List[List[FaceVector]]:
+    """Vectorize the images, reusing the vectors cached for their content.
+
+    The vectors are cached for the image the algorithm's tag resolves to,
+    so they're computed again after the algorithm is rebuilt. Only vectors
+    the algorithm actually returned are cached, images it failed on are
+    vectorized again the next time. With a timeout, only the
+    vectorizer service is asked and VectorizerError is raised when it can't
+    answer in time.
+    """
+    vector_cache = get_vector_cache()
+    image_id = None  # type: Optional[str]
+    if vector_cache is not None:
+        image_id = _get_algorithm_image_id(algorithm)
+    content_hashes = [hash_file(img_path) if image_id else None
+                      for img_path in img_paths]
+
+    cached = {}  # type: Dict[str, bytes]
+    if vector_cache is not None and image_id is not None:
+        cached = vector_cache.get_many(
+            [content_hash for content_hash in content_hashes
+             if content_hash is not None],
+            image_id, FACE_VECTORIZE_PREALIGNED)
+
+    missing = [i for i, content_hash in enumerate(content_hashes)
+               if content_hash not in cached]
+    computed = None  # type: Optional[List[List[FaceVector]]]
+    if missing:
+        computed = _compute_face_vectors_batch(
+            [img_paths[i] for i in missing], algorithm, timeout)
+    logger.debug('Reusing cached face vectors for %d of %d images',
+                 len(img_paths) - len(missing), len(img_paths))
+
+    face_vectors = [face_vectors_from_bytes(cached[content_hash])
+                    if content_hash in cached else []
+                    for content_hash in content_hashes]
+    if computed is None:
+        return face_vectors
+
+    computed_by_hash = {}  # type: Dict[str, bytes]
+    for i, vectors in zip(missing, computed):
+        face_vectors[i] = vectors
+        content_hash = content_hashes[i]
+        if content_hash is not None:
+            computed_by_hash[content_hash] = face_vectors_to_bytes(vectors)
+
+    if vector_cache is not None and image_id is not None:
+        vector_cache.put_many(computed_by_hash, image_id,
+                              FACE_VECTORIZE_PREALIGNED)
+
+    return face_vectors
+
+
+def get_face_vectors(img_path: str, algorithm: str,
+                     timeout: Optional[float] = None) -> List[FaceVector]:
+    return get_face_vectors_batch([img_path], algorithm, timeout)[0]
+
+
+def face_vector_from_text(text: Union[str, bytes, bytearray]) -> FaceVector:
+    return json.loads(text)
 
-    face_vectors = json.loads(stdout.decode('ascii')).get('faceVectors')
-    return face_vectors[0] if face_vectors else []
 
+def face_vector_to_bytes(vector: FaceVector) -> bytes:
+    array = np.asarray(vector,
+                       dtype=_FACE_VECTOR_DTYPES[_FACE_VECTOR_DTYPE_CODE])
+    header = _FACE_VECTOR_HEADER.pack(_FACE_VECTOR_MAGIC,
+                                      _FACE_VECTOR_VERSION,
+                                      _FACE_VECTOR_DTYPE_CODE,
+                                      len(array))
+    return header + array.tobytes()
 
-def face_vector_to_text(vector: FaceVector) -> str:
-    return json.dumps(vector)
 
+def is_binary_face_vector(data: Union[str, bytes, bytearray]) -> bool:
+    return isinstance(data, (bytes, bytearray)) \
+        and data.startswith(_FACE_VECTOR_MAGIC)
 
-def face_vector_from_text(text: str) -> FaceVector:
-    return json.loads(text)
+
+def face_vector_from_bytes(data: Union[str, bytes, bytearray]) -> np.ndarray:
+    # rows that have not been migrated yet still hold json text
+    if isinstance(data, str) or not is_binary_face_vector(data):
+        return np.asarray(face_vector_from_text(data), dtype=np.float32)
+
+    _, version, dtype_code, dimensions = \
+        _FACE_VECTOR_HEADER.unpack_from(data)
+    if version != _FACE_VECTOR_VERSION \
+            or dtype_code not in _FACE_VECTOR_DTYPES:
+        raise ValueError('Unsupported face vector format {}/{}'
+                         .format(version, dtype_code))
+
+    return np.frombuffer(data,
+                         dtype=_FACE_VECTOR_DTYPES[dtype_code],
+                         count=dimensions,
+                         offset=_FACE_VECTOR_HEADER.size)
+
+
+def face_vectors_to_bytes(vectors: List[FaceVector]) -> bytes:
+    return b''.join(face_vector_to_bytes(vector) for vector in vectors)
+
+
+def face_vectors_from_bytes(data: bytes) -> List[FaceVector]:
+    vectors = []  # type: List[FaceVector]
+    offset = 0
+    while offset < len(data):
+        _, _, dtype_code, dimensions = \
+            _FACE_VECTOR_HEADER.unpack_from(data, offset)
+        size = (_FACE_VECTOR_HEADER.size
+                + dimensions * _FACE_VECTOR_DTYPES[dtype_code].itemsize)
+        vectors.append(face_vector_from_bytes(data[offset:offset + size])
+                       .tolist())
+        offset += size
+    return vectors
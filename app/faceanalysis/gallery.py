@@ -0,0 +1,554 @@
+from contextlib import contextmanager
+from functools import lru_cache
+from tempfile import TemporaryFile
+from time import monotonic
+from typing import Dict  # noqa: F401
+from typing import Iterable
+from typing import List
+from typing import Optional
+from typing import Sequence
+from typing import Set  # noqa: F401
+from typing import Tuple
+import fcntl
+import json
+import os
+
+import numpy as np
+from numpy.lib.format import open_memmap
+from sqlalchemy import case
+from sqlalchemy import func
+from sqlalchemy import or_
+
+from faceanalysis.face_vectorizer import FaceVector
+from faceanalysis.face_vectorizer import face_vector_from_bytes
+from faceanalysis.indexes import CompressedIndex
+from faceanalysis.indexes import ExactIndex
+from faceanalysis.indexes import Float16Encoder
+from faceanalysis.indexes import IVFIndex
+from faceanalysis.indexes import Int8Encoder
+from faceanalysis.indexes import ProductQuantizationEncoder
+from faceanalysis.log import get_logger
+from faceanalysis.models import FeatureMapping
+from faceanalysis.models import get_db_session
+from faceanalysis.settings import GALLERY_INDEX_PATH
+from faceanalysis.settings import GALLERY_INDEX_SAVE_INTERVAL
+from faceanalysis.settings import GALLERY_SHARED_DIR
+from faceanalysis.settings import MATCHER_BACKEND
+from faceanalysis.settings import MATCHER_IVF_LISTS
+from faceanalysis.settings import MATCHER_IVF_PROBES
+from faceanalysis.settings import MATCHER_PQ_SUBVECTORS
+from faceanalysis.settings import MATCHER_RERANK_MARGIN
+from faceanalysis.settings import MATCH_SHARDS
+
+# for how long and how many rows below the high water mark to look out for
+_MISSING_ROW_TIMEOUT = 300
+_MAX_MISSING_ROWS = 10000
+
+logger = get_logger(__name__)
+
+
+class _RowTracker:
+    """The FeatureMapping rows a gallery still has to load.
+
+    New rows are queried from the highest id seen so far (the high water
+    mark) together with the ids below it that were skipped because their
+    transaction hadn't committed yet. Rows added directly by this process
+    are skipped when they show up in a query. The rows of images whose
+    CRC32 hashes to another shard are queried without their features so
+    that their ids still close the gaps below the high water mark.
+    """
+
+    def __init__(self, shard: Optional[int] = None,
+                 num_shards: int = MATCH_SHARDS) -> None:
+        self.shard = shard
+        self.num_shards = num_shards
+        self.high_water_mark = 0
+        self.added_row_ids = set()  # type: Set[int]
+        self.missing_row_ids = {}  # type: Dict[int, float]
+
+    def is_new_row(self):
+        is_new_row = FeatureMapping.id > self.high_water_mark
+        if self.missing_row_ids:
+            is_new_row = or_(is_new_row,
+                             FeatureMapping.id.in_(list(self.missing_row_ids)))
+        return is_new_row
+
+    def features(self):
+        if self.shard is None:
+            return FeatureMapping.features
+
+        # CRC32 is a builtin of mysql and agrees with zlib.crc32
+        in_shard = func.crc32(FeatureMapping.img_id) % self.num_shards \
+            == self.shard
+        return case([(in_shard, FeatureMapping.features)])
+
+    def is_wanted(self, row_id: int, features: Optional[bytes]) -> bool:
+        return features is not None and row_id not in self.added_row_ids
+
+    def track(self, row_ids: List[int]):
+        # ids are allocated before commit, so rows below the high water mark
+        # may still show up later when a slower transaction commits
+        now = monotonic()
+
+        for row_id in row_ids:
+            self.missing_row_ids.pop(row_id, None)
+
+        new_row_ids = [row_id for row_id in row_ids
+                       if row_id > self.high_water_mark]
+        if new_row_ids:
+            # the ids are sorted and unique so the number of gaps is known
+            # before any of them are enumerated
+            num_gaps = new_row_ids[-1] - self.high_water_mark \
+                - len(new_row_ids)
+            if num_gaps <= _MAX_MISSING_ROWS:
+                gaps = np.setdiff1d(
+                    np.arange(self.high_water_mark + 1, new_row_ids[-1]),
+                    new_row_ids, assume_unique=True)
+                self.missing_row_ids.update(
+                    (row_id, now) for row_id in gaps.tolist())
+            self.high_water_mark = new_row_ids[-1]
+
+        self.missing_row_ids = {
+            row_id: first_missed
+            for row_id, first_missed in self.missing_row_ids.items()
+            if now - first_missed < _MISSING_ROW_TIMEOUT}
+
+        # added rows can only still show up when they're not yet queried
+        self.added_row_ids = {
+            row_id for row_id in self.added_row_ids
+            if row_id > self.high_water_mark
+            or row_id in self.missing_row_ids}
+
+
+class _Autosave:
+    """When a gallery was last saved to path and if it changed since."""
+
+    def __init__(self, path: Optional[str] = None,
+                 interval: float = 0) -> None:
+        self.path = path
+        self.interval = interval
+        self.saved_at = monotonic()
+        self.is_dirty = False
+
+    def is_due(self) -> bool:
+        return bool(self.path) and self.is_dirty \
+            and monotonic() - self.saved_at > self.interval
+
+    def mark_saved(self):
+        self.saved_at = monotonic()
+        self.is_dirty = False
+
+
+class Gallery:
+    """In-process copy of all the stored face vectors.
+
+    The vectors are kept in a single contiguous float32 matrix (grown with
+    amortized doubling) next to an array holding the img_id of each row and
+    an array holding the squared norm of each row.
+    The gallery is loaded once and then kept up to date incrementally: rows
+    stored by this process are added directly and rows stored by other
+    workers are picked up by refreshing from the highest FeatureMapping id
+    seen so far.
+
+    When a shard is given, the gallery only holds the vectors of the images
+    that hash to that shard.
+
+    Searches are delegated to an index (exact or approximate) and the
+    gallery together with its index can be persisted to disk so that
+    workers don't have to rebuild it when they start. Indexes that scan
+    their own compressed codes only re-rank a few candidate rows, so the
+    matrix is then backed by an unlinked temporary file and only the pages
+    of those rows need to be resident.
+    """
+
+    def __init__(self, index=None, path: Optional[str] = None,
+                 save_interval: float = 0,
+                 shard: Optional[int] = None) -> None:
+        self._index = index or ExactIndex()
+        self._rows = _RowTracker(shard)
+        self._autosave = _Autosave(path, save_interval)
+        self._img_ids = np.empty(0, dtype=object)
+        self._vectors = np.empty((0, 0), dtype=np.float32)
+        self._squared_norms = np.empty(0, dtype=np.float32)
+        self._size = 0
+
+    def __len__(self) -> int:
+        return self._size
+
+    @property
+    def img_ids(self) -> np.ndarray:
+        return self._img_ids[:self._size]
+
+    @property
+    def vectors(self) -> np.ndarray:
+        return self._vectors[:self._size]
+
+    @property
+    def squared_norms(self) -> np.ndarray:
+        return self._squared_norms[:self._size]
+
+    @property
+    def resident_nbytes(self) -> int:
+        """Bytes of the gallery and its index that are kept in memory."""
+
+        arrays = (self._vectors, self._img_ids, self._squared_norms)
+        return self._index.nbytes + sum(
+            array.nbytes for array in arrays
+            if not isinstance(array, np.memmap))
+
+    def refresh(self):
+        self._store_rows(self._query_new_rows())
+        self._index.add(self.vectors)
+        self._autosave_if_due()
+
+    def _autosave_if_due(self):
+        if self._autosave.is_due():
+            self.save(self._autosave.path)
+
+    def _query_new_rows(self) -> List[tuple]:
+        rows = []  # type: List[tuple]
+        with get_db_session() as session:
+            rows = session.query(FeatureMapping.id,
+                                 FeatureMapping.img_id,
+                                 self._rows.features()) \
+                .filter(self._rows.is_new_row()) \
+                .order_by(FeatureMapping.id) \
+                .all()
+
+        return rows
+
+    def _store_rows(self, rows: List[tuple]):
+        img_ids = []
+        vectors = []
+        for row_id, img_id, features in rows:
+            if self._rows.is_wanted(row_id, features):
+                img_ids.append(img_id)
+                vectors.append(face_vector_from_bytes(features))
+
+        self._store(img_ids, vectors)
+        self._rows.track([row[0] for row in rows])
+
+        if rows:
+            logger.debug('Loaded %d new face vectors, gallery has %d',
+                         len(vectors), self._size)
+
+    def search(self, faces: np.ndarray, max_distance: float,
+               group_starts: Optional[np.ndarray] = None) \
+            -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """Rows closer than max_distance to any face of a group of faces.
+
+        The faces are split into consecutive groups starting at group_starts
+        (by default all the faces form a single group). Returns the group,
+        the row number and the distance to the closest face of the group
+        for every matching pair of group and row.
+        """
+        if group_starts is None:
+            group_starts = np.zeros(1, dtype=np.int64)
+
+        groups, rows, squared_distances = self._index.range_search(
+            self.vectors, self.squared_norms, faces, group_starts,
+            max_distance ** 2)
+        return groups, rows, np.sqrt(squared_distances)
+
+    def save(self, path: str):
+        if not self._autosave.is_dirty:
+            return
+
+        index_state = {'index_{}'.format(key): value
+                       for key, value in self._index.get_state().items()}
+
+        temp_path = '{}.{}.tmp'.format(path, os.getpid())
+        with open(temp_path, 'wb') as fobj:
+            np.savez(fobj,
+                     img_ids=self.img_ids.astype(str),
+                     vectors=self.vectors,
+                     high_water_mark=np.array(self._rows.high_water_mark),
+                     added_row_ids=np.array(sorted(self._rows.added_row_ids),
+                                            dtype=np.int64),
+                     missing_row_ids=np.array(
+                         sorted(self._rows.missing_row_ids), dtype=np.int64),
+                     index_name=np.array(self._index.name),
+                     **index_state)
+        os.replace(temp_path, path)
+
+        self._autosave.mark_saved()
+        logger.info('Saved gallery of %d face vectors to %s',
+                    self._size, path)
+
+    def load(self, path: str):
+        try:
+            with np.load(path) as data:
+                img_ids = data['img_ids'].astype(object)
+                vectors = data['vectors'].astype(np.float32)
+                high_water_mark = int(data['high_water_mark'])
+                added_row_ids = set(data['added_row_ids'].tolist())
+                missing_row_ids = data['missing_row_ids'].tolist()
+                index_name = str(data['index_name'])
+                index_state = {key[len('index_'):]: data[key]
+                               for key in data.files
+                               if key.startswith('index_')}
+        except (OSError, KeyError, ValueError):
+            logger.exception('Unable to load gallery from %s', path)
+            return
+
+        self._size = 0
+        self._store(img_ids.tolist(), vectors)
+        self._autosave.is_dirty = False
+        self._rows.high_water_mark = high_water_mark
+        self._rows.added_row_ids = added_row_ids
+        self._rows.missing_row_ids = dict.fromkeys(missing_row_ids,
+                                                   monotonic())
+
+        if index_name != self._index.name:
+            index_state = {}
+        self._index.set_state(index_state, self.vectors)
+
+        logger.info('Loaded gallery of %d face vectors from %s',
+                    self._size, path)
+
+    def add(self,
+            row_ids: Iterable[int],
+            img_ids: List[str],
+            vectors: Sequence[FaceVector]):
+        self._rows.added_row_ids.update(row_ids)
+        self._store(img_ids, vectors)
+        self._index.add(self.vectors)
+
+    def _store(self, img_ids: List[str], vectors: Sequence[FaceVector]):
+        new_vectors = np.asarray(vectors, dtype=np.float32)
+        if new_vectors.size == 0:
+            return
+
+        new_size = self._size + len(new_vectors)
+        dimensions = new_vectors.shape[1]
+
+        if self._size and self._vectors.shape[1] != dimensions:
+            raise ValueError('Face vectors of dimension {} can not be added '
+                             'to a gallery of dimension {}'
+                             .format(dimensions, self._vectors.shape[1]))
+
+        if new_size > len(self._vectors) \
+                or self._vectors.shape[1] != dimensions:
+            self._grow(new_size, dimensions)
+
+        self._vectors[self._size:new_size] = new_vectors
+        self._img_ids[self._size:new_size] = img_ids
+        self._squared_norms[self._size:new_size] = \
+            np.einsum('ij,ij->i', new_vectors, new_vectors)
+        self._size = new_size
+        self._autosave.is_dirty = True
+
+    def _grow(self, min_capacity: int, dimensions: int):
+        capacity = max(min_capacity, 2 * len(self._vectors), 1024)
+
+        if self._index.scans_vectors:
+            vectors = np.empty((capacity, dimensions), dtype=np.float32)
+        else:
+            with TemporaryFile() as fobj:
+                vectors = np.memmap(fobj, dtype=np.float32, mode='w+',
+                                    shape=(capacity, dimensions))
+        img_ids = np.empty(capacity, dtype=object)
+        squared_norms = np.empty(capacity, dtype=np.float32)
+        if self._size:
+            vectors[:self._size] = self._vectors[:self._size]
+            img_ids[:self._size] = self._img_ids[:self._size]
+            squared_norms[:self._size] = self._squared_norms[:self._size]
+
+        self._vectors = vectors
+        self._img_ids = img_ids
+        self._squared_norms = squared_norms
+
+
+class SharedGallery(Gallery):
+    """Gallery whose vectors are shared by all the processes of a host.
+
+    The vectors, img_ids and squared norms are kept in memory-mapped .npy
+    files in a directory next to a small json file describing how many rows
+    are valid. Every process maps the files read-only to search them. A
+    refresh takes an exclusive lock on the directory so that a single
+    process at a time loads the new rows from the database, appends them to
+    the files and publishes the new size. Growing the gallery beyond the
+    capacity of the files writes a new generation of files and the previous
+    generation is unlinked once no longer published (processes that still
+    map it keep a valid view until their next refresh).
+
+    Only the index (e.g. the ivf list assignments) is private to each
+    process.
+    """
+
+    _IMG_ID_DTYPE = np.dtype('U50')
+
+    # the arguments of Gallery plus the directory to share the files in
+    def __init__(self,  # pylint: disable=too-many-arguments
+                 directory: str,
+                 index=None,
+                 path: Optional[str] = None,
+                 save_interval: float = 0,
+                 shard: Optional[int] = None) -> None:
+        super().__init__(index, path, save_interval, shard)
+        self._directory = directory
+        self._mapped = (-1, '')  # type: Tuple[int, str]
+        self._img_ids = np.empty(0, dtype=self._IMG_ID_DTYPE)
+        os.makedirs(directory, exist_ok=True)
+
+    @property
+    def _generation(self) -> int:
+        return self._mapped[0]
+
+    def refresh(self):
+        with self._lock():
+            self._map('r+')
+            self._store_rows(self._query_new_rows())
+            self._publish()
+
+        self._map('r')
+        self._index.add(self.vectors)
+        self._autosave_if_due()
+
+    def add(self,
+            row_ids: Iterable[int],
+            img_ids: List[str],
+            vectors: Sequence[FaceVector]):
+        # the rows are committed so they're published by the next refresh,
+        # which makes them visible to all the other processes as well
+        self.refresh()
+
+    def load(self, path: str):
+        with self._lock():
+            if self._read_state() is not None:
+                return
+
+            super().load(path)
+            self._publish()
+
+        self._map('r')
+
+    @contextmanager
+    def _lock(self):
+        with open(os.path.join(self._directory, 'gallery.lock'), 'w') as fobj:
+            fcntl.flock(fobj, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(fobj, fcntl.LOCK_UN)
+
+    def _file(self, name: str, generation: int) -> str:
+        return os.path.join(self._directory,
+                            '{}.{}.npy'.format(name, generation))
+
+    def _read_state(self) -> Optional[dict]:
+        try:
+            with open(os.path.join(self._directory, 'gallery.json')) as fobj:
+                return json.load(fobj)
+        except FileNotFoundError:
+            return None
+
+    def _map(self, mode: str):
+        state = self._read_state()
+        if state is None:
+            return
+
+        generation = state['generation']
+        if (generation, mode) != self._mapped:
+            self._vectors = np.load(self._file('vectors', generation),
+                                    mmap_mode=mode)
+            self._img_ids = np.load(self._file('img_ids', generation),
+                                    mmap_mode=mode)
+            self._squared_norms = np.load(
+                self._file('squared_norms', generation), mmap_mode=mode)
+            self._mapped = (generation, mode)
+
+        self._size = state['size']
+        self._rows.high_water_mark = state['high_water_mark']
+        self._rows.missing_row_ids = {
+            int(row_id): first_missed
+            for row_id, first_missed in state['missing_row_ids']}
+
+    def _publish(self):
+        if self._generation < 0:
+            return
+
+        for array in (self._vectors, self._img_ids, self._squared_norms):
+            array.flush()
+
+        state = {
+            'generation': self._generation,
+            'size': self._size,
+            'high_water_mark': self._rows.high_water_mark,
+            'missing_row_ids': list(self._rows.missing_row_ids.items()),
+        }
+        state_path = os.path.join(self._directory, 'gallery.json')
+        temp_path = '{}.{}.tmp'.format(state_path, os.getpid())
+        with open(temp_path, 'w') as fobj:
+            json.dump(state, fobj)
+        os.replace(temp_path, state_path)
+
+        for name in ('vectors', 'img_ids', 'squared_norms'):
+            stale_path = self._file(name, self._generation - 1)
+            if os.path.exists(stale_path):
+                os.remove(stale_path)
+
+    def _grow(self, min_capacity: int, dimensions: int):
+        capacity = max(min_capacity, 2 * len(self._vectors), 1024)
+        generation = self._generation + 1
+
+        vectors = open_memmap(self._file('vectors', generation), mode='w+',
+                              dtype=np.float32, shape=(capacity, dimensions))
+        img_ids = open_memmap(self._file('img_ids', generation), mode='w+',
+                              dtype=self._IMG_ID_DTYPE, shape=(capacity,))
+        squared_norms = open_memmap(self._file('squared_norms', generation),
+                                    mode='w+', dtype=np.float32,
+                                    shape=(capacity,))
+        if self._size:
+            vectors[:self._size] = self._vectors[:self._size]
+            img_ids[:self._size] = self._img_ids[:self._size]
+            squared_norms[:self._size] = self._squared_norms[:self._size]
+
+        self._vectors = vectors
+        self._img_ids = img_ids
+        self._squared_norms = squared_norms
+        self._mapped = (generation, 'w+')
+
+
+def _create_index():
+    if MATCHER_BACKEND == ExactIndex.name:
+        return ExactIndex()
+    if MATCHER_BACKEND == IVFIndex.name:
+        return IVFIndex(MATCHER_IVF_LISTS, MATCHER_IVF_PROBES)
+    if MATCHER_BACKEND == Float16Encoder.name:
+        return CompressedIndex(Float16Encoder(), MATCHER_RERANK_MARGIN)
+    if MATCHER_BACKEND == Int8Encoder.name:
+        return CompressedIndex(Int8Encoder(), MATCHER_RERANK_MARGIN)
+    if MATCHER_BACKEND == ProductQuantizationEncoder.name:
+        return CompressedIndex(
+            ProductQuantizationEncoder(MATCHER_PQ_SUBVECTORS),
+            MATCHER_RERANK_MARGIN)
+    raise ValueError('Unknown matcher backend {}'.format(MATCHER_BACKEND))
+
+
+@lru_cache(maxsize=None)
+def get_gallery(shard: Optional[int] = None) -> Gallery:
+    path = GALLERY_INDEX_PATH
+    if path and shard is not None:
+        path = '{}.shard{}'.format(path, shard)
+
+    if GALLERY_SHARED_DIR:
+        directory = GALLERY_SHARED_DIR
+        if shard is not None:
+            directory = os.path.join(directory, 'shard{}'.format(shard))
+
+        gallery = SharedGallery(directory,
+                                _create_index(),
+                                path,
+                                GALLERY_INDEX_SAVE_INTERVAL,
+                                shard)  # type: Gallery
+    else:
+        gallery = Gallery(_create_index(),
+                          path,
+                          GALLERY_INDEX_SAVE_INTERVAL,
+                          shard)
+
+    if path and os.path.isfile(path):
+        gallery.load(path)
+
+    return gallery
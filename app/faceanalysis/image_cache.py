@@ -0,0 +1,169 @@
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+from time import sleep
+from time import time
+from typing import List
+from typing import Optional
+import os
+
+from faceanalysis.log import get_logger
+from faceanalysis.models import ImageStatus
+from faceanalysis.models import get_db_session
+from faceanalysis.settings import IMAGE_CACHE_DIR
+from faceanalysis.settings import IMAGE_CACHE_DOWNLOAD_TIMEOUT
+from faceanalysis.settings import IMAGE_CACHE_MAX_BYTES
+from faceanalysis.settings import IMAGE_CACHE_PREFETCH_THREADS
+from faceanalysis.storage import StorageError
+from faceanalysis.storage import download_image
+
+logger = get_logger(__name__)
+
+_PARTIAL_SUFFIX = '.part'
+_POLL_INTERVAL = 0.05
+
+
+def _remove(path: str):
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+
+
+class ImageCache:
+    """Local copies of the stored images, downloaded from any provider.
+
+    The copies are kept in a directory shared by all the processes of a
+    worker: the main process prefetches the images of the tasks it reserves
+    in background threads while the pool processes vectorize, and a pool
+    process downloads an image itself when it wasn't prefetched in time.
+    A download is claimed by exclusively creating its partial file so that
+    no image is downloaded twice at once, and the least recently used
+    copies are evicted once the directory holds more than max_bytes.
+    """
+
+    def __init__(self, directory: str,
+                 max_bytes: int = IMAGE_CACHE_MAX_BYTES,
+                 num_threads: int = IMAGE_CACHE_PREFETCH_THREADS,
+                 download_timeout: float = IMAGE_CACHE_DOWNLOAD_TIMEOUT) \
+            -> None:
+        os.makedirs(directory, exist_ok=True)
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.num_threads = num_threads
+        self.download_timeout = download_timeout
+        self._executor = None  # type: Optional[ThreadPoolExecutor]
+
+    def _local_path(self, img_id: str, image_name: Optional[str]) -> str:
+        return os.path.join(self.directory, image_name or img_id)
+
+    def _claim(self, partial_path: str) -> bool:
+        try:
+            os.close(os.open(partial_path,
+                             os.O_CREAT | os.O_EXCL | os.O_WRONLY))
+        except FileExistsError:
+            try:
+                is_stale = (time() - os.path.getmtime(partial_path)
+                            > self.download_timeout)
+            except FileNotFoundError:
+                return False
+
+            # the process downloading the image died
+            if is_stale:
+                _remove(partial_path)
+            return False
+        return True
+
+    def _try_fetch(self, img_id: str,
+                   image_name: Optional[str]) -> Optional[str]:
+
+        path = self._local_path(img_id, image_name)
+        partial_path = path + _PARTIAL_SUFFIX
+
+        try:
+            os.utime(path)
+        except FileNotFoundError:
+            pass
+        else:
+            return path
+
+        # another process is downloading the image
+        if not self._claim(partial_path):
+            return None
+
+        try:
+            download_image(img_id, partial_path, image_name)
+            os.replace(partial_path, path)
+        except BaseException:
+            _remove(partial_path)
+            raise
+
+        self._evict()
+        return path
+
+    def _evict(self):
+        files = []
+        for entry in os.scandir(self.directory):
+            if entry.name.endswith(_PARTIAL_SUFFIX) or not entry.is_file():
+                continue
+            try:
+                stat = entry.stat()
+            except FileNotFoundError:
+                continue
+            files.append((stat.st_mtime, stat.st_size, entry.path))
+
+        total_bytes = sum(size for _, size, _ in files)
+        files.sort()
+
+        # never evict the most recently used image
+        for _, size, path in files[:-1]:
+            if total_bytes <= self.max_bytes:
+                break
+            _remove(path)
+            total_bytes -= size
+            logger.debug('Evicted cached image %s', path)
+
+    def get_path(self, img_id: str, image_name: Optional[str] = None) -> str:
+        while True:
+            path = self._try_fetch(img_id, image_name)
+            if path is not None:
+                return path
+            sleep(_POLL_INTERVAL)
+
+    def discard(self, img_id: str, image_name: Optional[str] = None):
+        _remove(self._local_path(img_id, image_name))
+
+    def _get_executor(self) -> ThreadPoolExecutor:
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(max_workers=self.num_threads)
+        return self._executor
+
+    def prefetch(self, img_ids: List[str]):
+        self._get_executor().submit(self._prefetch, img_ids)
+
+    def _prefetch(self, img_ids: List[str]):
+        with get_db_session() as session:
+            object_names = dict(session
+                                .query(ImageStatus.img_id,
+                                       ImageStatus.object_name)
+                                .filter(ImageStatus.img_id.in_(img_ids)))
+
+        for img_id, image_name in object_names.items():
+            self._get_executor().submit(self._prefetch_image, img_id,
+                                        image_name)
+
+    def _prefetch_image(self, img_id: str, image_name: Optional[str]):
+        try:
+            path = self._try_fetch(img_id, image_name)
+        except StorageError:
+            logger.warning("Can't prefetch image %s", img_id)
+            return
+
+        if path is not None:
+            logger.debug('Prefetched image %s', img_id)
+
+
+@lru_cache(maxsize=1)
+def get_image_cache() -> Optional[ImageCache]:
+    if not IMAGE_CACHE_DIR:
+        return None
+    return ImageCache(IMAGE_CACHE_DIR)
@@ -0,0 +1,599 @@
+from typing import Dict
+from typing import List  # noqa: F401
+from typing import Optional  # noqa: F401
+from typing import Tuple
+
+import numpy as np
+
+from faceanalysis.log import get_logger
+
+logger = get_logger(__name__)
+
+# number of gallery rows compared to a set of faces in one matrix product
+_DISTANCE_BLOCK_SIZE = 65536
+
+# bounds on the number of vectors per list used to train the ivf centroids
+_MIN_TRAINING_POINTS_PER_LIST = 39
+_MAX_TRAINING_POINTS_PER_LIST = 256
+_KMEANS_ITERATIONS = 10
+
+# recently added rows are scanned exhaustively until there are this many of
+# them (or a fraction of the gallery), then they're merged into the lists
+_MIN_UNSORTED_ROWS = 4096
+_MAX_UNSORTED_FRACTION = 0.05
+
+# bounds on the number of vectors used to train the quantizers
+_MIN_SCALAR_TRAINING_POINTS = 1000
+_PQ_CENTROIDS = 256
+_MAX_TRAINING_POINTS = 65536
+
+SearchResult = Tuple[np.ndarray, np.ndarray, np.ndarray]
+
+
+def find_within_distance(vectors: np.ndarray,
+                         squared_norms: np.ndarray,
+                         faces: np.ndarray,
+                         group_starts: np.ndarray,
+                         max_squared_distance: float) -> SearchResult:
+    """Rows of vectors closer than the distance to a group of faces.
+
+    The faces are split into consecutive groups (e.g. one per image)
+    starting at group_starts and every (group, row) pair for which the row
+    is within the distance of one of the faces of the group is returned
+    together with the squared distance to the closest face of the group.
+
+    Uses the |a - b|^2 = |a|^2 + |b|^2 - 2ab expansion so that all the faces
+    are compared to the vectors with a single matrix product per block of
+    rows instead of materializing vector-sized differences.
+    """
+    face_squared_norms = np.einsum('ij,ij->i', faces, faces)
+
+    groups = []  # type: List[np.ndarray]
+    rows = []  # type: List[np.ndarray]
+    distances = []  # type: List[np.ndarray]
+    for start in range(0, len(vectors), _DISTANCE_BLOCK_SIZE):
+        end = start + _DISTANCE_BLOCK_SIZE
+        squared_distances = vectors[start:end] @ faces.T
+        squared_distances *= -2
+        squared_distances += squared_norms[start:end, np.newaxis]
+        squared_distances += face_squared_norms
+        squared_distances = np.minimum.reduceat(  # pylint: disable=no-member
+            squared_distances, group_starts, axis=1)
+
+        block_rows, block_groups = np.nonzero(
+            squared_distances < max_squared_distance)
+        groups.append(block_groups)
+        rows.append(block_rows + start)
+        distances.append(squared_distances[block_rows, block_groups])
+
+    if not rows:
+        return _empty_search_result()
+
+    squared_distances = np.concatenate(distances)
+    np.maximum(squared_distances, 0, out=squared_distances)
+    return np.concatenate(groups), np.concatenate(rows), squared_distances
+
+
+def _empty_search_result() -> SearchResult:
+    return (np.empty(0, dtype=np.int64),
+            np.empty(0, dtype=np.int64),
+            np.empty(0, dtype=np.float32))
+
+
+def _nearest_centroids(vectors: np.ndarray,
+                       centroids: np.ndarray) -> np.ndarray:
+    centroid_squared_norms = np.einsum('ij,ij->i', centroids, centroids)
+
+    nearest = np.empty(len(vectors), dtype=np.int32)
+    for start in range(0, len(vectors), _DISTANCE_BLOCK_SIZE):
+        end = start + _DISTANCE_BLOCK_SIZE
+        # |v|^2 is constant per row so it doesn't change the argmin
+        squared_distances = vectors[start:end] @ centroids.T
+        squared_distances *= -2
+        squared_distances += centroid_squared_norms
+        squared_distances.argmin(axis=1, out=nearest[start:end])
+    return nearest
+
+
+def _group_rows(assignments: np.ndarray,
+                num_lists: int) -> Tuple[np.ndarray, np.ndarray]:
+    rows = np.argsort(assignments, kind='mergesort')
+    offsets = np.zeros(num_lists + 1, dtype=np.int64)
+    np.cumsum(np.bincount(assignments, minlength=num_lists),
+              out=offsets[1:])
+    return rows, offsets
+
+
+def _kmeans(vectors: np.ndarray, num_clusters: int,
+            iterations: int) -> np.ndarray:
+    random = np.random.RandomState(0)  # pylint: disable=no-member
+    initial = random.choice(len(vectors), num_clusters, replace=False)
+    centroids = vectors[initial].copy()
+
+    for _ in range(iterations):
+        assignments = _nearest_centroids(vectors, centroids)
+        rows, offsets = _group_rows(assignments, num_clusters)
+        counts = np.diff(offsets)
+        non_empty = np.flatnonzero(counts)
+        sums = np.add.reduceat(vectors[rows], offsets[non_empty], axis=0)
+        # empty clusters keep their previous centroid
+        centroids[non_empty] = sums / counts[non_empty, np.newaxis]
+
+    return centroids
+
+
+# pylint: disable=no-self-use,unused-argument
+class ExactIndex:
+    """Brute-force range search over every row of the gallery."""
+
+    name = 'exact'
+    scans_vectors = True
+    nbytes = 0
+
+    def add(self, vectors: np.ndarray):
+        pass
+
+    # the arguments are those of find_within_distance, which every index
+    # narrows down to its candidate rows
+    def range_search(self,  # pylint: disable=too-many-arguments
+                     vectors: np.ndarray,
+                     squared_norms: np.ndarray,
+                     faces: np.ndarray,
+                     group_starts: np.ndarray,
+                     max_squared_distance: float) -> SearchResult:
+
+        return find_within_distance(vectors, squared_norms, faces,
+                                    group_starts, max_squared_distance)
+
+    def get_state(self) -> Dict[str, np.ndarray]:
+        return {}
+
+    def set_state(self, state: Dict[str, np.ndarray], vectors: np.ndarray):
+        pass
+# pylint: enable=no-self-use,unused-argument
+
+
+class IVFIndex:
+    """Inverted file index for approximate range search.
+
+    The gallery is clustered with k-means into num_lists lists and a query
+    only scans the rows of the num_probes lists closest to each face, so
+    num_probes trades recall for speed. Until the gallery is large enough
+    to train the centroids every query falls back to a brute-force scan.
+    Rows added after the lists were built are kept in an unsorted tail that
+    is always scanned and periodically merged into the lists.
+    """
+
+    name = 'ivf'
+    scans_vectors = True
+
+    def __init__(self, num_lists: int, num_probes: int) -> None:
+        self._num_lists = num_lists
+        self._num_probes = min(num_probes, num_lists)
+        self._centroids = np.empty((0, 0), dtype=np.float32)
+        self._training_size = 0
+        self._assignments = np.empty(0, dtype=np.int32)
+        self._list_rows = np.empty(0, dtype=np.int64)
+        self._list_offsets = np.zeros(num_lists + 1, dtype=np.int64)
+
+    @property
+    def is_trained(self) -> bool:
+        return len(self._centroids) > 0
+
+    @property
+    def _size(self) -> int:
+        return len(self._assignments)
+
+    @property
+    def _sorted_size(self) -> int:
+        # rows assigned after the lists were sorted are in the unsorted tail
+        return len(self._list_rows)
+
+    @property
+    def nbytes(self) -> int:
+        return (self._centroids.nbytes + self._assignments.nbytes
+                + self._list_rows.nbytes + self._list_offsets.nbytes)
+
+    def add(self, vectors: np.ndarray):
+        if self._needs_training(len(vectors)):
+            self._train(vectors)
+            return
+
+        if not self.is_trained or len(vectors) == self._size:
+            return
+
+        new_assignments = _nearest_centroids(vectors[self._size:],
+                                             self._centroids)
+        self._assignments = np.concatenate((self._assignments,
+                                            new_assignments))
+
+        unsorted = self._size - self._sorted_size
+        if unsorted > max(_MIN_UNSORTED_ROWS,
+                          _MAX_UNSORTED_FRACTION * self._size):
+            self._sort_lists()
+
+    def range_search(self,  # pylint: disable=too-many-arguments
+                     vectors: np.ndarray,
+                     squared_norms: np.ndarray,
+                     faces: np.ndarray,
+                     group_starts: np.ndarray,
+                     max_squared_distance: float) -> SearchResult:
+
+        if not self.is_trained:
+            return find_within_distance(vectors, squared_norms, faces,
+                                        group_starts, max_squared_distance)
+
+        probed_lists = np.unique(self._nearest_lists(faces))
+        candidates = [self._list_rows[self._list_offsets[i]:
+                                      self._list_offsets[i + 1]]
+                      for i in probed_lists]  # type: List[np.ndarray]
+        candidates.append(np.arange(self._sorted_size, len(vectors)))
+        candidate_rows = np.concatenate(candidates)
+
+        groups, rows, squared_distances = find_within_distance(
+            vectors[candidate_rows], squared_norms[candidate_rows], faces,
+            group_starts, max_squared_distance)
+        return groups, candidate_rows[rows], squared_distances
+
+    def get_state(self) -> Dict[str, np.ndarray]:
+        if not self.is_trained:
+            return {}
+
+        return {
+            'centroids': self._centroids,
+            'assignments': self._assignments,
+            'training_size': np.array(self._training_size),
+        }
+
+    def set_state(self, state: Dict[str, np.ndarray], vectors: np.ndarray):
+        centroids = state.get('centroids')
+        if centroids is None \
+                or len(centroids) != self._num_lists \
+                or len(state['assignments']) > len(vectors):
+            self.add(vectors)
+            return
+
+        self._centroids = centroids.astype(np.float32)
+        self._training_size = int(state['training_size'])
+        self._assignments = state['assignments'].astype(np.int32)
+        self._sort_lists()
+        self.add(vectors)
+
+    def _needs_training(self, size: int) -> bool:
+        min_training_size = self._num_lists * _MIN_TRAINING_POINTS_PER_LIST
+        max_training_size = self._num_lists * _MAX_TRAINING_POINTS_PER_LIST
+
+        if not self.is_trained:
+            return size >= min_training_size
+
+        # retrain on a larger sample while the gallery grows rapidly
+        return (self._training_size < max_training_size
+                and size >= 4 * self._training_size)
+
+    def _train(self, vectors: np.ndarray):
+        random = np.random.RandomState(0)  # pylint: disable=no-member
+        max_training_size = self._num_lists * _MAX_TRAINING_POINTS_PER_LIST
+        training_size = min(len(vectors), max_training_size)
+        sample = random.choice(len(vectors), training_size, replace=False)
+
+        self._centroids = _kmeans(vectors[np.sort(sample)],
+                                  self._num_lists,
+                                  _KMEANS_ITERATIONS).astype(np.float32)
+        self._training_size = training_size
+        self._assignments = _nearest_centroids(vectors, self._centroids)
+        self._sort_lists()
+
+        logger.info('Trained %d ivf lists on %d of %d face vectors',
+                    self._num_lists, training_size, len(vectors))
+
+    def _sort_lists(self):
+        self._list_rows, self._list_offsets = _group_rows(
+            self._assignments, self._num_lists)
+
+    def _nearest_lists(self, faces: np.ndarray) -> np.ndarray:
+        if self._num_probes == self._num_lists:
+            return np.arange(self._num_lists)
+
+        squared_distances = faces @ self._centroids.T
+        squared_distances *= -2
+        squared_distances += np.einsum('ij,ij->i', self._centroids,
+                                       self._centroids)
+        nearest = np.argpartition(squared_distances, self._num_probes - 1,
+                                  axis=1)
+        return nearest[:, :self._num_probes]
+
+
+def _training_sample(vectors: np.ndarray) -> np.ndarray:
+    if len(vectors) <= _MAX_TRAINING_POINTS:
+        return vectors
+
+    random = np.random.RandomState(0)  # pylint: disable=no-member
+    sample = random.choice(len(vectors), _MAX_TRAINING_POINTS, replace=False)
+    return vectors[np.sort(sample)]
+
+
+# pylint: disable=no-self-use,unused-argument
+class Float16Encoder:
+    """Half precision copy of the vectors (2 bytes per dimension)."""
+
+    name = 'float16'
+    min_training_size = 0
+    dtype = np.float16
+
+    def code_size(self, dimensions: int) -> int:
+        return dimensions
+
+    def train(self, vectors: np.ndarray):
+        pass
+
+    def encode(self, vectors: np.ndarray) -> np.ndarray:
+        return vectors.astype(np.float16)
+
+    def squared_norms(self, codes: np.ndarray) -> np.ndarray:
+        vectors = codes.astype(np.float32)
+        return np.einsum('ij,ij->i', vectors, vectors)
+
+    def inner_products(self, codes: np.ndarray,
+                       faces: np.ndarray) -> np.ndarray:
+        # numpy has no half precision matrix product, so a block of codes
+        # is widened right before it's multiplied
+        return codes.astype(np.float32) @ faces.T
+
+    def get_state(self) -> Dict[str, np.ndarray]:
+        return {}
+
+    def set_state(self, state: Dict[str, np.ndarray]) -> bool:
+        return True
+# pylint: enable=no-self-use,unused-argument
+
+
+class Int8Encoder:
+    """Scalar quantization of every dimension to 256 levels (1 byte)."""
+
+    name = 'int8'
+    min_training_size = _MIN_SCALAR_TRAINING_POINTS
+    dtype = np.uint8
+
+    def __init__(self):
+        self._offsets = None  # type: Optional[np.ndarray]
+        self._scales = None  # type: Optional[np.ndarray]
+
+    def code_size(self, dimensions: int) -> int:  # pylint: disable=no-self-use
+        return dimensions
+
+    def train(self, vectors: np.ndarray):
+        sample = _training_sample(vectors)
+        # clip the outliers so that they don't waste most of the levels
+        low, high = np.percentile(sample, [0.1, 99.9], axis=0)
+        self._offsets = low.astype(np.float32)
+        self._scales = (np.maximum(high - low, 1e-6) / 255).astype(np.float32)
+
+    def encode(self, vectors: np.ndarray) -> np.ndarray:
+        levels = np.rint((vectors - self._offsets) / self._scales)
+        return np.clip(levels, 0, 255).astype(np.uint8)
+
+    def squared_norms(self, codes: np.ndarray) -> np.ndarray:
+        vectors = codes.astype(np.float32)
+        vectors *= self._scales
+        vectors += self._offsets
+        return np.einsum('ij,ij->i', vectors, vectors)
+
+    def inner_products(self, codes: np.ndarray,
+                       faces: np.ndarray) -> np.ndarray:
+        # (c * s + o) . f = c . (s * f) + o . f, so the scales and offsets
+        # are applied to the few faces instead of decoding every code
+        inner_products = codes.astype(np.float32) @ (faces * self._scales).T
+        inner_products += faces @ self._offsets
+        return inner_products
+
+    def get_state(self) -> Dict[str, np.ndarray]:
+        if self._offsets is None:
+            return {}
+        return {'offsets': self._offsets, 'scales': self._scales}
+
+    def set_state(self, state: Dict[str, np.ndarray]) -> bool:
+        if 'offsets' not in state:
+            return False
+        self._offsets = state['offsets'].astype(np.float32)
+        self._scales = state['scales'].astype(np.float32)
+        return True
+
+
+class ProductQuantizationEncoder:
+    """Product quantization of the vectors into one byte per subvector.
+
+    The dimensions are split into num_subvectors slices and every slice is
+    quantized to the nearest of 256 centroids learned with k-means, so a
+    128 dimensional vector with 16 subvectors takes 16 bytes. Distances are
+    approximated with per-face lookup tables of the inner product of each
+    slice of the face with each centroid.
+    """
+
+    name = 'pq'
+    min_training_size = _PQ_CENTROIDS * _MIN_TRAINING_POINTS_PER_LIST
+    dtype = np.uint8
+
+    def __init__(self, num_subvectors: int) -> None:
+        self._num_subvectors = num_subvectors
+        self._bounds = np.empty(0, dtype=np.int64)
+        self._centroids = []  # type: List[np.ndarray]
+
+    def code_size(self, dimensions: int) -> int:
+        return min(self._num_subvectors, dimensions)
+
+    def train(self, vectors: np.ndarray):
+        sample = _training_sample(vectors)
+        num_subvectors = self.code_size(vectors.shape[1])
+        self._bounds = np.linspace(0, vectors.shape[1], num_subvectors + 1,
+                                   dtype=np.int64)
+        self._centroids = [
+            _kmeans(np.ascontiguousarray(sample[:, start:end]),
+                    _PQ_CENTROIDS, _KMEANS_ITERATIONS)
+            for start, end in zip(self._bounds[:-1], self._bounds[1:])]
+
+    def encode(self, vectors: np.ndarray) -> np.ndarray:
+        codes = np.empty((len(vectors), len(self._centroids)), dtype=np.uint8)
+        for i, (start, end) in enumerate(zip(self._bounds[:-1],
+                                             self._bounds[1:])):
+            codes[:, i] = _nearest_centroids(
+                np.ascontiguousarray(vectors[:, start:end]),
+                self._centroids[i])
+        return codes
+
+    def squared_norms(self, codes: np.ndarray) -> np.ndarray:
+        squared_norms = np.zeros(len(codes), dtype=np.float32)
+        for i, centroids in enumerate(self._centroids):
+            table = np.einsum('ij,ij->i', centroids, centroids)
+            squared_norms += table[codes[:, i]]
+        return squared_norms
+
+    def inner_products(self, codes: np.ndarray,
+                       faces: np.ndarray) -> np.ndarray:
+        inner_products = np.zeros((len(codes), len(faces)), dtype=np.float32)
+        for i, (start, end) in enumerate(zip(self._bounds[:-1],
+                                             self._bounds[1:])):
+            table = self._centroids[i] @ faces[:, start:end].T
+            inner_products += table[codes[:, i]]
+        return inner_products
+
+    def get_state(self) -> Dict[str, np.ndarray]:
+        if not self._centroids:
+            return {}
+        return {'bounds': self._bounds,
+                'centroids': np.concatenate(self._centroids, axis=1)}
+
+    def set_state(self, state: Dict[str, np.ndarray]) -> bool:
+        if 'bounds' not in state \
+                or len(state['bounds']) - 1 != self._num_subvectors:
+            return False
+        self._bounds = state['bounds'].astype(np.int64)
+        self._centroids = [
+            state['centroids'][:, start:end].astype(np.float32)
+            for start, end in zip(self._bounds[:-1], self._bounds[1:])]
+        return True
+
+
+class CompressedIndex:
+    """Range search over compressed codes with exact re-ranking.
+
+    A compact code (see the encoders above) and its squared norm are kept
+    for every row and scanned to find the candidate rows within the
+    distance plus rerank_margin of a face. Only the candidates are then
+    compared to the full precision vectors, which the gallery keeps in a
+    file-backed memory map (see scans_vectors) so that only the codes need
+    to be resident in memory. Until there are enough rows to train the
+    encoder every query falls back to a brute-force scan.
+    """
+
+    scans_vectors = False
+
+    def __init__(self, encoder, rerank_margin: float) -> None:
+        self._encoder = encoder
+        self._rerank_margin = rerank_margin
+        self._exact = ExactIndex()
+        self._is_trained = False
+        self._codes = np.empty((0, 0), dtype=encoder.dtype)
+        self._code_squared_norms = np.empty(0, dtype=np.float32)
+        self._size = 0
+
+    @property
+    def name(self) -> str:
+        return self._encoder.name
+
+    @property
+    def is_trained(self) -> bool:
+        return self._is_trained
+
+    @property
+    def codes(self) -> np.ndarray:
+        return self._codes[:self._size]
+
+    @property
+    def nbytes(self) -> int:
+        return self._codes.nbytes + self._code_squared_norms.nbytes
+
+    def add(self, vectors: np.ndarray):
+        if not self.is_trained:
+            if not vectors.shape[0] \
+                    or len(vectors) < self._encoder.min_training_size:
+                return
+            self._encoder.train(vectors)
+            self._is_trained = True
+            logger.info('Trained %s encoder on %d face vectors',
+                        self.name, len(vectors))
+
+        if len(vectors) <= self._size:
+            return
+
+        if len(vectors) > len(self._codes):
+            self._grow(len(vectors), vectors.shape[1])
+
+        for start in range(self._size, len(vectors), _DISTANCE_BLOCK_SIZE):
+            end = min(start + _DISTANCE_BLOCK_SIZE, len(vectors))
+            codes = self._encoder.encode(vectors[start:end])
+            self._codes[start:end] = codes
+            self._code_squared_norms[start:end] = \
+                self._encoder.squared_norms(codes)
+        self._size = len(vectors)
+
+    def range_search(self,  # pylint: disable=too-many-arguments
+                     vectors: np.ndarray,
+                     squared_norms: np.ndarray,
+                     faces: np.ndarray,
+                     group_starts: np.ndarray,
+                     max_squared_distance: float) -> SearchResult:
+
+        if not self.is_trained:
+            return self._exact.range_search(vectors, squared_norms, faces,
+                                            group_starts, max_squared_distance)
+
+        candidate_rows = np.concatenate((
+            self._coarse_candidates(faces, max_squared_distance),
+            np.arange(self._size, len(vectors))))
+
+        groups, rows, squared_distances = find_within_distance(
+            vectors[candidate_rows], squared_norms[candidate_rows], faces,
+            group_starts, max_squared_distance)
+        return groups, candidate_rows[rows], squared_distances
+
+    def _coarse_candidates(self, faces: np.ndarray,
+                           max_squared_distance: float) -> np.ndarray:
+        """Encoded rows whose code is within the distance plus the margin
+        of one of the faces."""
+
+        max_coarse_distance = \
+            (np.sqrt(max_squared_distance) + self._rerank_margin) ** 2
+        face_squared_norms = np.einsum('ij,ij->i', faces, faces)
+
+        candidates = [np.empty(0, dtype=np.int64)]  # type: List[np.ndarray]
+        for start in range(0, self._size, _DISTANCE_BLOCK_SIZE):
+            end = min(start + _DISTANCE_BLOCK_SIZE, self._size)
+            squared_distances = self._encoder.inner_products(
+                self._codes[start:end], faces)
+            squared_distances *= -2
+            squared_distances += \
+                self._code_squared_norms[start:end, np.newaxis]
+            squared_distances += face_squared_norms
+            candidates.append(start + np.flatnonzero(
+                squared_distances.min(axis=1) < max_coarse_distance))
+        return np.concatenate(candidates)
+
+    def get_state(self) -> Dict[str, np.ndarray]:
+        return self._encoder.get_state() if self.is_trained else {}
+
+    def set_state(self, state: Dict[str, np.ndarray], vectors: np.ndarray):
+        # the codes are cheap to recompute from the vectors
+        self._is_trained = bool(state) and self._encoder.set_state(state)
+        self.add(vectors)
+
+    def _grow(self, min_capacity: int, dimensions: int):
+        capacity = max(min_capacity, 2 * len(self._codes), 1024)
+        codes = np.empty((capacity, self._encoder.code_size(dimensions)),
+                         dtype=self._encoder.dtype)
+        code_squared_norms = np.empty(capacity, dtype=np.float32)
+        if self._size:
+            codes[:self._size] = self._codes[:self._size]
+            code_squared_norms[:self._size] = \
+                self._code_squared_norms[:self._size]
+        self._codes = codes
+        self._code_squared_norms = code_squared_norms
@@ -0,0 +1,139 @@
+from typing import List  # noqa: F401
+
+from sqlalchemy import Text
+from sqlalchemy import inspect
+from sqlalchemy.dialects.mysql import DOUBLE
+from sqlalchemy import select
+
+from faceanalysis.face_vectorizer import face_vector_from_text
+from faceanalysis.face_vectorizer import face_vector_to_bytes
+from faceanalysis.face_vectorizer import is_binary_face_vector
+from faceanalysis.log import get_logger
+from faceanalysis.models import FeatureMapping
+from faceanalysis.models import ImageStatus
+from faceanalysis.models import Match
+from faceanalysis.models import get_db_session
+from faceanalysis.settings import MATCH_STORAGE_MODE
+
+logger = get_logger(__name__)
+
+
+def _convert_features_column():
+    table = FeatureMapping.__tablename__
+
+    with get_db_session() as session:
+        columns = inspect(session.get_bind()).get_columns(table)
+        column_types = {column['name']: column['type'] for column in columns}
+        if isinstance(column_types['features'], Text):
+            logger.info('Converting %s.features to a binary column', table)
+            session.execute('ALTER TABLE {} MODIFY features BLOB'
+                            .format(table))
+
+
+def _convert_feature_mappings(batch_size: int) -> int:
+    last_id = 0
+    converted = 0
+
+    while True:
+        rows = []  # type: List[tuple]
+        updates = []  # type: List[dict]
+        with get_db_session(commit=True) as session:
+            rows = session.query(FeatureMapping.id, FeatureMapping.features) \
+                .filter(FeatureMapping.id > last_id) \
+                .order_by(FeatureMapping.id) \
+                .limit(batch_size) \
+                .all()
+
+            updates = [{'id': row_id,
+                        'features': face_vector_to_bytes(
+                            face_vector_from_text(features))}
+                       for row_id, features in rows
+                       if not is_binary_face_vector(features)]
+
+            session.bulk_update_mappings(FeatureMapping, updates)
+
+        if not rows:
+            return converted
+
+        last_id = rows[-1][0]
+        converted += len(updates)
+        logger.debug('Converted %d face vectors up to id %d',
+                     converted, last_id)
+
+
+def migrate_face_vectors(batch_size: int = 1000):
+    _convert_features_column()
+    converted = _convert_feature_mappings(batch_size)
+    logger.info('Converted %d face vectors to binary format', converted)
+
+
+def migrate_match_storage():
+    matches = Match.__table__
+
+    with get_db_session(commit=True) as session:
+        if MATCH_STORAGE_MODE == 'canonical':
+            result = session.execute(
+                matches.delete()
+                .where(matches.c.this_img_id > matches.c.that_img_id))
+        else:
+            result = session.execute(
+                matches.insert()
+                .prefix_with('IGNORE', dialect='mysql')
+                .from_select(['this_img_id', 'that_img_id', 'distance_score'],
+                             select([matches.c.that_img_id,
+                                     matches.c.this_img_id,
+                                     matches.c.distance_score])))
+
+    logger.info('Converted %d matches to %s storage',
+                result.rowcount, MATCH_STORAGE_MODE)
+
+
+def migrate_match_indexes():
+    table = Match.__tablename__
+
+    with get_db_session() as session:
+        inspector = inspect(session.get_bind())
+        columns = inspector.get_columns(table)
+        column_types = {column['name']: column['type'] for column in columns}
+        if not isinstance(column_types['distance_score'], DOUBLE):
+            logger.info('Converting %s.distance_score to double precision',
+                        table)
+            session.execute('ALTER TABLE {} MODIFY distance_score DOUBLE'
+                            .format(table))
+
+        existing_indexes = {index['name']
+                            for index in inspector.get_indexes(table)}
+        for index in Match.__table__.indexes:
+            if index.name not in existing_indexes:
+                logger.info('Creating index %s', index.name)
+                index.create(session.get_bind())
+
+
+def migrate_image_status_columns():
+    table = ImageStatus.__tablename__
+
+    with get_db_session() as session:
+        inspector = inspect(session.get_bind())
+        columns = {column['name'] for column in inspector.get_columns(table)}
+
+        # existing rows keep null values: their images are found by probing
+        # and they aren't considered for deduplication
+        if 'object_name' not in columns:
+            logger.info('Adding %s.object_name', table)
+            session.execute('ALTER TABLE {} ADD COLUMN object_name '
+                            'VARCHAR(100) NULL'.format(table))
+        if 'content_hash' not in columns:
+            logger.info('Adding %s.content_hash', table)
+            session.execute('ALTER TABLE {} ADD COLUMN content_hash '
+                            'VARCHAR(64) NULL'.format(table))
+        if 'perceptual_hash' not in columns:
+            logger.info('Adding %s.perceptual_hash', table)
+            session.execute('ALTER TABLE {} ADD COLUMN perceptual_hash '
+                            'VARCHAR(32) NULL'.format(table))
+
+        existing_indexes = {index['name']
+                            for index in inspector.get_indexes(table)}
+        for index in ImageStatus.__table__.indexes:
+            if index.name not in existing_indexes:
+                logger.info('Creating index %s', index.name)
+                index.create(session.get_bind())
@@ -6,9 +6,10 @@ from functools import lru_cache
 from sqlalchemy import Column
 from sqlalchemy import DateTime
 from sqlalchemy import Float
+from sqlalchemy import Index
 from sqlalchemy import Integer
+from sqlalchemy import LargeBinary
 from sqlalchemy import String
-from sqlalchemy import Text
 from sqlalchemy import UniqueConstraint
 from sqlalchemy import create_engine
 from sqlalchemy.exc import SQLAlchemyError
@@ -42,6 +43,9 @@ class ImageStatus(Base):  # type: ignore
     img_id = Column(String(50), unique=True)
     status = Column(String(50))
     error_msg = Column(String(50), default=None)
+    object_name = Column(String(100), default=None)
+    content_hash = Column(String(64), default=None, index=True)
+    perceptual_hash = Column(String(32), default=None)
 
 
 class Image(Base):  # type: ignore
@@ -58,7 +62,7 @@ class FeatureMapping(Base):  # type: ignore
 
     id = Column(Integer, primary_key=True)
     img_id = Column(String(50), ForeignKey('images.img_id'))
-    features = Column(Text)
+    features = Column(LargeBinary)
     time_created = Column(DateTime(timezone=True), server_default=func.now())
     img = relationship('Image', back_populates='feature_mappings')
 
@@ -68,13 +72,50 @@ class Match(Base):  # type: ignore
 
     id = Column(Integer, primary_key=True)
     this_img_id = Column(String(50), ForeignKey('images.img_id'))
-    that_img_id = Column(String(50), ForeignKey('images.img_id'))
-    distance_score = Column(Float)
+    that_img_id = Column(String(50), ForeignKey('images.img_id'), index=True)
+    # double precision so that distances round-trip exactly in cursors
+    distance_score = Column(Float(precision=53))
     time_created = Column(DateTime(timezone=True), server_default=func.now())
     this_img = relationship('Image', foreign_keys=[this_img_id])
     that_img = relationship('Image', foreign_keys=[that_img_id])
-    __table_args__ = (UniqueConstraint(
-        'this_img_id', 'that_img_id', name='_this_that_uc'),)
+    __table_args__ = (
+        UniqueConstraint('this_img_id', 'that_img_id', name='_this_that_uc'),
+        Index('ix_matches_this_distance',
+              'this_img_id', 'distance_score', 'that_img_id'),
+        Index('ix_matches_that_distance',
+              'that_img_id', 'distance_score', 'this_img_id'),
+    )
+
+
+class PendingDeletion(Base):  # type: ignore
+    __tablename__ = 'pendingdeletions'
+
+    id = Column(Integer, primary_key=True)
+    img_id = Column(String(50))
+    object_name = Column(String(100), default=None)
+    time_created = Column(DateTime(timezone=True), server_default=func.now())
+
+
+class PerceptualHash(Base):  # type: ignore
+    __tablename__ = 'perceptualhashes'
+
+    id = Column(Integer, primary_key=True)
+    img_id = Column(String(50), ForeignKey('images.img_id'), index=True)
+    band = Column(Integer)
+    value = Column(Integer)
+    __table_args__ = (
+        Index('ix_perceptualhashes_band_value', 'band', 'value'),
+    )
+
+
+class StageTiming(Base):  # type: ignore
+    __tablename__ = 'stagetimings'
+
+    id = Column(Integer, primary_key=True)
+    stage = Column(String(50), index=True)
+    num_images = Column(Integer)
+    seconds = Column(Float)
+    time_created = Column(DateTime(timezone=True), server_default=func.now())
 
 
 class FaceApiMapping(Base):  # type: ignore
@@ -91,6 +132,7 @@ class ImageStatusEnum(Enum):
     processing = auto()
     uploaded = auto()
     face_vector_computed = auto()
+    failed = auto()
 
 
 @lru_cache(maxsize=1)
@@ -112,7 +154,7 @@ def delete_models():
 
 # pylint: disable=broad-except
 @contextmanager
-def get_db_session(commit=False) -> Session:
+def get_db_session(commit=False, reraise=False) -> Session:
     _, session_factory = _connect()
     session = session_factory()
     try:
@@ -120,6 +162,8 @@ def get_db_session(commit=False) -> Session:
     except Exception:
         logger.exception('Error during session, rolling back')
         session.rollback()
+        if reraise:
+            raise
     else:
         if commit:
             try:
@@ -127,6 +171,8 @@ def get_db_session(commit=False) -> Session:
             except SQLAlchemyError:
                 logger.exception('Error during session commit, rolling back')
                 session.rollback()
+                if reraise:
+                    raise
             else:
                 logger.debug('Session committed successfully')
     finally:
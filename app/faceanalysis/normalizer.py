@@ -0,0 +1,119 @@
+from contextlib import contextmanager
+from tempfile import mkstemp
+from typing import Iterator
+from typing import List
+from typing import Optional
+import os
+
+from PIL import Image as PILImage
+import numpy as np
+
+from faceanalysis.log import get_logger
+from faceanalysis.settings import IMAGE_NORMALIZE_EQUALIZE
+from faceanalysis.settings import IMAGE_NORMALIZE_MAX_SIDE
+
+logger = get_logger(__name__)
+
+# normalized copies are written next to the image so that they are within
+# the data directory which is mounted into the vectorizer containers
+_NORMALIZED_DIRNAME = '.normalized'
+_JPEG_QUALITY = 95
+
+_EXIF_ORIENTATION = 0x0112
+_ORIENTATION_TRANSPOSES = {
+    2: PILImage.FLIP_LEFT_RIGHT,
+    3: PILImage.ROTATE_180,
+    4: PILImage.FLIP_TOP_BOTTOM,
+    5: PILImage.TRANSPOSE,
+    6: PILImage.ROTATE_270,
+    7: PILImage.TRANSVERSE,
+    8: PILImage.ROTATE_90,
+}
+
+
+def _get_orientation(image: PILImage.Image) -> int:
+    # only jpegs carry exif data and broken exif data is best ignored
+    # pylint: disable=broad-except,protected-access
+    try:
+        exif = image._getexif()  # type: ignore
+    except Exception:
+        return 1
+    # pylint: enable=broad-except,protected-access
+    return (exif or {}).get(_EXIF_ORIENTATION, 1)
+
+
+def _equalize(image: PILImage.Image) -> PILImage.Image:
+    # same contrast limited adaptive histogram equalization as the
+    # preprocessor script, scikit-image is only needed when it's enabled
+    from skimage import exposure
+
+    equalized = exposure.equalize_adapthist(np.asarray(image))
+    return PILImage.fromarray((equalized * 255).astype(np.uint8))
+
+
+def normalize_image(img_path: str,
+                    max_side: int = IMAGE_NORMALIZE_MAX_SIDE,
+                    equalize: bool = IMAGE_NORMALIZE_EQUALIZE) \
+        -> Optional[str]:
+    """Write the image the way it should be vectorized to a new file.
+
+    The image is rotated upright according to its exif orientation, shrunk
+    to at most max_side pixels on its longest side (0 to keep its size) and
+    optionally equalized. None is returned when the image can be vectorized
+    as it is.
+    """
+    if not os.path.isfile(img_path):
+        return None
+
+    with PILImage.open(img_path) as image:
+        transpose = _ORIENTATION_TRANSPOSES.get(_get_orientation(image))
+        is_too_large = 0 < max_side < max(image.size)
+        if transpose is None and not is_too_large and not equalize:
+            return None
+
+        # let the jpeg decoder skip the resolution we'll throw away anyways
+        if is_too_large:
+            image.draft('RGB', (max_side, max_side))
+
+        normalized = image.convert('RGB')
+
+    if transpose is not None:
+        normalized = normalized.transpose(transpose)
+    if is_too_large:
+        normalized.thumbnail((max_side, max_side), PILImage.LANCZOS)
+    if equalize:
+        normalized = _equalize(normalized)
+
+    directory = os.path.join(os.path.dirname(img_path), _NORMALIZED_DIRNAME)
+    os.makedirs(directory, exist_ok=True)
+    fd, normalized_path = mkstemp(suffix='.jpg', dir=directory)
+    with os.fdopen(fd, 'wb') as fobj:
+        normalized.save(fobj, 'JPEG', quality=_JPEG_QUALITY)
+
+    return normalized_path
+
+
+@contextmanager
+def normalized_images(img_paths: List[str]) -> Iterator[List[str]]:
+    """Paths of the images to vectorize, removed again on exit."""
+
+    normalized_paths = []  # type: List[str]
+    try:
+        paths = []  # type: List[str]
+        for img_path in img_paths:
+            try:
+                normalized_path = normalize_image(img_path)
+            except OSError:
+                logger.exception("Can't normalize image %s", img_path)
+                normalized_path = None
+
+            if normalized_path is None:
+                paths.append(img_path)
+            else:
+                normalized_paths.append(normalized_path)
+                paths.append(normalized_path)
+
+        yield paths
+    finally:
+        for normalized_path in normalized_paths:
+            os.remove(normalized_path)
@@ -0,0 +1,98 @@
+from typing import Iterable
+from typing import List
+from typing import Optional
+import os
+
+from PIL import Image as PILImage
+from sqlalchemy import and_
+from sqlalchemy import or_
+from sqlalchemy.orm import Session
+import dhash
+
+from faceanalysis.log import get_logger
+from faceanalysis.models import ImageStatus
+from faceanalysis.models import ImageStatusEnum
+from faceanalysis.models import PerceptualHash
+
+logger = get_logger(__name__)
+
+# a dhash of size 8 has 128 bits which are indexed as 8 bands of 16 bits:
+# two hashes within a hamming distance of 7 share at least one band
+_HASH_SIZE = 8
+_BAND_BITS = 16
+_NUM_BANDS = 2 * _HASH_SIZE * _HASH_SIZE // _BAND_BITS
+MAX_RADIUS = _NUM_BANDS - 1
+
+
+def compute_perceptual_hash(img_path: str) -> Optional[int]:
+    # remote storage providers hand out urls, only stage images locally
+    if not os.path.isfile(img_path):
+        logger.debug("Can't hash image %s which isn't a local file",
+                     img_path)
+        return None
+
+    try:
+        with PILImage.open(img_path) as image:
+            return dhash.dhash_int(image, size=_HASH_SIZE)
+    except OSError:
+        logger.exception("Can't hash image %s", img_path)
+        return None
+
+
+def format_perceptual_hash(perceptual_hash: int) -> str:
+    return '{:032x}'.format(perceptual_hash)
+
+
+def _bands(perceptual_hash: int) -> List[int]:
+    mask = (1 << _BAND_BITS) - 1
+    return [(perceptual_hash >> (band * _BAND_BITS)) & mask
+            for band in range(_NUM_BANDS)]
+
+
+def find_similar_image(session: Session,
+                       perceptual_hash: int,
+                       radius: int) -> Optional[str]:
+    """Closest processed image whose hash is within radius bits, if any.
+
+    Candidates share at least one band with the hash and are then checked
+    against the full hash.
+    """
+    if radius > MAX_RADIUS:
+        raise ValueError('Near duplicates are indexed up to a radius of {}'
+                         .format(MAX_RADIUS))
+
+    bands = _bands(perceptual_hash)
+    candidates = session.query(ImageStatus.img_id,
+                               ImageStatus.perceptual_hash) \
+        .join(PerceptualHash, PerceptualHash.img_id == ImageStatus.img_id) \
+        .filter(or_(*(and_(PerceptualHash.band == band,
+                           PerceptualHash.value == value)
+                      for band, value in enumerate(bands)))) \
+        .filter(ImageStatus.status ==
+                ImageStatusEnum.finished_processing.name) \
+        .distinct() \
+        .all()
+
+    closest = None
+    closest_distance = radius + 1
+    for img_id, candidate_hash in candidates:
+        distance = dhash.get_num_bits_different(
+            perceptual_hash, int(candidate_hash, 16))
+        if distance < closest_distance:
+            closest, closest_distance = img_id, distance
+
+    return closest
+
+
+def index_images(session: Session, img_ids: Iterable[str]):
+    rows = session.query(ImageStatus.img_id, ImageStatus.perceptual_hash) \
+        .filter(ImageStatus.img_id.in_(list(img_ids))) \
+        .filter(ImageStatus.perceptual_hash.isnot(None)) \
+        .all()
+
+    bands = [{'img_id': img_id, 'band': band, 'value': value}
+             for img_id, perceptual_hash in rows
+             for band, value in enumerate(_bands(int(perceptual_hash, 16)))]
+
+    if bands:
+        session.execute(PerceptualHash.__table__.insert(), bands)
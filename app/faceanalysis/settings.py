@@ -11,11 +11,50 @@ IMAGE_PROCESSOR_CONCURRENCY = int(environ.get(
     'IMAGE_PROCESSOR_CONCURRENCY',
     '3'))
 IMAGE_PROCESSOR_QUEUE = environ.get('IMAGE_PROCESSOR_QUEUE', 'faceanalysis')
+IMAGE_PRIORITY_CHECK_INTERVAL = float(environ.get(
+    'IMAGE_PRIORITY_CHECK_INTERVAL',
+    '1'))
+IMAGE_BATCH_SIZE = int(environ.get('IMAGE_BATCH_SIZE', '1'))
+IMAGE_BATCH_MAX_LATENCY = float(environ.get('IMAGE_BATCH_MAX_LATENCY', '5'))
+MATCH_STORAGE_MODE = environ.get('MATCH_STORAGE_MODE', 'symmetric')
+MATCH_SHARDS = int(environ.get('MATCH_SHARDS', '0'))
+MATCH_WORKER_SHARDS = [int(shard) for shard in
+                       environ.get('MATCH_WORKER_SHARDS', '').split(';')
+                       if shard]
+MATCH_WORKER_CONCURRENCY = int(environ.get('MATCH_WORKER_CONCURRENCY', '1'))
 CELERY_BROKER = 'pyamqp://{user}:{password}@{host}'.format(
     user=environ.get('RABBITMQ_USER', 'guest'),
     password=environ.get('RABBITMQ_PASSWORD', 'guest'),
     host=environ['RABBITMQ_HOST'])
 
+SEARCH_TIMEOUT = float(environ.get('SEARCH_TIMEOUT', '1'))
+SEARCH_WORKER_CONCURRENCY = int(environ.get('SEARCH_WORKER_CONCURRENCY', '1'))
+IMAGE_CACHE_DIR = environ.get('IMAGE_CACHE_DIR', '')
+IMAGE_CACHE_MAX_BYTES = int(environ.get('IMAGE_CACHE_MAX_BYTES',
+                                        str(1024 * 1024 * 1024)))
+IMAGE_CACHE_PREFETCH_THREADS = int(environ.get('IMAGE_CACHE_PREFETCH_THREADS',
+                                               '2'))
+IMAGE_CACHE_DOWNLOAD_TIMEOUT = float(environ.get(
+    'IMAGE_CACHE_DOWNLOAD_TIMEOUT',
+    '300'))
+IMAGE_NORMALIZE_MAX_SIDE = int(environ.get('IMAGE_NORMALIZE_MAX_SIDE', '0'))
+IMAGE_NORMALIZE_EQUALIZE = environ.get('IMAGE_NORMALIZE_EQUALIZE') == 'TRUE'
+VECTOR_CACHE_PATH = environ.get('VECTOR_CACHE_PATH', '')
+VECTOR_CACHE_MAX_BYTES = int(environ.get('VECTOR_CACHE_MAX_BYTES',
+                                         str(256 * 1024 * 1024)))
+DELETER_INTERVAL = float(environ.get('DELETER_INTERVAL', '10'))
+DELETER_BATCH_SIZE = int(environ.get('DELETER_BATCH_SIZE', '500'))
+DELETER_CONCURRENCY = int(environ.get('DELETER_CONCURRENCY', '8'))
+UPLOAD_DEDUPLICATION = environ.get('UPLOAD_DEDUPLICATION', 'off')
+NEAR_DUPLICATE_DETECTION = environ.get('NEAR_DUPLICATE_DETECTION') == 'TRUE'
+NEAR_DUPLICATE_RADIUS = int(environ.get('NEAR_DUPLICATE_RADIUS', '4'))
+UPLOAD_CONCURRENCY = int(environ.get('UPLOAD_CONCURRENCY', '8'))
+IMAGE_EXPORT_BATCH_SIZE = int(environ.get('IMAGE_EXPORT_BATCH_SIZE', '1000'))
+CACHE_URL = environ.get('CACHE_URL', '')
+CACHE_MAX_SIZE = int(environ.get('CACHE_MAX_SIZE', '10000'))
+CACHE_TTL = float(environ.get('CACHE_TTL', '60'))
+BULK_REQUEST_MAX_IMG_IDS = int(environ.get('BULK_REQUEST_MAX_IMG_IDS', '1000'))
+
 ALLOWED_MIMETYPES = set(
     environ.get('ALLOWED_IMAGE_MIMETYPES', '')
     .lower().split(';')) - {''}
@@ -23,9 +62,25 @@ ALLOWED_MIMETYPES = set(
 DISTANCE_SCORE_THRESHOLD = float(environ.get(
     'DISTANCE_SCORE_THRESHOLD',
     '0.6'))
+MATCHER_BACKEND = environ.get('MATCHER_BACKEND', 'exact')
+MATCHER_IVF_LISTS = int(environ.get('MATCHER_IVF_LISTS', '1024'))
+MATCHER_IVF_PROBES = int(environ.get('MATCHER_IVF_PROBES', '32'))
+MATCHER_PQ_SUBVECTORS = int(environ.get('MATCHER_PQ_SUBVECTORS', '16'))
+MATCHER_RERANK_MARGIN = float(environ.get('MATCHER_RERANK_MARGIN', '0.1'))
+GALLERY_INDEX_PATH = environ.get('GALLERY_INDEX_PATH', '')
+GALLERY_INDEX_SAVE_INTERVAL = int(environ.get(
+    'GALLERY_INDEX_SAVE_INTERVAL',
+    '300'))
+GALLERY_SHARED_DIR = environ.get('GALLERY_SHARED_DIR', '')
 FACE_VECTORIZE_ALGORITHM = environ.get(
     'FACE_VECTORIZE_ALGORITHM',
     'cwolff/face_recognition')
+FACE_VECTORIZE_PREALIGNED = environ.get(
+    'FACE_VECTORIZE_PREALIGNED', '').lower() == 'true'
+FACE_VECTORIZE_SERVICE_URL = environ.get('FACE_VECTORIZE_SERVICE_URL', '')
+FACE_VECTORIZE_SERVICE_TIMEOUT = int(environ.get(
+    'FACE_VECTORIZE_SERVICE_TIMEOUT',
+    '300'))
 
 TOKEN_SECRET_KEY = environ.get('TOKEN_SECRET_KEY', '')
 TOKEN_EXPIRATION = int(environ.get(
@@ -39,6 +94,9 @@ SQLALCHEMY_CONNECTION_STRING = (
             host=environ['MYSQL_HOST'],
             database=environ['MYSQL_DATABASE']))
 
+CELERY_RESULT_BACKEND = 'db+' + SQLALCHEMY_CONNECTION_STRING
+CELERY_RESULT_EXPIRES = int(environ.get('CELERY_RESULT_EXPIRES', '3600'))
+
 STORAGE_PROVIDER = environ.get('STORAGE_PROVIDER', 'LOCAL')
 STORAGE_KEY = environ.get('STORAGE_KEY', dirname(abspath(__file__)))
 STORAGE_SECRET = environ.get('STORAGE_SECRET', '')
@@ -1,15 +1,22 @@
+from concurrent.futures import ThreadPoolExecutor
 from functools import lru_cache
+from hashlib import sha256
 from typing import IO
+from typing import List
+from typing import Optional
+from typing import Tuple
 
 from libcloud.storage.base import Container
 from libcloud.storage.base import Object
 from libcloud.storage.providers import get_driver
 from libcloud.storage.types import ContainerAlreadyExistsError
+from libcloud.storage.types import ObjectDoesNotExistError
 from libcloud.storage.types import ObjectError
 from libcloud.storage.types import Provider
 
 from faceanalysis.log import get_logger
 from faceanalysis.settings import ALLOWED_MIMETYPES
+from faceanalysis.settings import DELETER_CONCURRENCY
 from faceanalysis.settings import STORAGE_PROVIDER
 from faceanalysis.settings import STORAGE_KEY
 from faceanalysis.settings import STORAGE_SECRET
@@ -36,8 +43,17 @@ def _get_storage_service() -> Container:
     return storage_container
 
 
-def _get_image(img_id: str) -> Object:
+def _get_image(img_id: str, image_name: Optional[str] = None) -> Object:
     container = _get_storage_service()
+
+    if image_name is not None:
+        try:
+            return container.get_object(image_name)
+        except ObjectError as ex:
+            raise StorageError('Image {} does not exist'
+                               .format(img_id)) from ex
+
+    # images uploaded before their object name was recorded
     for extension in allowed_extensions:
         image_name = '{}.{}'.format(img_id, extension)
         try:
@@ -50,18 +66,34 @@ def _get_image(img_id: str) -> Object:
     raise StorageError('Image {} does not exist'.format(img_id))
 
 
-def store_image(iterator: IO[bytes], image_name: str):
+class _HashingReader:  # pylint: disable=too-few-public-methods
+    def __init__(self, stream: IO[bytes]) -> None:
+        self.stream = stream
+        self.hash = sha256()
+
+    def read(self, size: int = -1) -> bytes:
+        data = self.stream.read(size)
+        self.hash.update(data)
+        return data
+
+
+def store_image(iterator: IO[bytes], image_name: str) -> str:
+    """Store an image and return the SHA-256 of its content, computed
+    while the content is streamed to the storage."""
+
     container = _get_storage_service()
+    reader = _HashingReader(iterator)
     try:
-        container.upload_object_via_stream(iterator, image_name)
+        container.upload_object_via_stream(reader, image_name)
     except (ObjectError, OSError) as ex:
         raise StorageError('Unable to store {}'.format(image_name)) from ex
 
     logger.debug('Stored image %s', image_name)
+    return reader.hash.hexdigest()
 
 
-def delete_image(img_id: str):
-    image = _get_image(img_id)
+def delete_image(img_id: str, image_name: Optional[str] = None):
+    image = _get_image(img_id, image_name)
 
     if not image.delete():
         raise StorageError('Unable to delete image {}'.format(img_id))
@@ -69,6 +101,60 @@ def delete_image(img_id: str):
     logger.debug('Removed image %s', img_id)
 
 
-def get_image_path(img_id: str) -> str:
-    image = _get_image(img_id)
+def _delete_image_if_exists(img_id: str, image_name: Optional[str]) -> bool:
+    try:
+        image = _get_image(img_id, image_name)
+    except StorageError as ex:
+        # deleted by an earlier attempt
+        return isinstance(ex.__cause__, ObjectDoesNotExistError) \
+            or image_name is None
+    except OSError:
+        logger.exception('Unable to look up image %s', img_id)
+        return False
+
+    try:
+        return image.delete()
+    except ObjectDoesNotExistError:
+        return True
+    except (ObjectError, OSError):
+        logger.exception('Unable to delete image %s', img_id)
+        return False
+
+
+def delete_images(images: List[Tuple[str, Optional[str]]]) -> List[str]:
+    """Delete many images at once and return the ids of the deleted ones.
+
+    libcloud has no bulk delete so the deletions are issued concurrently.
+    Images that are already gone count as deleted.
+    """
+    if not images:
+        return []
+
+    with ThreadPoolExecutor(max_workers=DELETER_CONCURRENCY) as executor:
+        is_deleted = list(executor.map(
+            lambda image: _delete_image_if_exists(*image), images))
+
+    deleted = [img_id for (img_id, _), ok in zip(images, is_deleted) if ok]
+    logger.debug('Removed %d of %d images', len(deleted), len(images))
+    return deleted
+
+
+def download_image(img_id: str, destination: str,
+                   image_name: Optional[str] = None):
+    image = _get_image(img_id, image_name)
+
+    try:
+        is_downloaded = image.download(destination, overwrite_existing=True)
+    except (ObjectError, OSError) as ex:
+        raise StorageError('Unable to download image {}'
+                           .format(img_id)) from ex
+
+    if not is_downloaded:
+        raise StorageError('Unable to download image {}'.format(img_id))
+
+    logger.debug('Downloaded image %s', img_id)
+
+
+def get_image_path(img_id: str, image_name: Optional[str] = None) -> str:
+    image = _get_image(img_id, image_name)
     return image.get_cdn_url()
@@ -1,14 +1,346 @@
+from datetime import datetime
+from threading import Thread
+from time import sleep
+from time import time
+from typing import Dict
+from typing import List
+from typing import Optional
+from typing import Tuple
+from typing import Union
+
 from celery import Celery
+from celery import chord
+from celery import group
+from celery.backends.rpc import RPCBackend
+from celery.signals import worker_ready
+from celery.worker.request import Request
 
 from faceanalysis import face_matcher
+from faceanalysis.log import get_logger
 from faceanalysis.settings import CELERY_BROKER
+from faceanalysis.settings import CELERY_RESULT_BACKEND
+from faceanalysis.settings import CELERY_RESULT_EXPIRES
+from faceanalysis.settings import IMAGE_BATCH_SIZE
+from faceanalysis.settings import IMAGE_PRIORITY_CHECK_INTERVAL
 from faceanalysis.settings import IMAGE_PROCESSOR_QUEUE
+from faceanalysis.settings import MATCH_SHARDS
+from faceanalysis.timings import QueueWait
+from faceanalysis.timings import get_stage_timings
 
+QueueMetrics = Dict[str, Union[str, int, Optional[float]]]
+logger = get_logger(__name__)
 
-celery = Celery('pipeline', broker=CELERY_BROKER)
+celery = Celery('pipeline', broker=CELERY_BROKER,
+                backend=CELERY_RESULT_BACKEND)
 celery.conf.task_default_queue = IMAGE_PROCESSOR_QUEUE
+# only the results of the shard matches and of searches are ever read, they
+# are removed by delete_expired_results if nobody picks them up
+celery.conf.task_ignore_result = True
+celery.conf.result_expires = CELERY_RESULT_EXPIRES
+
+# images are processed from one queue per priority, workers only take bulk
+# images while there are no interactive images waiting
+INTERACTIVE_PRIORITY = 'interactive'
+BULK_PRIORITY = 'bulk'
+PRIORITIES = (INTERACTIVE_PRIORITY, BULK_PRIORITY)
+
+
+def _get_priority_suffix(priority: str) -> str:
+    # interactive images keep the queues used before there were priorities
+    if priority == INTERACTIVE_PRIORITY:
+        return ''
+    return '_{}'.format(priority)
+
+
+def get_process_queue(priority: str = INTERACTIVE_PRIORITY) -> str:
+    return '{}{}'.format(IMAGE_PROCESSOR_QUEUE,
+                         _get_priority_suffix(priority))
+
+
+def get_wait_stage(priority: str) -> str:
+    return '{}_wait'.format(priority)
+
+
+def get_match_queue(shard: int) -> str:
+    return '{}_match_{}'.format(IMAGE_PROCESSOR_QUEUE, shard)
+
+
+def get_search_queue() -> str:
+    return '{}_search'.format(IMAGE_PROCESSOR_QUEUE)
+
+
+def get_merge_queue() -> str:
+    return '{}_merge'.format(IMAGE_PROCESSOR_QUEUE)
+
+
+# the matchworkers poll for finished shard matches and merge them, so that
+# the polling doesn't take up the processes of the image queues
+celery.conf.task_routes = {
+    'celery.chord_unlock': {'queue': get_merge_queue()},
+}
+
+
+def get_batch_queue(priority: str = INTERACTIVE_PRIORITY) -> str:
+    return '{}_batch{}'.format(IMAGE_PROCESSOR_QUEUE,
+                               _get_priority_suffix(priority))
+
+
+def queue_image(img_id: str, priority: str = INTERACTIVE_PRIORITY):
+    queue_images([img_id], priority)
+
+
+def queue_images(img_ids: List[str], priority: str = INTERACTIVE_PRIORITY):
+    queued_at = time()
+
+    if IMAGE_BATCH_SIZE <= 1:
+        with celery.producer_or_acquire() as producer:
+            for img_id in img_ids:
+                process_image.apply_async((img_id, priority, queued_at),
+                                          queue=get_process_queue(priority),
+                                          producer=producer)
+        return
+
+    # the batcher drains this queue into process_image_batch tasks
+    with celery.connection_for_write() as connection:
+        with connection.SimpleQueue(get_batch_queue(priority)) as queue:
+            for img_id in img_ids:
+                queue.put({'img_id': img_id, 'queued_at': queued_at})
+
+
+class _PrefetchingRequest(Request):
+    """Prefetches the images of a task in the worker's main process as soon
+    as it reserves the task, i.e. while the pool processes are busy."""
+
+    def __init__(self, *args, **kwargs) -> None:
+        super().__init__(*args, **kwargs)
+
+        # the payload of a task message is the tuple (args, kwargs, embed)
+        args = self._payload[0]
+        if self.name == process_image.name:
+            img_ids = [args[0]]
+        else:
+            img_ids = args[0]
+
+        face_matcher.prefetch_images(img_ids)
+
+
+def _get_wait(priority: str, queued_at: Optional[List[float]]) \
+        -> Optional[QueueWait]:
+    if not queued_at:
+        return None
+    return get_wait_stage(priority), queued_at
+
+
+@celery.task(Request=_PrefetchingRequest)
+def process_image(img_id: str,
+                  priority: str = INTERACTIVE_PRIORITY,
+                  queued_at: Optional[float] = None):
+
+    wait = _get_wait(priority, [queued_at] if queued_at is not None else None)
+
+    if not MATCH_SHARDS:
+        face_matcher.process_image(img_id, wait)
+        return
+
+    face_vectors = face_matcher.store_face_vectors(img_id, wait)
+    if face_vectors is None:
+        return
+
+    if not face_vectors:
+        face_matcher.store_matches(img_id, False, [])
+        return
+
+    chord(match_shard.signature((shard, img_id, face_vectors),
+                                queue=get_match_queue(shard))
+          for shard in range(MATCH_SHARDS))(
+              merge_matches.signature((img_id,), queue=get_merge_queue()))
+
+
+@celery.task(Request=_PrefetchingRequest)
+def process_image_batch(img_ids: List[str],
+                        priority: str = INTERACTIVE_PRIORITY,
+                        queued_at: Optional[List[float]] = None):
+
+    wait = _get_wait(priority, queued_at)
+
+    if not MATCH_SHARDS:
+        face_matcher.process_images(img_ids, wait)
+        return
+
+    img_ids, face_vectors = face_matcher.store_batch_face_vectors(img_ids,
+                                                                  wait)
+    if not img_ids:
+        return
+
+    has_faces = [bool(vectors) for vectors in face_vectors]
+    if not any(has_faces):
+        face_matcher.store_batch_matches(img_ids, has_faces,
+                                         [[] for _ in img_ids])
+        return
+
+    chord(match_shard_batch.signature((shard, img_ids, face_vectors),
+                                      queue=get_match_queue(shard))
+          for shard in range(MATCH_SHARDS))(
+              merge_batch_matches.signature((img_ids, has_faces),
+                                            queue=get_merge_queue()))
+
+
+# the api process waits for search results so they are sent straight back
+# to it over the broker instead of being polled from the database
+@celery.task(backend=RPCBackend(celery), ignore_result=False)
+def search_faces(face_vectors: List[List[float]], limit: Optional[int]):
+    return face_matcher.search_faces(face_vectors, limit)
+
+
+def search(face_vectors: List[List[float]],
+           limit: Optional[int],
+           timeout: float) -> List[Tuple[str, float]]:
+
+    if not MATCH_SHARDS:
+        result = search_faces.apply_async((face_vectors, limit),
+                                          queue=get_search_queue())
+        # the pairs come back as json lists
+        return [(str(that_img_id), float(distance))
+                for that_img_id, distance in result.get(timeout=timeout)]
+
+    result = group(match_shard.signature((shard, '', face_vectors),
+                                         queue=get_match_queue(shard))
+                   for shard in range(MATCH_SHARDS))()
+    try:
+        shard_matches = result.get(timeout=timeout, interval=0.01)
+    finally:
+        result.forget()
+
+    matches = sorted((distance, that_img_id)
+                     for matches in shard_matches
+                     for that_img_id, distance in matches)
+    return [(that_img_id, distance)
+            for distance, that_img_id in matches[:limit]]
+
+
+@celery.task(ignore_result=False)
+def match_shard(shard: int, img_id: str, face_vectors: List[List[float]]):
+    return face_matcher.find_shard_matches(shard, img_id, face_vectors)
+
+
+@celery.task(ignore_result=False)
+def match_shard_batch(shard: int,
+                      img_ids: List[str],
+                      face_vectors: List[List[List[float]]]):
+    return face_matcher.find_shard_batch_matches(shard, img_ids, face_vectors)
+
+
+@celery.task
+def merge_matches(shard_matches: List[List[list]], img_id: str):
+    matches = [(that_img_id, distance_score)
+               for matches in shard_matches
+               for that_img_id, distance_score in matches]
+    face_matcher.store_matches(img_id, True, matches)
+
+
+@celery.task
+def merge_batch_matches(shard_matches: List[List[List[list]]],
+                        img_ids: List[str],
+                        has_faces: List[bool]):
+    # every shard returns the matches of every image of the batch
+    matches = [[] for _ in img_ids]  # type: List[List[Tuple[str, float]]]
+    for batch_matches in shard_matches:
+        for image_matches, shard_image_matches in zip(matches, batch_matches):
+            image_matches.extend((that_img_id, distance_score)
+                                 for that_img_id, distance_score
+                                 in shard_image_matches)
+    face_matcher.store_batch_matches(img_ids, has_faces, matches)
+
+
+def delete_expired_results():
+    """Remove the results that nobody read before they expired, e.g. the
+    ones of searches that timed out."""
+
+    celery.backend.cleanup()
+
+
+def _get_queue_depth(connection, queue: str) -> int:
+    with connection.channel() as channel:
+        try:
+            _, depth, _ = channel.queue_declare(queue=queue, passive=True)
+        except connection.channel_errors:
+            # queues are only declared once the first message is sent
+            return 0
+    return depth
+
+
+def get_queue_depths() -> Dict[str, int]:
+    """Images waiting in the queues of every priority, including the images
+    waiting to be batched."""
+
+    depths = {}  # type: Dict[str, int]
+    with celery.connection_for_read() as connection:
+        for priority in PRIORITIES:
+            depths[priority] = sum(
+                _get_queue_depth(connection, queue)
+                for queue in (get_process_queue(priority),
+                              get_batch_queue(priority)))
+    return depths
+
+
+def get_queue_metrics(since: Optional[datetime] = None) \
+        -> Dict[str, QueueMetrics]:
+
+    depths = get_queue_depths()
+    timings = get_stage_timings(since)
+
+    metrics = {}  # type: Dict[str, QueueMetrics]
+    for priority in PRIORITIES:
+        waits = timings.get(get_wait_stage(priority), {})
+        metrics[priority] = {
+            'queue': get_process_queue(priority),
+            'depth': depths[priority],
+            'images': waits.get('images', 0),
+            'wait_seconds_per_image': waits.get('seconds_per_image'),
+        }
+    return metrics
+
+
+def _prefer_interactive_images(consumer, interval: float):
+    bulk_queue = get_process_queue(BULK_PRIORITY)
+    interactive_queue = get_process_queue(INTERACTIVE_PRIORITY)
+    is_consuming_bulk = True
+
+    while True:
+        sleep(interval)
+        # pylint: disable=broad-except
+        try:
+            with celery.connection_for_read() as connection:
+                backlog = _get_queue_depth(connection, interactive_queue)
+        except Exception:
+            logger.exception("Can't get the depth of queue %s",
+                             interactive_queue)
+            continue
+        # pylint: enable=broad-except
+
+        # processes that are done with their bulk image pick up the waiting
+        # interactive images once the worker stops taking bulk images
+        should_consume_bulk = backlog == 0
+        if should_consume_bulk == is_consuming_bulk:
+            continue
+
+        if should_consume_bulk:
+            consumer.call_soon(consumer.add_task_queue, bulk_queue)
+            logger.debug('Resuming bulk queue %s', bulk_queue)
+        else:
+            consumer.call_soon(consumer.cancel_task_queue, bulk_queue)
+            logger.debug('Pausing bulk queue %s for %d interactive images',
+                         bulk_queue, backlog)
+        is_consuming_bulk = should_consume_bulk
+
 
+@worker_ready.connect
+def start_priority_scheduling(sender=None, **_):
+    # only the workers consuming the bulk queue have anything to prefer
+    if get_process_queue(BULK_PRIORITY) not in \
+            sender.app.amqp.queues.consume_from:
+        return
 
-@celery.task(ignore_result=True)
-def process_image(img_id: str):
-    face_matcher.process_image(img_id)
+    Thread(target=_prefer_interactive_images,
+           args=(sender, IMAGE_PRIORITY_CHECK_INTERVAL),
+           daemon=True).start()
@@ -0,0 +1,71 @@
+from contextlib import contextmanager
+from datetime import datetime
+from time import monotonic
+from time import time
+from typing import Dict
+from typing import Iterator
+from typing import List
+from typing import Optional
+from typing import Tuple
+from typing import Union
+
+from sqlalchemy.orm import Session
+from sqlalchemy.sql import func
+
+from faceanalysis.log import get_logger
+from faceanalysis.models import StageTiming
+from faceanalysis.models import get_db_session
+
+logger = get_logger(__name__)
+
+NORMALIZE_STAGE = 'normalize'
+VECTORIZE_STAGE = 'vectorize'
+
+# the stage a queue wait is recorded as and when each image was queued
+QueueWait = Tuple[str, List[float]]
+
+
+@contextmanager
+def timed_stage(session: Session, stage: str, num_images: int) \
+        -> Iterator[None]:
+    """Record how long a processing stage took for a number of images.
+
+    The timing is written with the session so it is only kept when the
+    processing of the images is committed.
+    """
+    start = monotonic()
+    yield
+    record_stage_timing(session, stage, num_images, monotonic() - start)
+
+
+def record_stage_timing(session: Session, stage: str, num_images: int,
+                        seconds: float):
+    session.add(StageTiming(stage=stage, num_images=num_images,
+                            seconds=seconds))
+    logger.debug('Stage %s took %.3f seconds for %d images',
+                 stage, seconds, num_images)
+
+
+def record_queue_wait(session: Session, wait: QueueWait):
+    stage, queued_at = wait
+    now = time()
+    record_stage_timing(session, stage, len(queued_at),
+                        sum(now - timestamp for timestamp in queued_at))
+
+
+def get_stage_timings(since: Optional[datetime] = None) \
+        -> Dict[str, Dict[str, Union[int, Optional[float]]]]:
+
+    rows = []  # type: List[tuple]
+    with get_db_session() as session:
+        query = session.query(StageTiming.stage,
+                              func.sum(StageTiming.num_images),
+                              func.sum(StageTiming.seconds))
+        if since is not None:
+            query = query.filter(StageTiming.time_created >= since)
+        rows = query.group_by(StageTiming.stage).all()
+
+    return {stage: {'images': int(num_images or 0),
+                    'seconds_per_image': (float(seconds) / int(num_images)
+                                          if num_images else None)}
+            for stage, num_images, seconds in rows}
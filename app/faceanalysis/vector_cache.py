@@ -0,0 +1,172 @@
+from functools import lru_cache
+from hashlib import sha256
+from time import time
+from typing import Dict
+from typing import Iterable
+from typing import List
+from typing import Optional
+import os
+import sqlite3
+
+from faceanalysis.log import get_logger
+from faceanalysis.settings import VECTOR_CACHE_MAX_BYTES
+from faceanalysis.settings import VECTOR_CACHE_PATH
+
+logger = get_logger(__name__)
+
+_HASH_CHUNK_SIZE = 1024 * 1024
+_EVICTION_BATCH_SIZE = 1000
+# rough size of the key and the bookkeeping of an entry in the database
+_ENTRY_OVERHEAD_BYTES = 128
+
+_SCHEMA = '''
+CREATE TABLE IF NOT EXISTS vectors (
+    content_hash TEXT NOT NULL,
+    algorithm TEXT NOT NULL,
+    prealigned INTEGER NOT NULL,
+    face_vectors BLOB NOT NULL,
+    size INTEGER NOT NULL,
+    last_used REAL NOT NULL,
+    PRIMARY KEY (content_hash, algorithm, prealigned)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS ix_vectors_last_used ON vectors (last_used);
+'''
+
+
+def hash_file(path: str) -> Optional[str]:
+    if not os.path.isfile(path):
+        return None
+
+    content_hash = sha256()
+    with open(path, 'rb') as fobj:
+        for chunk in iter(lambda: fobj.read(_HASH_CHUNK_SIZE), b''):
+            content_hash.update(chunk)
+    return content_hash.hexdigest()
+
+
+class VectorCache:
+    """Face vectors computed before for the same input of an algorithm.
+
+    The vectors are kept in a SQLite database on local disk that survives
+    resets of the database, keyed by the hash of the image content, the id
+    of the algorithm's docker image and whether the images are prealigned.
+    The least recently used entries are evicted once the stored vectors
+    take more than max_bytes. The processes of a worker share the database
+    file but every process opens its own connection.
+    """
+
+    def __init__(self, path: str,
+                 max_bytes: int = VECTOR_CACHE_MAX_BYTES) -> None:
+        self.path = path
+        self.max_bytes = max_bytes
+        self._connection = None  # type: Optional[sqlite3.Connection]
+        self._pid = None  # type: Optional[int]
+
+    def _connect(self) -> sqlite3.Connection:
+        # connections can't be shared with forked pool processes
+        if self._connection is None or self._pid != os.getpid():
+            directory = os.path.dirname(self.path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+
+            connection = sqlite3.connect(self.path, timeout=30)
+            connection.execute('PRAGMA journal_mode=WAL')
+            connection.executescript(_SCHEMA)
+            self._connection = connection
+            self._pid = os.getpid()
+        return self._connection
+
+    def get_many(self, content_hashes: Iterable[str], algorithm: str,
+                 prealigned: bool) -> Dict[str, bytes]:
+
+        content_hashes = list(set(content_hashes))
+        if not content_hashes:
+            return {}
+
+        try:
+            return self._get_many(content_hashes, algorithm, prealigned)
+        except sqlite3.Error:
+            logger.exception("Can't read cached face vectors from %s",
+                             self.path)
+            return {}
+
+    def _get_many(self, content_hashes: List[str], algorithm: str,
+                  prealigned: bool) -> Dict[str, bytes]:
+
+        connection = self._connect()
+        with connection:
+            placeholders = ', '.join('?' for _ in content_hashes)
+            params = [algorithm, int(prealigned), *content_hashes]
+            found = dict(connection.execute(
+                'SELECT content_hash, face_vectors FROM vectors '
+                'WHERE algorithm = ? AND prealigned = ? '
+                'AND content_hash IN ({})'.format(placeholders),
+                params))
+
+            if found:
+                found_hashes = list(found)
+                connection.execute(
+                    'UPDATE vectors SET last_used = ? '
+                    'WHERE algorithm = ? AND prealigned = ? '
+                    'AND content_hash IN ({})'.format(
+                        ', '.join('?' for _ in found_hashes)),
+                    [time(), algorithm, int(prealigned), *found_hashes])
+
+        return found
+
+    def put_many(self, face_vectors: Dict[str, bytes], algorithm: str,
+                 prealigned: bool):
+
+        if not face_vectors:
+            return
+
+        try:
+            self._put_many(face_vectors, algorithm, prealigned)
+        except sqlite3.Error:
+            logger.exception("Can't cache face vectors in %s", self.path)
+
+    def _put_many(self, face_vectors: Dict[str, bytes], algorithm: str,
+                  prealigned: bool):
+
+        now = time()
+        connection = self._connect()
+        with connection:
+            connection.executemany(
+                'INSERT OR REPLACE INTO vectors (content_hash, algorithm, '
+                'prealigned, face_vectors, size, last_used) '
+                'VALUES (?, ?, ?, ?, ?, ?)',
+                [(content_hash, algorithm, int(prealigned), data,
+                  len(data) + _ENTRY_OVERHEAD_BYTES, now)
+                 for content_hash, data in face_vectors.items()])
+            self._evict(connection)
+
+    def _evict(self, connection: sqlite3.Connection):
+        total_bytes, = connection.execute(
+            'SELECT COALESCE(SUM(size), 0) FROM vectors').fetchone()
+
+        while total_bytes > self.max_bytes:
+            rows = connection.execute(
+                'SELECT content_hash, algorithm, prealigned, size '
+                'FROM vectors ORDER BY last_used LIMIT ?',
+                (_EVICTION_BATCH_SIZE,)).fetchall()
+            if not rows:
+                break
+
+            evicted = []
+            for content_hash, algorithm, prealigned, size in rows:
+                if total_bytes <= self.max_bytes:
+                    break
+                evicted.append((content_hash, algorithm, prealigned))
+                total_bytes -= size
+
+            connection.executemany(
+                'DELETE FROM vectors WHERE content_hash = ? '
+                'AND algorithm = ? AND prealigned = ?', evicted)
+            logger.debug('Evicted %d cached face vectors', len(evicted))
+
+
+@lru_cache(maxsize=1)
+def get_vector_cache() -> Optional[VectorCache]:
+    if not VECTOR_CACHE_PATH or VECTOR_CACHE_MAX_BYTES <= 0:
+        return None
+    return VectorCache(VECTOR_CACHE_PATH)
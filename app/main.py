@@ -1,14 +1,29 @@
 #!/usr/bin/env python3
 
 from faceanalysis.api import app as application
+from faceanalysis.batcher import run_batcher
+from faceanalysis.deleter import run_deleter
 from faceanalysis.log import get_logger
+from faceanalysis.migrations import migrate_face_vectors
+from faceanalysis.migrations import migrate_image_status_columns
+from faceanalysis.migrations import migrate_match_indexes
+from faceanalysis.migrations import migrate_match_storage
 from faceanalysis.models import delete_models
 from faceanalysis.models import init_models
 from faceanalysis.settings import FACE_VECTORIZE_ALGORITHM
+from faceanalysis.settings import IMAGE_BATCH_SIZE
 from faceanalysis.settings import IMAGE_PROCESSOR_CONCURRENCY
-from faceanalysis.settings import IMAGE_PROCESSOR_QUEUE
 from faceanalysis.settings import LOGGING_LEVEL
+from faceanalysis.settings import MATCH_SHARDS
+from faceanalysis.settings import MATCH_WORKER_CONCURRENCY
+from faceanalysis.settings import MATCH_WORKER_SHARDS
+from faceanalysis.settings import SEARCH_WORKER_CONCURRENCY
+from faceanalysis.tasks import PRIORITIES
 from faceanalysis.tasks import celery
+from faceanalysis.tasks import get_match_queue
+from faceanalysis.tasks import get_merge_queue
+from faceanalysis.tasks import get_process_queue
+from faceanalysis.tasks import get_search_queue
 
 logger = get_logger(__name__)
 
@@ -20,13 +35,65 @@ class Commands:
             logger.warning('FaceApi backend detected: not starting worker')
             return
 
+        queues = [get_process_queue(priority) for priority in PRIORITIES]
+
         celery.worker_main([
-            '--queues={}'.format(IMAGE_PROCESSOR_QUEUE),
+            '--queues={}'.format(','.join(queues)),
             '--concurrency={}'.format(IMAGE_PROCESSOR_CONCURRENCY),
             '--loglevel={}'.format(LOGGING_LEVEL),
             '-Ofair',
         ])
 
+    @classmethod
+    def matchworker(cls):
+        if not MATCH_SHARDS or not MATCH_WORKER_SHARDS:
+            logger.warning('No match shards configured: not starting worker')
+            return
+
+        queues = [get_match_queue(shard) for shard in MATCH_WORKER_SHARDS]
+        queues.append(get_merge_queue())
+
+        celery.worker_main([
+            '--queues={}'.format(','.join(queues)),
+            '--concurrency={}'.format(MATCH_WORKER_CONCURRENCY),
+            '--loglevel={}'.format(LOGGING_LEVEL),
+            '-Ofair',
+        ])
+
+    @classmethod
+    def searchworker(cls):
+        if FACE_VECTORIZE_ALGORITHM == 'FaceApi':
+            logger.warning('FaceApi backend detected: not starting worker')
+            return
+
+        if MATCH_SHARDS:
+            logger.warning('Searches run on the matchworkers: '
+                           'not starting worker')
+            return
+
+        celery.worker_main([
+            '--queues={}'.format(get_search_queue()),
+            '--concurrency={}'.format(SEARCH_WORKER_CONCURRENCY),
+            '--loglevel={}'.format(LOGGING_LEVEL),
+            '-Ofair',
+        ])
+
+    @classmethod
+    def batcher(cls):
+        if IMAGE_BATCH_SIZE <= 1:
+            logger.warning('Image batching disabled: not starting batcher')
+            return
+
+        run_batcher()
+
+    @classmethod
+    def deleter(cls):
+        if FACE_VECTORIZE_ALGORITHM == 'FaceApi':
+            logger.warning('FaceApi backend detected: not starting deleter')
+            return
+
+        run_deleter()
+
     @classmethod
     def runserver(cls):
         application.run()
@@ -35,6 +102,15 @@ class Commands:
     def createdb(cls):
         init_models()
 
+    @classmethod
+    def migratedb(cls):
+        # tables added since the database was created
+        init_models()
+        migrate_face_vectors()
+        migrate_match_storage()
+        migrate_match_indexes()
+        migrate_image_status_columns()
+
     @classmethod
     def dropdb(cls):
         delete_models()
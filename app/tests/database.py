@@ -0,0 +1,53 @@
+from unittest import TestCase
+from unittest.mock import patch
+import zlib
+
+from sqlalchemy import create_engine
+from sqlalchemy import event
+from sqlalchemy.orm import sessionmaker
+from sqlalchemy.pool import StaticPool
+
+from faceanalysis import models
+from faceanalysis.models import Base
+from faceanalysis.models import Image
+from faceanalysis.models import ImageStatus
+
+
+def _add_mysql_functions(connection, _):
+    connection.create_function(
+        'crc32', 1, lambda value: zlib.crc32(value.encode('utf-8')))
+
+
+class DatabaseTestCase(TestCase):
+    """Runs every test against a fresh in-memory SQLite database."""
+
+    def setUp(self):
+        engine = create_engine('sqlite://', poolclass=StaticPool,
+                               connect_args={'check_same_thread': False})
+        event.listen(engine, 'connect', _add_mysql_functions)
+        Base.metadata.create_all(engine)
+        self.session_factory = sessionmaker(bind=engine)
+
+        patcher = patch.object(models, '_connect',
+                               return_value=(engine, self.session_factory))
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.addCleanup(engine.dispose)
+
+    def add_images(self, img_ids, status='finished_processing'):
+        session = self.session_factory()
+        for img_id in img_ids:
+            session.add(Image(img_id=img_id))
+            session.add(ImageStatus(img_id=img_id, status=status,
+                                    error_msg=None))
+        session.commit()
+        session.close()
+
+    def get_status(self, img_id):
+        session = self.session_factory()
+        status, error_msg = session.query(ImageStatus.status,
+                                          ImageStatus.error_msg) \
+            .filter(ImageStatus.img_id == img_id) \
+            .one()
+        session.close()
+        return status, error_msg
@@ -4,9 +4,12 @@ from io import BytesIO
 from os.path import abspath
 from os.path import dirname
 from os.path import join
+from tarfile import TarFile
 from time import sleep
 from unittest import TestCase
 from unittest import skipIf
+from zipfile import ZipFile
+import json
 
 from faceanalysis.api import app
 from faceanalysis.models import ImageStatusEnum
@@ -49,13 +52,16 @@ class ApiTestCase(TestCase):
         self.assertEqual(response.status_code, expected_status_code.value)
         return response
 
-    def _get_imgs(self, expected_status_code=HTTPStatus.OK):
-        response = self.app.get(API_VERSION + '/images/')
+    def _get_imgs(self, expected_status_code=HTTPStatus.OK, **params):
+        response = self.app.get(API_VERSION + '/images/',
+                                query_string=params)
         self.assertEqual(response.status_code, expected_status_code.value)
         return response
 
-    def _get_matches(self, img_id, expected_status_code=HTTPStatus.OK):
-        response = self.app.get(API_VERSION + '/image_matches/' + img_id)
+    def _get_matches(self, img_id, expected_status_code=HTTPStatus.OK,
+                     **params):
+        response = self.app.get(API_VERSION + '/image_matches/' + img_id,
+                                query_string=params)
         self.assertEqual(response.status_code, expected_status_code.value)
         return response
 
@@ -111,6 +117,67 @@ class ApiTestCase(TestCase):
         fnames = {'3.jpg', '6.jpg'}
         self._test_end_to_end_with_matching_imgs(fnames)
 
+    def test_matches_are_paginated_closest_first(self):
+        fnames = ['1.jpg', '2.jpg', '11.jpg', '12.png']
+        img_ids = []
+        for fname in fnames:
+            img_id = self._upload_img(fname)
+            img_ids.append(img_id)
+            self._process_img(img_id)
+            self._wait_for_img_to_finish_processing(img_id)
+
+        all_matches = self._get_matches(img_ids[0]).get_json()
+        self.assertEqual(all_matches['distances'],
+                         sorted(all_matches['distances']))
+        self.assertIsNone(all_matches['next'])
+
+        imgs = []
+        cursor = None
+        while True:
+            page = self._get_matches(img_ids[0], limit=1,
+                                     **({'cursor': cursor} if cursor else {}))
+            page = page.get_json()
+            imgs.extend(page['imgs'])
+            cursor = page['next']
+            if not cursor:
+                break
+
+        self.assertEqual(imgs, all_matches['imgs'])
+
+    def test_matches_with_invalid_cursor(self):
+        self._get_matches('some-img', cursor='not-a-cursor',
+                          expected_status_code=HTTPStatus.BAD_REQUEST)
+
+    def test_search_does_not_store_probe(self):
+        img_id = self._upload_img('1.jpg')
+        self._process_img(img_id)
+        self._wait_for_img_to_finish_processing(img_id)
+
+        data = {'image': _load_test_image('2.jpg')}
+        response = self.app.post(API_VERSION + '/search',
+                                 content_type='multipart/form-data',
+                                 data=data)
+        self.assertEqual(response.status_code, HTTPStatus.OK.value)
+        self.assertIn(img_id, response.get_json()['imgs'])
+
+        imgs = self._get_imgs().get_json()['imgs']
+        self.assertEqual(imgs, [img_id])
+
+    def test_duplicate_upload_matches_original(self):
+        fname = '1.jpg'
+        original_img_id = self._upload_img(fname)
+        self._process_img(original_img_id)
+        self._wait_for_img_to_finish_processing(original_img_id)
+
+        duplicate_img_id = self._upload_img(fname)
+        self.assertNotEqual(duplicate_img_id, original_img_id)
+        self._process_img(duplicate_img_id)
+        self._wait_for_img_to_finish_processing(duplicate_img_id)
+
+        matches = self._get_matches(duplicate_img_id).get_json()
+        self.assertEqual(matches['imgs'], [original_img_id])
+        self.assertEqual(matches['distances'], [0.0])
+
     def test_upload_and_process_img_without_face(self):
         fname = '9.jpg'
         img_id = self._upload_img(fname)
@@ -120,6 +187,31 @@ class ApiTestCase(TestCase):
         imgs = self._get_imgs().get_json()['imgs']
         self.assertIn(img_id, imgs)
 
+    def test_images_are_paginated_and_streamed(self):
+        fnames = ['1.jpg', '2.jpg', '9.jpg']
+        for fname in fnames:
+            img_id = self._upload_img(fname)
+            self._process_img(img_id)
+            self._wait_for_img_to_finish_processing(img_id)
+
+        all_imgs = self._get_imgs().get_json()['imgs']
+
+        imgs = []
+        page = self._get_imgs(limit=2).get_json()
+        while True:
+            imgs.extend(page['imgs'])
+            if not page['next']:
+                break
+            page = self._get_imgs(limit=2, cursor=page['next']).get_json()
+        self.assertEqual(imgs, all_imgs)
+
+        response = self._get_imgs(format='ndjson')
+        self.assertEqual(response.mimetype, 'application/x-ndjson')
+        streamed_imgs = [json.loads(line)['img_id']
+                         for line in response.get_data(as_text=True)
+                         .splitlines()]
+        self.assertEqual(streamed_imgs, all_imgs)
+
     def test_processing_img_that_has_not_yet_been_uploaded(self):
         img_id_not_yet_uploaded = '100'
         self._process_img(img_id_not_yet_uploaded,
@@ -154,6 +246,102 @@ class ApiTestCase(TestCase):
     def test_queue_failures(self):
         self.skipTest('Not implemented')
 
+    def test_bulk_upload_archive_and_process(self):
+        archive = BytesIO()
+        with ZipFile(archive, 'w') as zip_archive:
+            for fname in ['1.jpg', '2.jpg', '0.txt']:
+                zip_archive.write(join(TEST_IMAGES_ROOT, fname), fname)
+        archive.seek(0)
+
+        data = {'archive': (archive, 'images.zip')}
+        response = self.app.post(API_VERSION + '/upload_images',
+                                 content_type='multipart/form-data',
+                                 query_string={'process': 'true'},
+                                 data=data)
+        self.assertEqual(response.status_code, HTTPStatus.OK.value)
+        uploaded = response.get_json()
+        self.assertEqual(uploaded['filenames'], ['1.jpg', '2.jpg'])
+        self.assertEqual(uploaded['rejected'], ['0.txt'])
+
+        for img_id in uploaded['img_ids']:
+            self._wait_for_img_to_finish_processing(img_id)
+
+        imgs = self._get_matches(uploaded['img_ids'][0]).get_json()['imgs']
+        self.assertIn(uploaded['img_ids'][1], imgs)
+
+    def test_bulk_upload_corrupt_archive(self):
+        archive = BytesIO()
+        with TarFile(fileobj=archive, mode='w') as tar_archive:
+            for fname in ['1.jpg', '2.jpg']:
+                tar_archive.add(join(TEST_IMAGES_ROOT, fname), fname)
+
+        # the first image is complete but the second one is cut off
+        data = {'archive': (BytesIO(archive.getvalue()[:-20000]),
+                            'images.tar')}
+        response = self.app.post(API_VERSION + '/upload_images',
+                                 content_type='multipart/form-data',
+                                 data=data)
+        self.assertEqual(response.status_code, HTTPStatus.BAD_REQUEST.value)
+        self.assertEqual(self._get_imgs().get_json()['imgs'], [])
+
+    def test_bulk_process_and_status(self):
+        img_ids = [self._upload_img(fname) for fname in ['1.jpg', '2.jpg']]
+        unknown_img_id = 'not-uploaded'
+
+        response = self.app.post(API_VERSION + '/process_images',
+                                 json={'img_ids': img_ids + [unknown_img_id]})
+        self.assertEqual(response.status_code, HTTPStatus.OK.value)
+        self.assertEqual(response.get_json(),
+                         {'img_ids': img_ids, 'rejected': [unknown_img_id]})
+
+        for img_id in img_ids:
+            self._wait_for_img_to_finish_processing(img_id)
+
+        response = self.app.post(API_VERSION + '/image_statuses',
+                                 json={'img_ids': img_ids + [unknown_img_id],
+                                       'with_matches': True})
+        self.assertEqual(response.status_code, HTTPStatus.OK.value)
+        result = response.get_json()
+        self.assertEqual(result['missing'], [unknown_img_id])
+        self.assertEqual([status['img_id'] for status in result['statuses']],
+                         img_ids)
+        for status in result['statuses']:
+            self.assertEqual(status['status'],
+                             ImageStatusEnum.finished_processing.name)
+            self.assertEqual(status['num_matches'], 1)
+            self.assertIsNotNone(status['closest_distance'])
+
+        response = self.app.get(API_VERSION + '/image_statuses',
+                                query_string={'img_ids': img_ids})
+        self.assertEqual(response.status_code, HTTPStatus.OK.value)
+        self.assertNotIn('num_matches', response.get_json()['statuses'][0])
+
+    def test_process_with_priority(self):
+        img_id = self._upload_img('1.jpg')
+
+        response = self.app.post(API_VERSION + '/process_image',
+                                 data={'img_id': img_id,
+                                       'priority': 'urgent'})
+        self.assertEqual(response.status_code, HTTPStatus.BAD_REQUEST.value)
+
+        response = self.app.post(API_VERSION + '/process_image',
+                                 data={'img_id': img_id, 'priority': 'bulk'})
+        self.assertEqual(response.status_code, HTTPStatus.OK.value)
+        self._wait_for_img_to_finish_processing(img_id)
+
+        response = self.app.get(API_VERSION + '/metrics/queues')
+        self.assertEqual(response.status_code, HTTPStatus.OK.value)
+        metrics = response.get_json()
+        self.assertEqual(set(metrics), {'interactive', 'bulk'})
+        self.assertGreaterEqual(metrics['bulk']['images'], 1)
+        self.assertIsNotNone(metrics['bulk']['wait_seconds_per_image'])
+
+    def test_bulk_upload_without_images(self):
+        response = self.app.post(API_VERSION + '/upload_images',
+                                 content_type='multipart/form-data',
+                                 data={})
+        self.assertEqual(response.status_code, HTTPStatus.BAD_REQUEST.value)
+
     def test_upload_file_not_allowed(self):
         fname = '0.txt'
         self._upload_img(fname, expected_status_code=HTTPStatus.BAD_REQUEST)
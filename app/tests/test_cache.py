@@ -0,0 +1,96 @@
+from time import sleep
+from unittest import TestCase
+from unittest.mock import patch
+
+from faceanalysis import cache
+from faceanalysis.cache import LocalCache
+
+
+class LocalCacheTestCase(TestCase):
+    def test_least_recently_used_key_is_evicted(self):
+        local_cache = LocalCache(max_size=2, ttl=60)
+        local_cache.set('a', 'field', 1)
+        local_cache.set('b', 'field', 2)
+        local_cache.get('a', 'field')
+        local_cache.set('c', 'field', 3)
+
+        self.assertEqual(local_cache.get('a', 'field'), 1)
+        self.assertIs(local_cache.get('b', 'field'), cache._MISSING)
+        self.assertEqual(local_cache.get('c', 'field'), 3)
+
+    def test_keys_expire(self):
+        local_cache = LocalCache(max_size=2, ttl=0.01)
+        local_cache.set('a', 'field', 1)
+        sleep(0.02)
+
+        self.assertIs(local_cache.get('a', 'field'), cache._MISSING)
+
+    def test_delete_drops_all_fields(self):
+        local_cache = LocalCache(max_size=2, ttl=60)
+        local_cache.set('a', 'field', 1)
+        local_cache.set('a', 'other', 2)
+        local_cache.delete(['a'])
+
+        self.assertIs(local_cache.get('a', 'field'), cache._MISSING)
+        self.assertIs(local_cache.get('a', 'other'), cache._MISSING)
+
+
+class CachedTestCase(TestCase):
+    def setUp(self):
+        self.local_cache = LocalCache(max_size=10, ttl=60)
+        patcher = patch.object(cache, 'get_cache',
+                               return_value=self.local_cache)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+        self.calls = []
+
+        @cache.cached(cache.MATCHES_NAMESPACE)
+        def lookup(img_id, limit=None):
+            self.calls.append((img_id, limit))
+            return [img_id], [float(len(self.calls))]
+
+        self.lookup = lookup
+
+    def test_results_are_cached_per_arguments(self):
+        self.assertEqual(self.lookup('a'), (['a'], [1.0]))
+        self.assertEqual(self.lookup('a'), (['a'], [1.0]))
+        self.assertEqual(self.lookup('a', 5), (['a'], [2.0]))
+        self.assertEqual(self.calls, [('a', None), ('a', 5)])
+
+    def test_invalidation_drops_results_of_image(self):
+        self.lookup('a')
+        self.lookup('b')
+        cache.invalidate_images(['a'])
+        self.lookup('a')
+        self.lookup('b')
+
+        self.assertEqual(self.calls, [('a', None), ('b', None), ('a', None)])
+
+    def test_hits_and_misses_are_counted(self):
+        before = cache.get_cache_stats()[cache.MATCHES_NAMESPACE]
+        self.lookup('a')
+        self.lookup('a')
+        after = cache.get_cache_stats()[cache.MATCHES_NAMESPACE]
+
+        self.assertEqual(after['hits'] - before['hits'], 1)
+        self.assertEqual(after['misses'] - before['misses'], 1)
+        self.assertIsNotNone(after['hit_latency_ms'])
+
+    def test_without_cache_every_call_is_made(self):
+        with patch.object(cache, 'get_cache', return_value=None):
+            self.lookup('a')
+            self.lookup('a')
+            cache.invalidate_images(['a'])
+
+        self.assertEqual(self.calls, [('a', None), ('a', None)])
+
+
+class GetCacheTestCase(TestCase):
+    def tearDown(self):
+        cache.get_cache.cache_clear()
+
+    def test_cache_is_disabled_without_a_shared_url(self):
+        cache.get_cache.cache_clear()
+        with patch.object(cache, 'CACHE_URL', ''):
+            self.assertIsNone(cache.get_cache())
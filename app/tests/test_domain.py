@@ -0,0 +1,117 @@
+from contextlib import contextmanager
+from io import BytesIO
+from tempfile import TemporaryDirectory
+from unittest import TestCase
+from unittest.mock import patch
+
+from faceanalysis import cache
+from faceanalysis.cache import LocalCache
+from faceanalysis.domain import docker
+from faceanalysis.models import Match
+from tests.database import DatabaseTestCase
+
+
+class CanonicalMatchesTestCase(DatabaseTestCase):
+    def setUp(self):
+        super().setUp()
+
+        for patcher in (patch.object(docker, 'MATCH_STORAGE_MODE',
+                                     'canonical'),
+                        patch.object(cache, 'get_cache',
+                                     return_value=LocalCache())):
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+        self.add_images(['a', 'b', 'c'])
+        session = self.session_factory()
+        session.add_all([
+            Match(this_img_id='a', that_img_id='b', distance_score=0.2),
+            Match(this_img_id='a', that_img_id='c', distance_score=0.4),
+            Match(this_img_id='b', that_img_id='c', distance_score=0.1),
+        ])
+        session.commit()
+        session.close()
+
+    def test_lookup_merges_both_directions(self):
+        self.assertEqual(docker.lookup_matching_images('a'),
+                         (['b', 'c'], [0.2, 0.4]))
+        self.assertEqual(docker.lookup_matching_images('b'),
+                         (['c', 'a'], [0.1, 0.2]))
+        self.assertEqual(docker.lookup_matching_images('c'),
+                         (['b', 'a'], [0.1, 0.4]))
+
+    def test_lookup_pages_across_both_directions(self):
+        self.assertEqual(docker.lookup_matching_images('c', limit=1),
+                         (['b'], [0.1]))
+        self.assertEqual(
+            docker.lookup_matching_images('c', limit=1, cursor=(0.1, 'b')),
+            (['a'], [0.4]))
+
+    def test_summary_merges_both_directions(self):
+        self.assertEqual(docker.summarize_matches(['a', 'b', 'c']),
+                         {'a': (2, 0.2), 'b': (2, 0.1), 'c': (2, 0.1)})
+
+
+class StoreImagesTestCase(TestCase):
+    def setUp(self):
+        self.stored = []
+
+        for patcher in (patch.object(docker, 'store_image',
+                                     side_effect=self._store_image),
+                        patch.object(docker, 'delete_images')):
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def _store_image(self, stream, filename):
+        self.stored.append(filename)
+        return 'hash-' + stream.read().decode('ascii')
+
+    def _images(self, count, error=None):
+        for i in range(count):
+            yield BytesIO(str(i).encode('ascii')), 'id{}'.format(i), \
+                '{}.jpg'.format(i)
+        if error is not None:
+            raise error
+
+    def test_returns_content_hashes(self):
+        self.assertEqual(docker._store_images(self._images(2)),
+                         [('id0', '0.jpg', 'hash-0'),
+                          ('id1', '1.jpg', 'hash-1')])
+        docker.delete_images.assert_not_called()
+
+    def test_deletes_stored_images_when_reading_fails(self):
+        with self.assertRaises(OSError):
+            docker._store_images(self._images(2, OSError('truncated')))
+
+        self.assertEqual(sorted(self.stored), ['0.jpg', '1.jpg'])
+        docker.delete_images.assert_called_once_with(
+            [('id0', '0.jpg'), ('id1', '1.jpg')])
+
+
+class SearchImageTestCase(TestCase):
+    def setUp(self):
+        directory = TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.normalized = []
+
+        for patcher in (patch.object(docker, 'MOUNTED_DATA_DIR',
+                                     directory.name),
+                        patch.object(docker, 'normalized_images',
+                                     self._normalized_images),
+                        patch.object(docker, 'get_face_vectors',
+                                     return_value=[])):
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    @contextmanager
+    def _normalized_images(self, img_paths):
+        self.normalized.extend(img_paths)
+        yield ['normalized.jpg' for _ in img_paths]
+
+    def test_probe_is_normalized_before_vectorizing(self):
+        self.assertEqual(docker.search_image(BytesIO(b'probe'), 'probe.jpg'),
+                         ([], []))
+
+        self.assertEqual(len(self.normalized), 1)
+        self.assertEqual(docker.get_face_vectors.call_args[0][0],
+                         'normalized.jpg')
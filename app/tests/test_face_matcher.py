@@ -0,0 +1,216 @@
+from unittest import TestCase
+from unittest.mock import patch
+
+import numpy as np
+
+from faceanalysis import face_matcher
+from faceanalysis.face_matcher import _find_batch_matches
+from faceanalysis.face_matcher import _find_matches
+from faceanalysis.face_matcher import _find_matches_within_batch
+from faceanalysis.face_matcher import _finish_processing
+from faceanalysis.face_matcher import _store_matches
+from faceanalysis.face_matcher import _transition_img_status
+from faceanalysis.gallery import Gallery
+from faceanalysis.models import ImageStatusEnum
+from faceanalysis.models import Match
+from faceanalysis.models import StageTiming
+from faceanalysis.settings import DISTANCE_SCORE_THRESHOLD
+from tests.database import DatabaseTestCase
+
+
+class FindMatchesTestCase(TestCase):
+    def setUp(self):
+        random = np.random.RandomState(42)
+        self.img_ids = ['img{}'.format(i % 10) for i in range(100)]
+        self.vectors = random.normal(scale=0.1, size=(100, 16))
+        self.faces = random.normal(scale=0.1, size=(3, 16))
+
+        self.gallery = Gallery()
+        self.gallery.add(range(len(self.img_ids)), self.img_ids, self.vectors)
+
+    def _brute_force_matches(self, img_id):
+        matches = {}
+        for face in self.faces:
+            for that_img_id, vector in zip(self.img_ids, self.vectors):
+                distance = np.linalg.norm(vector - face)
+                if that_img_id == img_id \
+                        or distance >= DISTANCE_SCORE_THRESHOLD:
+                    continue
+                matches[that_img_id] = min(
+                    distance, matches.get(that_img_id, distance))
+        return matches
+
+    def test_matches_agree_with_brute_force(self):
+        matches = dict(_find_matches('img3', self.faces.tolist(),
+                                     self.gallery))
+        expected = self._brute_force_matches('img3')
+
+        self.assertTrue(expected)
+        self.assertEqual(set(matches), set(expected))
+        for that_img_id, distance in expected.items():
+            self.assertAlmostEqual(matches[that_img_id], distance, places=4)
+
+    def test_excludes_own_image(self):
+        own_faces = self.vectors[:2].tolist()
+        matches = dict(_find_matches('img0', own_faces, self.gallery))
+        self.assertNotIn('img0', matches)
+
+    def test_no_faces_or_empty_gallery(self):
+        self.assertEqual(_find_matches('img0', [], self.gallery), [])
+        self.assertEqual(
+            _find_matches('img0', self.faces.tolist(), Gallery()), [])
+
+    def test_batch_matches_agree_with_single_matches(self):
+        img_ids = ['img3', 'new', 'img5']
+        face_vectors = [self.faces.tolist(), [], self.vectors[:2].tolist()]
+
+        batch_matches = _find_batch_matches(img_ids, face_vectors,
+                                            self.gallery)
+
+        for img_id, vectors, matches in zip(img_ids, face_vectors,
+                                            batch_matches):
+            matches = dict(matches)
+            expected = dict(_find_matches(img_id, vectors, self.gallery))
+
+            # the distances come out of different matrix products
+            self.assertEqual(set(matches), set(expected))
+            for that_img_id, distance in expected.items():
+                self.assertAlmostEqual(matches[that_img_id], distance,
+                                       places=5)
+
+    def test_batch_images_match_earlier_images(self):
+        img_ids = ['first', 'second', 'third']
+        face_vectors = [self.faces[:1].tolist(),
+                        (self.faces[1:] + 1).tolist(),
+                        (self.faces[:1] + 0.001).tolist()]
+
+        matches = _find_matches_within_batch(img_ids, face_vectors)
+
+        self.assertEqual(matches[0], [])
+        self.assertEqual([img_id for img_id, _ in matches[2]], ['first'])
+
+
+class StoreMatchesTestCase(DatabaseTestCase):
+    def setUp(self):
+        super().setUp()
+        self.add_images(['a', 'b', 'c'])
+
+    def _store(self, storage_mode, matches):
+        with patch.object(face_matcher, 'MATCH_STORAGE_MODE', storage_mode):
+            session = self.session_factory()
+            _store_matches(matches, session)
+            session.commit()
+
+        rows = session.query(Match.this_img_id, Match.that_img_id,
+                             Match.distance_score).all()
+        session.close()
+        return sorted(rows)
+
+    def test_canonical_storage_writes_each_pair_once(self):
+        rows = self._store('canonical', [('b', 'a', 0.25), ('a', 'c', 0.5)])
+
+        self.assertEqual(rows, [('a', 'b', 0.25), ('a', 'c', 0.5)])
+
+    def test_symmetric_storage_writes_both_directions(self):
+        rows = self._store('symmetric', [('b', 'a', 0.25)])
+
+        self.assertEqual(rows, [('a', 'b', 0.25), ('b', 'a', 0.25)])
+
+
+class TransitionImgStatusTestCase(DatabaseTestCase):
+    def setUp(self):
+        super().setUp()
+        self.session = self.session_factory()
+        self.addCleanup(self.session.close)
+
+    def test_allowed_transition_updates_status(self):
+        self.add_images(['img0'], status='uploaded')
+
+        self.assertTrue(_transition_img_status(
+            self.session, 'img0', ImageStatusEnum.processing))
+        self.session.commit()
+
+        self.assertEqual(self.get_status('img0'), ('processing', None))
+
+    def test_duplicate_transition_is_rejected(self):
+        self.add_images(['img0'], status='uploaded')
+
+        self.assertTrue(_transition_img_status(
+            self.session, 'img0', ImageStatusEnum.processing))
+        self.assertFalse(_transition_img_status(
+            self.session, 'img0', ImageStatusEnum.processing))
+
+    def test_stale_transition_is_rejected(self):
+        self.add_images(['img0'])
+
+        self.assertFalse(_transition_img_status(
+            self.session, 'img0', ImageStatusEnum.face_vector_computed))
+        self.session.commit()
+
+        self.assertEqual(self.get_status('img0'),
+                         ('finished_processing', None))
+
+    def test_finish_processing_records_missing_faces(self):
+        self.add_images(['img0'], status='processing')
+
+        self.assertTrue(_finish_processing(self.session, 'img0', False))
+        self.session.commit()
+
+        self.assertEqual(self.get_status('img0'),
+                         ('finished_processing', 'No faces found in image'))
+
+    def test_finish_processing_rolls_back_when_rejected(self):
+        self.add_images(['a', 'b'])
+        _store_matches([('a', 'b', 0.25)], self.session)
+
+        self.assertFalse(_finish_processing(self.session, 'a', True))
+        self.session.commit()
+
+        self.assertEqual(self.session.query(Match).count(), 0)
+        self.assertEqual(self.get_status('a'), ('finished_processing', None))
+
+
+class ProcessingFailureTestCase(DatabaseTestCase):
+    def setUp(self):
+        super().setUp()
+        for name, value in (('_get_local_image_path', 'img0.jpg'),
+                            ('get_gallery', Gallery())):
+            patcher = patch.object(face_matcher, name, return_value=value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+        patcher = patch.object(face_matcher, '_vectorize',
+                               side_effect=ConnectionError)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_failed_image_is_not_left_processing(self):
+        self.add_images(['img0'], status='uploaded')
+
+        with self.assertRaises(ConnectionError):
+            face_matcher.process_image('img0')
+
+        self.assertEqual(self.get_status('img0'),
+                         ('failed', 'Processing failed: ConnectionError'))
+
+    def test_failed_batch_is_not_left_processing(self):
+        self.add_images(['img0', 'img1'], status='uploaded')
+
+        with self.assertRaises(ConnectionError):
+            face_matcher.store_batch_face_vectors(['img0', 'img1'])
+
+        self.assertEqual(self.get_status('img1'),
+                         ('failed', 'Processing failed: ConnectionError'))
+
+    def test_wait_is_kept_when_processing_fails(self):
+        self.add_images(['img0', 'img1'], status='uploaded')
+
+        with self.assertRaises(ConnectionError):
+            face_matcher.process_images(['img0', 'img1'],
+                                        ('bulk_wait', [0.0, 0.0]))
+
+        session = self.session_factory()
+        timings = session.query(StageTiming.stage, StageTiming.num_images) \
+            .all()
+        session.close()
+        self.assertEqual(timings, [('bulk_wait', 2)])
@@ -0,0 +1,194 @@
+from os.path import abspath
+from os.path import dirname
+from os.path import join
+from tempfile import TemporaryDirectory
+from unittest import TestCase
+from unittest.mock import patch
+import json
+import struct
+
+import numpy as np
+
+from faceanalysis import face_vectorizer
+from faceanalysis.face_vectorizer import VectorizerError
+from faceanalysis.face_vectorizer import face_vector_from_bytes
+from faceanalysis.face_vectorizer import face_vector_to_bytes
+from faceanalysis.face_vectorizer import face_vectors_from_bytes
+from faceanalysis.face_vectorizer import face_vectors_to_bytes
+from faceanalysis.face_vectorizer import get_face_vectors_batch
+from faceanalysis.vector_cache import VectorCache
+from tests.vectorizer_server import VectorizerServer
+from tests.vectorizer_server import fake_face_vectors
+
+TEST_IMAGES_ROOT = join(abspath(dirname(__file__)), 'images')
+
+
+class VectorizerServiceTestCase(TestCase):
+    def setUp(self):
+        self.img_paths = [join(TEST_IMAGES_ROOT, '0.jpg'),
+                          join(TEST_IMAGES_ROOT, '12.png')]
+
+    def _expected_face_vectors(self):
+        expected = []
+        for img_path in self.img_paths:
+            with open(img_path, 'rb') as fobj:
+                expected.append(fake_face_vectors(fobj.read()))
+        return expected
+
+    def test_vectorizes_images_with_service(self):
+        with VectorizerServer() as server, \
+                patch.object(face_vectorizer, 'FACE_VECTORIZE_SERVICE_URL',
+                             server.url), \
+                patch.object(face_vectorizer, '_run_container') as run:
+            face_vectors = get_face_vectors_batch(self.img_paths, 'algo')
+
+        run.assert_not_called()
+        self.assertEqual(face_vectors, self._expected_face_vectors())
+
+    def test_sends_prealigned_setting_to_service(self):
+        with VectorizerServer() as server, \
+                patch.object(face_vectorizer, 'FACE_VECTORIZE_SERVICE_URL',
+                             server.url), \
+                patch.object(face_vectorizer, 'FACE_VECTORIZE_PREALIGNED',
+                             True):
+            get_face_vectors_batch(self.img_paths, 'algo')
+
+        self.assertEqual([request['prealigned']
+                          for request in server.requests], [True])
+
+    def test_falls_back_to_container_when_service_is_down(self):
+        with VectorizerServer() as server:
+            url = server.url
+
+        with patch.object(face_vectorizer, 'FACE_VECTORIZE_SERVICE_URL',
+                          url), \
+                patch.object(face_vectorizer, '_run_container',
+                             return_value=[[], []]) as run:
+            face_vectors = get_face_vectors_batch(self.img_paths, 'algo')
+
+        run.assert_called_once_with(self.img_paths, 'algo')
+        self.assertEqual(face_vectors, [[], []])
+
+    def test_fails_fast_when_service_is_down_with_timeout(self):
+        with VectorizerServer() as server:
+            url = server.url
+
+        with patch.object(face_vectorizer, 'FACE_VECTORIZE_SERVICE_URL',
+                          url), \
+                patch.object(face_vectorizer, '_run_container') as run:
+            with self.assertRaises(VectorizerError):
+                get_face_vectors_batch(self.img_paths, 'algo', timeout=1)
+
+        run.assert_not_called()
+
+
+class VectorCacheTestCase(TestCase):
+    def setUp(self):
+        self.img_paths = [join(TEST_IMAGES_ROOT, '0.jpg'),
+                          join(TEST_IMAGES_ROOT, '12.png')]
+
+        directory = TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.cache = VectorCache(join(directory.name, 'vectors.sqlite3'),
+                                 max_bytes=1024 * 1024)
+
+        self.image_ids = {'algo': 'sha256:1', 'other_algo': 'sha256:2'}
+        for patcher in (patch.object(face_vectorizer, 'get_vector_cache',
+                                     return_value=self.cache),
+                        patch.object(face_vectorizer,
+                                     '_get_algorithm_image_id',
+                                     side_effect=self.image_ids.get)):
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def test_images_are_only_vectorized_once(self):
+        with patch.object(face_vectorizer, '_run_container',
+                          return_value=[[[0.5, 0.25]], []]) as run:
+            first = get_face_vectors_batch(self.img_paths, 'algo')
+            second = get_face_vectors_batch(self.img_paths, 'algo')
+
+        run.assert_called_once_with(self.img_paths, 'algo')
+        self.assertEqual(first, [[[0.5, 0.25]], []])
+        self.assertEqual(second, first)
+
+    def test_cache_is_keyed_by_algorithm(self):
+        with patch.object(face_vectorizer, '_run_container',
+                          return_value=[[], []]) as run:
+            get_face_vectors_batch(self.img_paths, 'algo')
+            get_face_vectors_batch(self.img_paths, 'other_algo')
+
+        self.assertEqual(run.call_count, 2)
+
+    def test_cache_is_keyed_by_algorithm_image(self):
+        with patch.object(face_vectorizer, '_run_container',
+                          return_value=[[], []]) as run:
+            get_face_vectors_batch(self.img_paths, 'algo')
+            self.image_ids['algo'] = 'sha256:3'
+            get_face_vectors_batch(self.img_paths, 'algo')
+
+        self.assertEqual(run.call_count, 2)
+
+    def test_unresolved_algorithm_is_not_cached(self):
+        with patch.object(face_vectorizer, '_run_container',
+                          return_value=[[], []]) as run:
+            get_face_vectors_batch(self.img_paths, 'unknown')
+            get_face_vectors_batch(self.img_paths, 'unknown')
+
+        self.assertEqual(run.call_count, 2)
+
+    def test_failed_vectorizations_are_not_cached(self):
+        with patch.object(face_vectorizer, '_run_container',
+                          return_value=None) as run:
+            face_vectors = get_face_vectors_batch(self.img_paths, 'algo')
+            get_face_vectors_batch(self.img_paths, 'algo')
+
+        self.assertEqual(face_vectors, [[], []])
+        self.assertEqual(run.call_count, 2)
+
+    def test_least_recently_used_vectors_are_evicted(self):
+        cache = VectorCache(self.cache.path, max_bytes=500)
+        data = b'x' * 100
+
+        cache.put_many({'a': data}, 'algo', False)
+        cache.put_many({'b': data}, 'algo', False)
+        cache.get_many(['a'], 'algo', False)
+        cache.put_many({'c': data}, 'algo', False)
+
+        self.assertEqual(set(cache.get_many(['a', 'b', 'c'], 'algo', False)),
+                         {'a', 'c'})
+
+    def test_face_vectors_round_trip(self):
+        vectors = [[0.5, 0.25, 1.0], [2.0, 4.0, 8.0]]
+
+        self.assertEqual(face_vectors_from_bytes(face_vectors_to_bytes(
+            vectors)), vectors)
+        self.assertEqual(face_vectors_from_bytes(b''), [])
+
+
+class FaceVectorBytesTestCase(TestCase):
+    def test_round_trip(self):
+        vector = [0.5, -0.25, 1.0, 0.125]
+
+        data = face_vector_to_bytes(vector)
+
+        self.assertEqual(len(data), 8 + 4 * len(vector))
+        self.assertEqual(face_vector_from_bytes(data).dtype, np.float32)
+        self.assertEqual(face_vector_from_bytes(data).tolist(), vector)
+
+    def test_json_rows_are_still_read(self):
+        vector = [0.5, -0.25, 1.0]
+
+        for data in (json.dumps(vector), json.dumps(vector).encode('utf-8')):
+            self.assertEqual(face_vector_from_bytes(data).tolist(), vector)
+
+    def test_unknown_version_raises(self):
+        data = struct.pack('<2sBBI', b'FV', 2, 1, 1) + b'\x00' * 4
+
+        with self.assertRaises(ValueError):
+            face_vector_from_bytes(data)
+
+    def test_unknown_dtype_raises(self):
+        data = struct.pack('<2sBBI', b'FV', 1, 9, 1) + b'\x00' * 4
+
+        with self.assertRaises(ValueError):
+            face_vector_from_bytes(data)
@@ -0,0 +1,243 @@
+from tempfile import TemporaryDirectory
+from unittest import TestCase
+from unittest.mock import patch
+
+import numpy as np
+
+from faceanalysis.face_matcher import _find_matches
+from faceanalysis.face_vectorizer import face_vector_to_bytes
+from faceanalysis.gallery import Gallery
+from faceanalysis.gallery import SharedGallery
+from faceanalysis.gallery import _RowTracker
+from faceanalysis.indexes import CompressedIndex
+from faceanalysis.indexes import ExactIndex
+from faceanalysis.indexes import Float16Encoder
+from faceanalysis.indexes import Int8Encoder
+from faceanalysis.indexes import ProductQuantizationEncoder
+from faceanalysis.models import FeatureMapping
+from tests.database import DatabaseTestCase
+
+
+class GalleryRefreshTestCase(DatabaseTestCase):
+    def setUp(self):
+        super().setUp()
+        random = np.random.RandomState(0)
+        self.vectors = random.normal(scale=0.1, size=(10, 16))
+        self.add_images(['img{}'.format(i) for i in range(len(self.vectors))])
+
+    def _commit_rows(self, *row_ids):
+        session = self.session_factory()
+        for row_id in row_ids:
+            session.add(FeatureMapping(
+                id=row_id, img_id='img{}'.format(row_id),
+                features=face_vector_to_bytes(self.vectors[row_id].tolist())))
+        session.commit()
+        session.close()
+
+    def test_refresh_appends_only_new_rows(self):
+        gallery = Gallery()
+        self._commit_rows(1, 2)
+        gallery.refresh()
+        self._commit_rows(3)
+        gallery.refresh()
+        gallery.refresh()
+
+        self.assertEqual(list(gallery.img_ids), ['img1', 'img2', 'img3'])
+        np.testing.assert_allclose(gallery.vectors, self.vectors[1:4],
+                                   atol=1e-6)
+
+    def test_refresh_starts_at_the_high_water_mark(self):
+        gallery = Gallery()
+        self._commit_rows(1, 2)
+        gallery.refresh()
+
+        with patch.object(gallery, '_store_rows') as store_rows:
+            gallery.refresh()
+
+        store_rows.assert_called_once_with([])
+        self.assertEqual(gallery._rows.high_water_mark, 2)
+
+    def test_missed_rows_are_filled_in_later(self):
+        gallery = Gallery()
+        # row 2 is committed by a slower transaction after row 3
+        self._commit_rows(1, 3)
+        gallery.refresh()
+        self._commit_rows(2)
+        gallery.refresh()
+
+        self.assertEqual(list(gallery.img_ids), ['img1', 'img3', 'img2'])
+        self.assertEqual(gallery._rows.high_water_mark, 3)
+        self.assertFalse(gallery._rows.missing_row_ids)
+
+    def test_missed_rows_are_given_up_after_a_while(self):
+        gallery = Gallery()
+        self._commit_rows(1, 3)
+        with patch('faceanalysis.gallery.monotonic', return_value=0):
+            gallery.refresh()
+        with patch('faceanalysis.gallery.monotonic', return_value=1000):
+            gallery.refresh()
+
+        self.assertFalse(gallery._rows.missing_row_ids)
+
+    def test_added_rows_are_not_loaded_again(self):
+        gallery = Gallery()
+        gallery.add([1], ['img1'], self.vectors[1:2])
+        self._commit_rows(1, 2)
+        gallery.refresh()
+
+        self.assertEqual(list(gallery.img_ids), ['img1', 'img2'])
+
+    def test_added_missed_rows_are_not_loaded_again(self):
+        gallery = Gallery()
+        self._commit_rows(1, 3)
+        gallery.refresh()
+        gallery.add([2], ['img2'], self.vectors[2:3])
+        self._commit_rows(2)
+        gallery.refresh()
+
+        self.assertEqual(list(gallery.img_ids), ['img1', 'img3', 'img2'])
+
+    def test_shard_only_loads_its_own_images(self):
+        galleries = [Gallery(shard=shard) for shard in range(2)]
+        for gallery in galleries:
+            gallery._rows.num_shards = 2
+        self._commit_rows(*range(1, 10))
+        for gallery in galleries:
+            gallery.refresh()
+
+        img_ids = [set(gallery.img_ids) for gallery in galleries]
+        self.assertTrue(all(img_ids))
+        self.assertFalse(img_ids[0] & img_ids[1])
+        self.assertEqual(img_ids[0] | img_ids[1],
+                         {'img{}'.format(i) for i in range(1, 10)})
+        for gallery in galleries:
+            self.assertEqual(gallery._rows.high_water_mark, 9)
+            self.assertFalse(gallery._rows.missing_row_ids)
+
+
+class RowTrackerTestCase(TestCase):
+    def test_gaps_below_the_new_rows_are_missing(self):
+        rows = _RowTracker()
+        rows.track([1, 3, 6])
+
+        self.assertEqual(sorted(rows.missing_row_ids), [2, 4, 5])
+        self.assertEqual(rows.high_water_mark, 6)
+
+    def test_too_many_gaps_are_not_tracked(self):
+        rows = _RowTracker()
+        with patch('faceanalysis.gallery._MAX_MISSING_ROWS', 2):
+            rows.track([1, 3, 6])
+
+        self.assertFalse(rows.missing_row_ids)
+        self.assertEqual(rows.high_water_mark, 6)
+
+
+class SharedGalleryTestCase(TestCase):
+    def setUp(self):
+        self.directory = TemporaryDirectory()
+        self.rows = []
+
+        random = np.random.RandomState(0)
+        self.vectors = random.normal(scale=0.1, size=(1500, 16))
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def _gallery(self):
+        gallery = SharedGallery(self.directory.name)
+        patcher = patch.object(gallery, '_query_new_rows', self._new_rows)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        return gallery
+
+    def _new_rows(self):
+        rows, self.rows = self.rows, []
+        return rows
+
+    def _store_rows(self, start, end):
+        self.rows = [(i + 1, 'img{}'.format(i),
+                      face_vector_to_bytes(self.vectors[i].tolist()))
+                     for i in range(start, end)]
+
+    def test_rows_are_published_to_other_processes(self):
+        writer = self._gallery()
+        reader = self._gallery()
+
+        self._store_rows(0, 10)
+        writer.refresh()
+        reader.refresh()
+
+        self.assertEqual(len(reader), 10)
+        np.testing.assert_allclose(reader.vectors, self.vectors[:10],
+                                   atol=1e-6)
+        self.assertFalse(reader.vectors.flags.writeable)
+
+    def test_readers_follow_growth_of_the_gallery(self):
+        writer = self._gallery()
+        reader = self._gallery()
+
+        self._store_rows(0, 10)
+        reader.refresh()
+        self._store_rows(10, len(self.vectors))
+        writer.refresh()
+        reader.refresh()
+
+        self.assertEqual(len(reader), len(self.vectors))
+        self.assertEqual(reader.img_ids[-1], 'img1499')
+        np.testing.assert_allclose(reader.vectors, self.vectors, atol=1e-6)
+
+    def test_matches_shared_img_ids(self):
+        gallery = self._gallery()
+        self._store_rows(0, 10)
+        gallery.refresh()
+
+        matches = dict(_find_matches('new', self.vectors[:1].tolist(),
+                                     gallery))
+        self.assertIn('img0', matches)
+
+
+class GalleryMemoryTestCase(TestCase):
+    num_vectors = 20000
+
+    def setUp(self):
+        random = np.random.RandomState(0)
+        self.vectors = random.normal(scale=0.1, size=(self.num_vectors, 128))
+
+    def _resident_bytes_per_row(self, index):
+        gallery = Gallery(index)
+        gallery.add(range(self.num_vectors),
+                    ['img{}'.format(i) for i in range(self.num_vectors)],
+                    self.vectors)
+        return gallery.resident_nbytes / len(gallery)
+
+    def test_compressed_indexes_keep_only_codes_resident(self):
+        exact = self._resident_bytes_per_row(ExactIndex())
+        float16 = self._resident_bytes_per_row(
+            CompressedIndex(Float16Encoder(), 0.05))
+        int8 = self._resident_bytes_per_row(
+            CompressedIndex(Int8Encoder(), 0.05))
+        pq = self._resident_bytes_per_row(
+            CompressedIndex(ProductQuantizationEncoder(16), 0.05))
+
+        # a float32 row, its squared norm and the reference to its img_id
+        self.assertEqual(exact, 128 * 4 + 4 + 8)
+        self.assertEqual(float16, 128 * 2 + 4 + 4 + 8)
+        self.assertEqual(int8, 128 + 4 + 4 + 8)
+        self.assertEqual(pq, 16 + 4 + 4 + 8)
+        self.assertGreater(exact / pq, 16)
+
+    def test_compressed_indexes_find_the_same_rows(self):
+        gallery = Gallery(CompressedIndex(Int8Encoder(), 0.05))
+        gallery.add(range(self.num_vectors),
+                    ['img{}'.format(i) for i in range(self.num_vectors)],
+                    self.vectors)
+        exact = Gallery()
+        exact.add(range(self.num_vectors), list(gallery.img_ids),
+                  self.vectors)
+
+        faces = self.vectors[:2] + 0.01
+        _, rows, _ = gallery.search(faces, 0.5)
+        _, exact_rows, _ = exact.search(faces, 0.5)
+
+        self.assertIsInstance(gallery.vectors, np.memmap)
+        np.testing.assert_array_equal(np.sort(rows), np.sort(exact_rows))
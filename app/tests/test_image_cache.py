@@ -0,0 +1,72 @@
+from tempfile import TemporaryDirectory
+from unittest import TestCase
+from unittest.mock import patch
+import os
+
+from faceanalysis import image_cache
+from faceanalysis.image_cache import ImageCache
+
+
+class ImageCacheTestCase(TestCase):
+    def setUp(self):
+        directory = TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.directory = directory.name
+
+        self.downloads = []
+
+        def download_image(img_id, destination, image_name=None):
+            self.downloads.append(img_id)
+            with open(destination, 'wb') as fobj:
+                fobj.write(b'x' * 10)
+
+        patcher = patch.object(image_cache, 'download_image',
+                               side_effect=download_image)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_images_are_downloaded_once(self):
+        cache = ImageCache(self.directory, max_bytes=100)
+
+        path = cache.get_path('a', 'a.jpg')
+        self.assertEqual(cache.get_path('a', 'a.jpg'), path)
+
+        self.assertEqual(os.path.basename(path), 'a.jpg')
+        self.assertEqual(self.downloads, ['a'])
+
+    def test_least_recently_used_images_are_evicted(self):
+        cache = ImageCache(self.directory, max_bytes=20)
+
+        path_a = cache.get_path('a', 'a.jpg')
+        path_b = cache.get_path('b', 'b.jpg')
+        os.utime(path_a, (0, 0))
+        os.utime(path_b, (1, 1))
+        cache.get_path('a', 'a.jpg')
+        cache.get_path('c', 'c.jpg')
+
+        self.assertTrue(os.path.exists(path_a))
+        self.assertFalse(os.path.exists(path_b))
+
+    def test_prefetch_skips_images_being_downloaded(self):
+        cache = ImageCache(self.directory, max_bytes=100)
+        open(os.path.join(self.directory, 'a.jpg.part'), 'wb').close()
+
+        self.assertIsNone(cache._try_fetch('a', 'a.jpg'))
+        self.assertEqual(self.downloads, [])
+
+    def test_stale_downloads_are_reclaimed(self):
+        cache = ImageCache(self.directory, max_bytes=100, download_timeout=1)
+        partial_path = os.path.join(self.directory, 'a.jpg.part')
+        open(partial_path, 'wb').close()
+        os.utime(partial_path, (0, 0))
+
+        cache.get_path('a', 'a.jpg')
+
+        self.assertEqual(self.downloads, ['a'])
+
+    def test_discard_removes_local_copy(self):
+        cache = ImageCache(self.directory, max_bytes=100)
+        path = cache.get_path('a', 'a.jpg')
+        cache.discard('a', 'a.jpg')
+
+        self.assertFalse(os.path.exists(path))
@@ -0,0 +1,107 @@
+from unittest import TestCase
+
+import numpy as np
+
+from faceanalysis.indexes import CompressedIndex
+from faceanalysis.indexes import ExactIndex
+from faceanalysis.indexes import Float16Encoder
+from faceanalysis.indexes import IVFIndex
+from faceanalysis.indexes import Int8Encoder
+from faceanalysis.indexes import ProductQuantizationEncoder
+
+
+class IndexTestCase(TestCase):
+    num_vectors = 2000
+
+    def setUp(self):
+        random = np.random.RandomState(0)
+        centers = random.normal(scale=0.1, size=(50, 16))
+        labels = random.randint(len(centers), size=self.num_vectors)
+        noise = random.normal(scale=0.02, size=(len(labels), 16))
+
+        self.vectors = (centers[labels] + noise).astype(np.float32)
+        self.squared_norms = np.einsum('ij,ij->i', self.vectors, self.vectors)
+        self.faces = self.vectors[:3] + np.float32(0.01)
+
+    def _search(self, index, vectors=None):
+        vectors = self.vectors if vectors is None else vectors
+        index.add(vectors)
+        _, rows, distances = index.range_search(
+            vectors, self.squared_norms[:len(vectors)], self.faces,
+            np.zeros(1, dtype=np.int64), 0.01)
+        order = np.argsort(rows)
+        return rows[order], distances[order]
+
+
+class IVFIndexTestCase(IndexTestCase):
+    def test_probing_all_lists_is_exact(self):
+        rows, distances = self._search(IVFIndex(num_lists=8, num_probes=8))
+        exact_rows, exact_distances = self._search(ExactIndex())
+
+        self.assertTrue(len(exact_rows))
+        np.testing.assert_array_equal(rows, exact_rows)
+        np.testing.assert_allclose(distances, exact_distances, atol=1e-6)
+
+    def test_probing_few_lists_finds_close_rows(self):
+        rows, _ = self._search(IVFIndex(num_lists=16, num_probes=2))
+        exact_rows, _ = self._search(ExactIndex())
+
+        recall = len(np.intersect1d(rows, exact_rows)) / len(exact_rows)
+        self.assertGreater(recall, 0.9)
+
+    def test_small_gallery_falls_back_to_exact(self):
+        index = IVFIndex(num_lists=64, num_probes=1)
+        rows, _ = self._search(index, self.vectors[:100])
+        exact_rows, _ = self._search(ExactIndex(), self.vectors[:100])
+
+        self.assertFalse(index.is_trained)
+        np.testing.assert_array_equal(rows, exact_rows)
+
+    def test_state_round_trip(self):
+        index = IVFIndex(num_lists=8, num_probes=2)
+        rows, _ = self._search(index)
+
+        restored = IVFIndex(num_lists=8, num_probes=2)
+        restored.set_state(index.get_state(), self.vectors)
+        restored_rows, _ = self._search(restored)
+
+        np.testing.assert_array_equal(rows, restored_rows)
+
+
+class CompressedIndexTestCase(IndexTestCase):
+    num_vectors = 10000
+
+    def _assert_same_as_exact(self, index):
+        rows, distances = self._search(index)
+        exact_rows, exact_distances = self._search(ExactIndex())
+
+        self.assertTrue(index.is_trained)
+        self.assertTrue(len(exact_rows))
+        np.testing.assert_array_equal(rows, exact_rows)
+        np.testing.assert_allclose(distances, exact_distances, atol=1e-6)
+
+    def test_float16_reranks_to_exact(self):
+        self._assert_same_as_exact(CompressedIndex(Float16Encoder(), 0.05))
+
+    def test_int8_reranks_to_exact(self):
+        self._assert_same_as_exact(CompressedIndex(Int8Encoder(), 0.05))
+
+    def test_pq_finds_close_rows(self):
+        index = CompressedIndex(ProductQuantizationEncoder(8), 0.05)
+        rows, _ = self._search(index)
+        exact_rows, _ = self._search(ExactIndex())
+
+        self.assertEqual(index.codes.shape, (len(self.vectors), 8))
+        recall = len(np.intersect1d(rows, exact_rows)) / len(exact_rows)
+        self.assertGreater(recall, 0.9)
+
+    def test_state_round_trip(self):
+        index = CompressedIndex(Int8Encoder(), 0.05)
+        rows, _ = self._search(index)
+
+        restored = CompressedIndex(Int8Encoder(), 0.05)
+        restored.set_state(index.get_state(), self.vectors)
+        restored_rows, _ = self._search(restored)
+
+        np.testing.assert_array_equal(index.codes, restored.codes)
+        np.testing.assert_array_equal(rows, restored_rows)
@@ -0,0 +1,60 @@
+import json
+
+from faceanalysis.face_vectorizer import face_vector_from_bytes
+from faceanalysis.face_vectorizer import face_vector_to_bytes
+from faceanalysis.face_vectorizer import is_binary_face_vector
+from faceanalysis.migrations import _convert_feature_mappings
+from faceanalysis.migrations import migrate_face_vectors
+from faceanalysis.models import FeatureMapping
+from tests.database import DatabaseTestCase
+
+
+class MigrateFaceVectorsTestCase(DatabaseTestCase):
+    def setUp(self):
+        super().setUp()
+        self.vectors = [[0.5 * i, 0.25, -1.0] for i in range(5)]
+        self.add_images(['img{}'.format(i) for i in range(5)])
+
+    def _add_rows(self, binary_rows):
+        session = self.session_factory()
+        for i, vector in enumerate(self.vectors):
+            if i in binary_rows:
+                features = face_vector_to_bytes(vector)
+            else:
+                features = json.dumps(vector).encode('utf-8')
+            session.add(FeatureMapping(id=i + 1, img_id='img{}'.format(i),
+                                       features=features))
+        session.commit()
+        session.close()
+
+    def _rows(self):
+        session = self.session_factory()
+        rows = session.query(FeatureMapping.features) \
+            .order_by(FeatureMapping.id) \
+            .all()
+        session.close()
+        return [features for features, in rows]
+
+    def test_converts_json_rows_in_batches(self):
+        self._add_rows(binary_rows={1, 3})
+
+        migrate_face_vectors(batch_size=2)
+
+        rows = self._rows()
+        self.assertTrue(all(is_binary_face_vector(row) for row in rows))
+        self.assertEqual([face_vector_from_bytes(row).tolist()
+                          for row in rows], self.vectors)
+
+    def test_counts_converted_rows_across_batches(self):
+        self._add_rows(binary_rows={0})
+
+        self.assertEqual(_convert_feature_mappings(batch_size=2), 4)
+        self.assertEqual(_convert_feature_mappings(batch_size=2), 0)
+
+    def test_binary_rows_are_left_alone(self):
+        self._add_rows(binary_rows=set(range(5)))
+        before = self._rows()
+
+        migrate_face_vectors(batch_size=2)
+
+        self.assertEqual(self._rows(), before)
@@ -0,0 +1,58 @@
+from tempfile import TemporaryDirectory
+from unittest import TestCase
+import os
+
+from PIL import Image
+
+from faceanalysis.normalizer import normalize_image
+from faceanalysis.normalizer import normalized_images
+
+# exif data with the single tag orientation 6: rotated clockwise by 90 degrees
+ROTATED_EXIF = (b'Exif\x00\x00II*\x00\x08\x00\x00\x00\x01\x00'
+                b'\x12\x01\x03\x00\x01\x00\x00\x00\x06\x00\x00\x00'
+                b'\x00\x00\x00\x00')
+
+
+class NormalizeImageTestCase(TestCase):
+    def setUp(self):
+        directory = TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.directory = directory.name
+
+    def _create_image(self, size, **kwargs):
+        img_path = os.path.join(self.directory, 'img.jpg')
+        Image.new('RGB', size, 'white').save(img_path, 'JPEG', **kwargs)
+        return img_path
+
+    def test_upright_small_images_are_used_as_is(self):
+        img_path = self._create_image((400, 300))
+
+        self.assertIsNone(normalize_image(img_path, max_side=1000))
+
+    def test_large_images_are_shrunk(self):
+        img_path = self._create_image((4000, 3000))
+
+        normalized_path = normalize_image(img_path, max_side=1000)
+
+        with Image.open(normalized_path) as image:
+            self.assertEqual(image.size, (1000, 750))
+
+    def test_images_are_rotated_upright(self):
+        img_path = self._create_image((400, 300), exif=ROTATED_EXIF)
+
+        normalized_path = normalize_image(img_path, max_side=0)
+
+        with Image.open(normalized_path) as image:
+            self.assertEqual(image.size, (300, 400))
+
+    def test_remote_images_are_used_as_is(self):
+        self.assertIsNone(normalize_image('https://host/img.jpg'))
+
+    def test_normalized_copies_are_removed(self):
+        img_path = self._create_image((400, 300), exif=ROTATED_EXIF)
+
+        with normalized_images([img_path]) as img_paths:
+            self.assertNotEqual(img_paths, [img_path])
+            self.assertTrue(os.path.exists(img_paths[0]))
+
+        self.assertFalse(os.path.exists(img_paths[0]))
@@ -0,0 +1,61 @@
+from os.path import abspath
+from os.path import dirname
+from os.path import join
+from tempfile import TemporaryDirectory
+from unittest import TestCase
+import random
+
+from PIL import Image
+import dhash
+
+from faceanalysis.perceptual_hash import MAX_RADIUS
+from faceanalysis.perceptual_hash import _bands
+from faceanalysis.perceptual_hash import compute_perceptual_hash
+from faceanalysis.perceptual_hash import format_perceptual_hash
+
+TEST_IMAGES_ROOT = join(abspath(dirname(__file__)), 'images')
+
+
+class PerceptualHashTestCase(TestCase):
+    def test_reposts_are_near_duplicates(self):
+        img_path = join(TEST_IMAGES_ROOT, '1.jpg')
+        other_img_path = join(TEST_IMAGES_ROOT, '2.jpg')
+
+        with TemporaryDirectory() as directory:
+            repost_path = join(directory, 'repost.jpg')
+            with Image.open(img_path) as image:
+                image.resize((image.width // 2, image.height // 2)) \
+                    .save(repost_path, 'JPEG', quality=60)
+
+            img_hash = compute_perceptual_hash(img_path)
+            repost_hash = compute_perceptual_hash(repost_path)
+            other_hash = compute_perceptual_hash(other_img_path)
+
+        self.assertLessEqual(
+            dhash.get_num_bits_different(img_hash, repost_hash), 4)
+        self.assertGreater(
+            dhash.get_num_bits_different(img_hash, other_hash), MAX_RADIUS)
+
+    def test_remote_images_are_not_hashed(self):
+        self.assertIsNone(compute_perceptual_hash('https://host/img.jpg'))
+
+    def test_hashes_within_radius_share_a_band(self):
+        generator = random.Random(0)
+        for _ in range(100):
+            perceptual_hash = generator.getrandbits(128)
+            flipped_bits = generator.sample(range(128), MAX_RADIUS)
+            other_hash = perceptual_hash
+            for bit in flipped_bits:
+                other_hash ^= 1 << bit
+
+            shared = [band for band, other_band
+                      in zip(_bands(perceptual_hash), _bands(other_hash))
+                      if band == other_band]
+            self.assertTrue(shared)
+
+    def test_format_round_trip(self):
+        perceptual_hash = 1 << 127 | 1
+        formatted = format_perceptual_hash(perceptual_hash)
+
+        self.assertEqual(len(formatted), 32)
+        self.assertEqual(int(formatted, 16), perceptual_hash)
@@ -0,0 +1,98 @@
+from hashlib import sha256
+from io import BytesIO
+from unittest import TestCase
+from unittest.mock import MagicMock
+from unittest.mock import patch
+
+from libcloud.storage.types import ObjectDoesNotExistError
+
+from faceanalysis import storage
+
+
+class GetImageTestCase(TestCase):
+    def setUp(self):
+        self.container = MagicMock()
+        patcher = patch.object(storage, '_get_storage_service',
+                               return_value=self.container)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def _store(self, image_name):
+        def get_object(name):
+            if name != image_name:
+                raise ObjectDoesNotExistError('missing', None, name)
+            return MagicMock(name=name)
+        self.container.get_object.side_effect = get_object
+
+    def test_recorded_name_is_looked_up_directly(self):
+        self._store('img.png')
+
+        storage.get_image_path('img', 'img.png')
+
+        self.container.get_object.assert_called_once_with('img.png')
+
+    def test_missing_recorded_name_raises(self):
+        self._store('img.png')
+
+        with self.assertRaises(storage.StorageError):
+            storage.get_image_path('img', 'img.jpeg')
+
+    def test_legacy_images_are_probed(self):
+        image_name = 'img.{}'.format(storage.allowed_extensions[-1])
+        self._store(image_name)
+
+        storage.get_image_path('img')
+
+        self.container.get_object.assert_called_with(image_name)
+        self.assertEqual(self.container.get_object.call_count,
+                         len(storage.allowed_extensions))
+
+
+class StoreImageTestCase(TestCase):
+    def test_content_hash_is_computed_while_streaming(self):
+        content = b'image content' * 10000
+        uploaded = []
+
+        def upload_object_via_stream(iterator, image_name):
+            chunk = iterator.read(4096)
+            while chunk:
+                uploaded.append(chunk)
+                chunk = iterator.read(4096)
+
+        container = MagicMock()
+        container.upload_object_via_stream.side_effect = \
+            upload_object_via_stream
+
+        with patch.object(storage, '_get_storage_service',
+                          return_value=container):
+            content_hash = storage.store_image(BytesIO(content), 'img.png')
+
+        self.assertEqual(b''.join(uploaded), content)
+        self.assertEqual(content_hash, sha256(content).hexdigest())
+
+
+class DeleteImagesTestCase(TestCase):
+    def setUp(self):
+        self.container = MagicMock()
+        patcher = patch.object(storage, '_get_storage_service',
+                               return_value=self.container)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_missing_images_count_as_deleted(self):
+        images = {'kept.png': MagicMock(), 'deleted.png': MagicMock()}
+        images['kept.png'].delete.return_value = False
+        images['deleted.png'].delete.return_value = True
+
+        def get_object(name):
+            if name not in images:
+                raise ObjectDoesNotExistError('missing', None, name)
+            return images[name]
+        self.container.get_object.side_effect = get_object
+
+        deleted = storage.delete_images([('kept', 'kept.png'),
+                                         ('deleted', 'deleted.png'),
+                                         ('gone', 'gone.png'),
+                                         ('legacy', None)])
+
+        self.assertEqual(deleted, ['deleted', 'gone', 'legacy'])
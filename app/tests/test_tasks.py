@@ -0,0 +1,200 @@
+from unittest import TestCase
+from unittest.mock import MagicMock
+from unittest.mock import patch
+
+from faceanalysis import tasks
+
+
+class MergeMatchesTestCase(TestCase):
+    def setUp(self):
+        patcher = patch.object(tasks, 'face_matcher')
+        self.face_matcher = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_merges_the_matches_of_all_shards(self):
+        # the shard results arrive as json
+        shard_matches = [[['img1', 0.2]], [], [['img2', 0.1], ['img3', 0.5]]]
+
+        tasks.merge_matches(shard_matches, 'img0')
+
+        self.face_matcher.store_matches.assert_called_once_with(
+            'img0', True, [('img1', 0.2), ('img2', 0.1), ('img3', 0.5)])
+
+    def test_merges_the_matches_of_every_image_of_a_batch(self):
+        shard_matches = [
+            [[['img3', 0.2]], []],
+            [[['img4', 0.1]], [['img5', 0.3]]],
+        ]
+
+        tasks.merge_batch_matches(shard_matches, ['img0', 'img1'],
+                                  [True, True])
+
+        self.face_matcher.store_batch_matches.assert_called_once_with(
+            ['img0', 'img1'], [True, True],
+            [[('img3', 0.2), ('img4', 0.1)], [('img5', 0.3)]])
+
+    def test_wait_is_recorded_by_the_processing(self):
+        with patch.object(tasks, 'MATCH_SHARDS', 0):
+            tasks.process_image('img0', tasks.BULK_PRIORITY, 12.5)
+
+        self.face_matcher.process_image.assert_called_once_with(
+            'img0', ('bulk_wait', [12.5]))
+
+    def test_batch_without_faces_is_finished_without_matching(self):
+        self.face_matcher.store_batch_face_vectors.return_value = \
+            (['img0', 'img1'], [[], []])
+
+        with patch.object(tasks, 'MATCH_SHARDS', 2), \
+                patch.object(tasks, 'chord') as chord:
+            tasks.process_image_batch(['img0', 'img1'])
+
+        chord.assert_not_called()
+        self.face_matcher.store_batch_matches.assert_called_once_with(
+            ['img0', 'img1'], [False, False], [[], []])
+
+    def test_batch_is_matched_with_one_chord(self):
+        face_vectors = [[[0.1, 0.2]], []]
+        self.face_matcher.store_batch_face_vectors.return_value = \
+            (['img0', 'img1'], face_vectors)
+
+        with patch.object(tasks, 'MATCH_SHARDS', 2), \
+                patch.object(tasks, 'chord') as chord:
+            tasks.process_image_batch(['img0', 'img1'])
+
+        header, = chord.call_args[0]
+        header = list(header)
+        self.assertEqual([signature.args for signature in header],
+                         [(0, ['img0', 'img1'], face_vectors),
+                          (1, ['img0', 'img1'], face_vectors)])
+        body, = chord.return_value.call_args[0]
+        self.assertEqual(body.args, (['img0', 'img1'], [True, False]))
+        self.assertEqual(body.options['queue'], tasks.get_merge_queue())
+
+
+class PrefetchingRequestTestCase(TestCase):
+    def setUp(self):
+        patcher = patch.object(tasks, 'face_matcher')
+        self.face_matcher = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    @classmethod
+    def _reserve(cls, task, args):
+        message = MagicMock(headers={'id': 'task0', 'task': task.name},
+                            payload=(args, {}, {}),
+                            delivery_info={}, properties={})
+        return task.Request(message, app=tasks.celery, task=task)
+
+    def test_prefetches_the_image_of_a_reserved_task(self):
+        self._reserve(tasks.process_image, ['img0', 'interactive', None])
+
+        self.face_matcher.prefetch_images.assert_called_once_with(['img0'])
+
+    def test_prefetches_the_images_of_a_reserved_batch(self):
+        self._reserve(tasks.process_image_batch, [['img0', 'img1']])
+
+        self.face_matcher.prefetch_images.assert_called_once_with(
+            ['img0', 'img1'])
+
+
+class QueueImagesTestCase(TestCase):
+    def test_images_are_sent_to_the_queue_of_their_priority(self):
+        for priority in tasks.PRIORITIES:
+            with patch.object(tasks, 'IMAGE_BATCH_SIZE', 1), \
+                    patch.object(tasks.celery, 'producer_or_acquire'), \
+                    patch.object(tasks.process_image,
+                                 'apply_async') as apply_async:
+                tasks.queue_images(['img0', 'img1'], priority)
+
+            self.assertEqual(
+                [kwargs['queue'] for _, kwargs in apply_async.call_args_list],
+                [tasks.get_process_queue(priority)] * 2)
+            self.assertEqual(
+                [args[0][:2] for args, _ in apply_async.call_args_list],
+                [('img0', priority), ('img1', priority)])
+
+    def test_images_are_batched_per_priority(self):
+        for priority in tasks.PRIORITIES:
+            with patch.object(tasks, 'IMAGE_BATCH_SIZE', 10), \
+                    patch.object(tasks.celery,
+                                 'connection_for_write') as connect:
+                tasks.queue_images(['img0', 'img1'], priority)
+
+            connection = connect.return_value.__enter__.return_value
+            connection.SimpleQueue.assert_called_once_with(
+                tasks.get_batch_queue(priority))
+            queue = connection.SimpleQueue.return_value.__enter__.return_value
+            self.assertEqual(
+                [args[0]['img_id'] for args, _ in queue.put.call_args_list],
+                ['img0', 'img1'])
+
+    def test_priorities_use_separate_queues(self):
+        self.assertNotEqual(tasks.get_process_queue(tasks.BULK_PRIORITY),
+                            tasks.get_process_queue())
+        self.assertNotEqual(tasks.get_batch_queue(tasks.BULK_PRIORITY),
+                            tasks.get_batch_queue())
+
+
+class _StopScheduling(Exception):
+    pass
+
+
+class _FakeConsumer:
+    def __init__(self):
+        self.consumed_queues = []
+
+    @classmethod
+    def call_soon(cls, func, *args):
+        func(*args)
+
+    def add_task_queue(self, queue):
+        self.consumed_queues.append(queue)
+
+    def cancel_task_queue(self, queue):
+        self.consumed_queues.remove(queue)
+
+
+class PreferInteractiveImagesTestCase(TestCase):
+    def setUp(self):
+        self.bulk_queue = tasks.get_process_queue(tasks.BULK_PRIORITY)
+        self.consumer = _FakeConsumer()
+        self.consumer.consumed_queues.append(self.bulk_queue)
+
+        patcher = patch.object(tasks.celery, 'connection_for_read')
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def _schedule(self, backlogs):
+        # the queues consumed before the first check and after every check
+        consumed_queues = []
+
+        def record(_):
+            consumed_queues.append(list(self.consumer.consumed_queues))
+            if len(consumed_queues) > len(backlogs):
+                raise _StopScheduling
+
+        with patch.object(tasks, 'sleep', side_effect=record), \
+                patch.object(tasks, '_get_queue_depth',
+                             side_effect=backlogs) as get_queue_depth, \
+                self.assertRaises(_StopScheduling):
+            tasks._prefer_interactive_images(self.consumer, 1)
+
+        self.assertEqual(
+            [args[1] for args, _ in get_queue_depth.call_args_list],
+            [tasks.get_process_queue()] * len(backlogs))
+        return consumed_queues[1:]
+
+    def test_bulk_images_are_paused_for_interactive_images(self):
+        consumed_queues = self._schedule([0, 3, 1, 0, 0])
+
+        self.assertEqual(consumed_queues, [
+            [self.bulk_queue],
+            [],
+            [],
+            [self.bulk_queue],
+            [self.bulk_queue],
+        ])
+
+    def test_queue_errors_keep_the_bulk_images_as_they_are(self):
+        consumed_queues = self._schedule([5, ConnectionError(), 0])
+
+        self.assertEqual(consumed_queues, [[], [], [self.bulk_queue]])
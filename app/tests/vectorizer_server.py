@@ -0,0 +1,57 @@
+from base64 import b64decode
+from hashlib import sha256
+from http.server import BaseHTTPRequestHandler
+from http.server import HTTPServer
+from threading import Thread
+import json
+
+
+def fake_face_vectors(image: bytes) -> list:
+    digest = sha256(image).digest()
+    return [[byte / 255 for byte in digest[:8]]]
+
+
+class _VectorizeHandler(BaseHTTPRequestHandler):
+    def do_POST(self):  # pylint: disable=invalid-name
+        length = int(self.headers['Content-Length'])
+        images = json.loads(self.rfile.read(length).decode('utf-8'))
+        self.server.requests.append(images)
+
+        vectors = [fake_face_vectors(b64decode(image))
+                   for image in images['images']]
+
+        body = json.dumps({'faceVectors': vectors}).encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):  # pylint: disable=arguments-differ
+        pass
+
+
+class VectorizerServer:
+    """Stand-in for an algorithm container started with --serve."""
+
+    def __init__(self):
+        self._server = HTTPServer(('127.0.0.1', 0), _VectorizeHandler)
+        self._server.requests = []  # type: ignore
+        self._thread = Thread(target=self._server.serve_forever, daemon=True)
+
+    @property
+    def requests(self) -> list:
+        return self._server.requests  # type: ignore
+
+    @property
+    def url(self) -> str:
+        host, port = self._server.server_address
+        return 'http://{}:{}/vectorize'.format(host, port)
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, *args):
+        self._server.shutdown()
+        self._server.server_close()
@@ -0,0 +1,75 @@
+from parser.pair import Pair
+from typing import Iterable
+from typing import List
+from typing import Union
+from typing import cast
+
+import numpy as np
+from sklearn.cluster import KMeans
+
+from calculator.calculator import Calculator
+from metrics.metrics import VectorEncoding
+from metrics.metrics import VectorEncodingException
+
+PQ_CENTROIDS = 256
+
+
+# pylint: disable=too-few-public-methods
+class QuantizationCalculator(Calculator):
+    """Replaces the embeddings of the pairs with their lossy encoding.
+
+    Mirrors the compressed gallery encodings of the matcher so that their
+    effect on the verification accuracy can be measured.
+    """
+
+    def __init__(self,
+                 vector_encoding: Union[str, VectorEncoding],
+                 pq_subvectors: int = 16) -> None:
+        if isinstance(vector_encoding, str):
+            self._vector_encoding = getattr(VectorEncoding,
+                                            cast(str, vector_encoding))
+        else:
+            self._vector_encoding = vector_encoding
+        self._pq_subvectors = pq_subvectors
+
+    def calculate(self, pairs: Iterable[Pair]) -> List[Pair]:
+        pairs = list(pairs)
+        embeddings = np.array([embedding
+                               for pair in pairs
+                               for embedding in [pair.image1, pair.image2]],
+                              dtype=np.float32)
+        decoded = self._round_trip(embeddings)
+        return [Pair(image1.tolist(), image2.tolist(), pair.is_match)
+                for image1, image2, pair
+                in zip(decoded[0::2], decoded[1::2], pairs)]
+
+    def _round_trip(self, embeddings: np.ndarray) -> np.ndarray:
+        if self._vector_encoding == VectorEncoding.FLOAT16:
+            return embeddings.astype(np.float16).astype(np.float32)
+        if self._vector_encoding == VectorEncoding.INT8:
+            return self._round_trip_int8(embeddings)
+        if self._vector_encoding == VectorEncoding.PQ:
+            return self._round_trip_pq(embeddings)
+        encodings = [str(encoding) for encoding in VectorEncoding]
+        err = f"Undefined {VectorEncoding.__qualname__}. \
+Choose from {encodings}"
+        raise VectorEncodingException(err)
+
+    @staticmethod
+    def _round_trip_int8(embeddings: np.ndarray) -> np.ndarray:
+        low, high = np.percentile(embeddings, [0.1, 99.9], axis=0)
+        scales = np.maximum(high - low, 1e-6) / 255
+        levels = np.clip(np.rint((embeddings - low) / scales), 0, 255)
+        return (levels * scales + low).astype(np.float32)
+
+    def _round_trip_pq(self, embeddings: np.ndarray) -> np.ndarray:
+        num_subvectors = min(self._pq_subvectors, embeddings.shape[1])
+        num_centroids = min(PQ_CENTROIDS, len(embeddings))
+        bounds = np.linspace(0, embeddings.shape[1], num_subvectors + 1,
+                             dtype=int)
+        decoded = np.empty_like(embeddings)
+        for start, end in zip(bounds[:-1], bounds[1:]):
+            kmeans = KMeans(n_clusters=num_centroids, random_state=0)
+            codes = kmeans.fit_predict(embeddings[:, start:end])
+            decoded[:, start:end] = kmeans.cluster_centers_[codes]
+        return decoded
@@ -3,7 +3,9 @@ from parser.container_parser import ContainerParser
 from parser.face_vector_fill_parser import FaceVectorFillParser
 from parser.face_vector_parser import FaceVectorParser
 from parser.face_vector_remove_parser import FaceVectorRemoveParser
+from parser.pair import Pair
 from parser.pair_parser import PairParser
+from typing import List
 
 import numpy as np
 from sklearn.metrics import accuracy_score
@@ -11,6 +13,7 @@ from sklearn.metrics import precision_score
 from sklearn.metrics import recall_score
 
 from calculator.distance_calculator import DistanceCalculator
+from calculator.quantization_calculator import QuantizationCalculator
 from calculator.threshold_calculator import ThresholdCalculator
 from metrics.metrics import EvaluationMetric
 from metrics.metrics import FaceVectorMetric
@@ -55,6 +58,15 @@ class Evaluator:
 
     def evaluate(self) -> EvaluationMetric:
         pairs = list(self._face_vector_parser.compute_pairs())
+        return self._evaluate(pairs)
+
+    def evaluate_encoded(self,
+                         quantization_calculator: QuantizationCalculator) \
+            -> EvaluationMetric:
+        pairs = list(self._face_vector_parser.compute_pairs())
+        return self._evaluate(quantization_calculator.calculate(pairs))
+
+    def _evaluate(self, pairs: List[Pair]) -> EvaluationMetric:
         threshold = self._threshold_calculator.calculate(pairs)
         dist = self._distance_calculator.calculate(pairs)
         predictions = np.less(dist, threshold)
@@ -70,9 +70,19 @@ class ThresholdMetric(Enum):
     F1 = auto()
 
 
+class VectorEncoding(Enum):
+    FLOAT16 = auto()
+    INT8 = auto()
+    PQ = auto()
+
+
 class DistanceMetricException(Exception):
     pass
 
 
 class ThresholdMetricException(Exception):
     pass
+
+
+class VectorEncodingException(Exception):
+    pass
@@ -1,7 +1,8 @@
 from argparse import ArgumentParser, FileType, Namespace
 
+from calculator.quantization_calculator import QuantizationCalculator
 from evaluator.evaluator import Evaluator
-from metrics.metrics import DistanceMetric, ThresholdMetric
+from metrics.metrics import DistanceMetric, ThresholdMetric, VectorEncoding
 
 
 def _parse_arguments() -> Namespace:
@@ -62,6 +63,20 @@ faces are not detected, remove them')
         '--prealigned_flag',
         action='store_true',
         help='Specify if the images have already been aligned.')
+    vector_encodings = [str(encoding)
+                        .replace(f'{VectorEncoding.__qualname__}.', '')
+                        for encoding in VectorEncoding]
+    parser.add_argument(
+        '--vector_encoding',
+        type=str,
+        choices=vector_encodings,
+        help='Also evaluate the face vectors after a lossy encoding and \
+report the change in the evaluation metrics.')
+    parser.add_argument(
+        '--pq_subvectors',
+        type=int,
+        default=16,
+        help='Number of subvectors for the PQ vector encoding.')
     return parser.parse_args()
 
 
@@ -69,6 +84,17 @@ def _main(args: Namespace) -> None:
     evaluator = Evaluator.create_evaluator(args)
     evaluation_results = evaluator.evaluate()
     print('Evaluation results: ', evaluation_results)
+    if args.vector_encoding:
+        quantization_calculator = QuantizationCalculator(args.vector_encoding,
+                                                         args.pq_subvectors)
+        encoded_results = evaluator.evaluate_encoded(quantization_calculator)
+        print(f'Evaluation results with {args.vector_encoding} encoding: ',
+              encoded_results)
+        print('Accuracy delta: {:+.4f}, recall delta: {:+.4f}, \
+precision delta: {:+.4f}'.format(
+            encoded_results.accuracy - evaluation_results.accuracy,
+            encoded_results.recall - evaluation_results.recall,
+            encoded_results.precision - evaluation_results.precision))
     parser_metrics = evaluator.compute_metrics()
     print('Parser metrics: ', parser_metrics)
 